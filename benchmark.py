@@ -0,0 +1,347 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from types import SimpleNamespace
+
+# Benchmark offline dos caminhos mais usados do SAVECNT, com listas sintéticas de contatos.
+#
+# Uso:
+#   python benchmark.py --tamanhos 1000,10000,100000 --saida resultado.json
+#   python benchmark.py --tamanhos 1000,10000,100000 --comparar resultado.json
+#
+# Para cada tamanho, um usuário sintético recebe a lista inteira e os handlers são
+# chamados com Update/Context falsos, sem rede. Cada operação informa execuções/s,
+# latência p50/p99 e o pico de memória alocada durante uma execução (tracemalloc, medido
+# numa rodada separada para não pesar nos tempos). Os dados ficam num diretório
+# temporário, apagado no final; o arquivo de contatos do bot não é tocado.
+
+DIRETORIO = os.path.dirname(os.path.abspath(__file__))
+
+PRIMEIROS_NOMES = [
+    "Ana", "João", "Maria", "José", "Antônio", "Francisca", "Carlos", "Paulo", "Lúcia", "Pedro",
+    "Luís", "Marcos", "Gabriel", "Rafael", "Fernanda", "Juliana", "Márcia", "Sebastião", "Beatriz", "Conceição",
+]
+SOBRENOMES = [
+    "Silva", "Santos", "Oliveira", "Souza", "Rodrigues", "Ferreira", "Alves", "Pereira", "Lima", "Gomes",
+    "Araújo", "Ribeiro", "Cavalcanti", "Barbosa", "Monteiro", "Correia", "Nascimento", "Melo", "Tenório", "Brandão",
+]
+CATEGORIAS = ["Trabalho", "Família", "Amigos", "Clientes", "Fornecedores", None]
+DDDS = ["11", "21", "31", "71", "81", "82", "83", "85", "61", "51"]
+
+# Vão no JSON do resultado, para quem compara com resultados de versões anteriores
+NOTAS = [
+    "procurar_contatos_por_nome não existe mais: a busca por nome é medida em buscar_nome, "
+    "pelo handler processar_editar_nome, como o usuário a usa em /editar",
+    "salvar_contatos mede até o gravador terminar de escrever o snapshot; antes media só "
+    "a entrada da compactação na fila",
+]
+
+
+def preparar_ambiente(opcoes):
+    # O savecnt abre log e arquivos de dados no diretório atual ao ser importado
+    pasta = tempfile.mkdtemp(prefix="savecnt_benchmark_")
+    os.chdir(pasta)
+    os.environ["SAVECNT_ARMAZENAMENTO"] = opcoes.armazenamento
+    # Sem descarte por orçamento de memória no meio das medições
+    os.environ["SAVECNT_USUARIOS_MEMORIA"] = str(10 ** 6)
+    os.environ["SAVECNT_CONTATOS_MEMORIA"] = str(10 ** 9)
+    sys.path.insert(0, DIRETORIO)
+    import savecnt
+    return savecnt, pasta
+
+
+def gerar_linhas(aleatorio, quantidade, inicio=0):
+    # Pares (linha do nome, número) distintos: o índice do contato entra no nome
+    for i in range(inicio, inicio + quantidade):
+        nome = f"{aleatorio.choice(PRIMEIROS_NOMES)} {aleatorio.choice(SOBRENOMES)} {i}"
+        categoria = aleatorio.choice(CATEGORIAS)
+        if categoria is not None:
+            nome = f"{nome} - {categoria}"
+        numero = aleatorio.choice(DDDS) + "9" + f"{aleatorio.randrange(10 ** 8):08d}"
+        yield nome, numero
+
+
+class MensagemFalsa:
+    ids = iter(range(1, 10 ** 18))
+
+    def __init__(self, texto=None, documento=None):
+        self.message_id = next(MensagemFalsa.ids)
+        self.text = texto
+        self.document = documento
+        self.respostas = []
+
+    async def reply_text(self, texto, **kwargs):
+        self.respostas.append(texto)
+        return MensagemFalsa(texto)
+
+    async def edit_text(self, texto, **kwargs):
+        self.text = texto
+        return self
+
+
+class DocumentoFalso:
+    def __init__(self, nome, dados):
+        self.file_name = nome
+        self.mime_type = None
+        self.file_size = len(dados)
+        self.dados = dados
+
+    async def get_file(self):
+        return self
+
+    async def download_to_memory(self, out):
+        out.write(self.dados)
+
+
+def update_falso(user_id, texto=None, documento=None):
+    return SimpleNamespace(
+        effective_user=SimpleNamespace(id=user_id),
+        message=MensagemFalsa(texto, documento),
+        callback_query=None,
+    )
+
+
+contexto_falso = SimpleNamespace(bot=SimpleNamespace(rate_limiter=None))
+
+
+def percentil(ordenados, fracao):
+    return ordenados[min(len(ordenados) - 1, int(len(ordenados) * fracao))]
+
+
+def esvaziar_gravador(savecnt):
+    # Espera o gravador entregar tudo o que está na fila e o põe para rodar de novo
+    savecnt.armazenamento.parar()
+    savecnt.armazenamento.iniciar()
+
+
+async def executar(funcao):
+    resultado = funcao()
+    if asyncio.iscoroutine(resultado):
+        await resultado
+
+
+async def medir(funcao, execucoes, execucoes_memoria):
+    tempos = []
+    for _ in range(execucoes):
+        inicio = time.perf_counter()
+        await executar(funcao)
+        tempos.append(time.perf_counter() - inicio)
+    # Pico de memória numa rodada à parte: o tracemalloc deixa tudo bem mais lento
+    tracemalloc.start()
+    pico = 0
+    for _ in range(execucoes_memoria):
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        await executar(funcao)
+        pico = max(pico, tracemalloc.get_traced_memory()[1] - base)
+    tracemalloc.stop()
+    ordenados = sorted(tempos)
+    total = sum(tempos)
+    return {
+        "execucoes": execucoes,
+        "total_s": round(total, 4),
+        "ops_por_s": round(execucoes / total, 1) if total else None,
+        "p50_ms": round(percentil(ordenados, 0.50) * 1000, 3),
+        "p99_ms": round(percentil(ordenados, 0.99) * 1000, 3),
+        "pico_memoria_kb": round(pico / 1024, 1),
+    }
+
+
+def montar_operacoes(savecnt, user_id, aleatorio, opcoes, contador):
+    usuario = savecnt.obter_usuario(user_id)
+    contatos = usuario["contatos"]
+    consultas = [(c.nome_linha, c.numero) for c in aleatorio.sample(contatos, min(len(contatos), 1000))]
+    total_paginas = (len(contatos) + 24) // 25
+
+    def contato_existe():
+        nome, numero = aleatorio.choice(consultas)
+        # Metade das consultas acerta, metade procura um número que não existe
+        if aleatorio.random() < 0.5:
+            numero = numero[:-1] + ("0" if numero[-1] != "0" else "1")
+        savecnt.contato_existe(user_id, nome, numero)
+
+    def buscar_nome():
+        nome = aleatorio.choice(consultas)[0].split(" - ")[0]
+        # Busca por parte do nome, como o usuário digita em /editar e /remover
+        return savecnt.processar_editar_nome(update_falso(user_id, nome), contexto_falso, nome.split(" ")[1])
+
+    def listar():
+        usuario["ordenacao"] = aleatorio.choice(["padrao", "alfabetica"])
+        return savecnt.listar(update_falso(user_id), contexto_falso, pagina=aleatorio.randrange(total_paginas))
+
+    def duplicados():
+        # Metade só por número, metade também por nome (/duplicados nomes)
+        argumentos = aleatorio.choice([[], ["nomes"]])
+        contexto = SimpleNamespace(bot=contexto_falso.bot, args=argumentos)
+        return savecnt.duplicados(update_falso(user_id), contexto)
+
+    rapidas = opcoes.consultas
+    pesadas = opcoes.repeticoes
+    # Entradas geradas antes da medição, uma por execução (tempo e memória)
+    mensagens = []
+    for _ in range(max(1, rapidas // 10) + opcoes.execucoes_memoria):
+        # Uma mensagem colada com 50 contatos novos, como chega do Telegram
+        linhas = gerar_linhas(aleatorio, 50, inicio=next(contador))
+        mensagens.append("\n".join(f"{nome}\n({numero[:2]}) {numero[2:7]}-{numero[7:]}" for nome, numero in linhas))
+    documentos = []
+    for _ in range(pesadas + opcoes.execucoes_memoria):
+        # Um CSV de 5000 contatos para um usuário novo a cada execução
+        destino = next(contador)
+        linhas = ["Nome,Número,Categoria"] + [
+            f'"{nome}","+55{numero}","{savecnt.Contato.de_linha(nome, numero).categoria_exibicao}"'
+            for nome, numero in gerar_linhas(aleatorio, 5000, inicio=destino)
+        ]
+        documentos.append((destino, DocumentoFalso("contatos.csv", "\n".join(linhas).encode("utf-8"))))
+
+    def adicionar_mensagem():
+        # O modo de edição deixado pela busca fica na sessão, não no usuário
+        savecnt.obter_sessao(user_id).pop("modo_edicao", None)
+        return savecnt.handle_message(update_falso(user_id, mensagens.pop()), contexto_falso)
+
+    def importar_csv():
+        destino, documento = documentos.pop()
+        return savecnt.importar_documento(update_falso(destino, documento=documento), contexto_falso)
+
+    def salvar_contatos():
+        # Sem nada registrado desde a última compactação o salvar não grava nada: uma
+        # alteração por execução. O tempo vai até o gravador terminar de escrever, não
+        # só até a compactação entrar na fila dele.
+        savecnt.salvar_estado(user_id)
+        savecnt.salvar_contatos()
+        esvaziar_gravador(savecnt)
+
+    return [
+        ("contato_existe", contato_existe, rapidas),
+        ("buscar_nome", buscar_nome, rapidas),
+        ("listar", listar, rapidas),
+        ("duplicados", duplicados, pesadas),
+        ("handle_message_50", adicionar_mensagem, max(1, rapidas // 10)),
+        ("salvar_vcf", lambda: savecnt.salvar_vcf(contatos), pesadas),
+        ("salvar_csv", lambda: savecnt.salvar_csv(contatos), pesadas),
+        ("salvar_json", lambda: savecnt.salvar_json(contatos), pesadas),
+        ("importar_csv_5000", importar_csv, pesadas),
+        ("salvar_contatos", salvar_contatos, pesadas),
+    ]
+
+
+async def rodar_tamanho(savecnt, tamanho, opcoes):
+    aleatorio = random.Random(opcoes.semente + tamanho)
+    user_id = tamanho
+    # Contadores distintos por tamanho para nomes e usuários de importação não colidirem
+    contador = iter(range(10 ** 9 + tamanho * 10 ** 6, 10 ** 18, 10 ** 4))
+
+    inicio = time.perf_counter()
+    novos = [savecnt.Contato.de_linha(nome, numero) for nome, numero in gerar_linhas(aleatorio, tamanho)]
+    savecnt.adicionar_contatos(user_id, novos)
+    savecnt.obter_indice(user_id)
+    preparo = time.perf_counter() - inicio
+    # O índice de trigramas só nasce na primeira busca do usuário: medido à parte
+    inicio = time.perf_counter()
+    savecnt.obter_indice(user_id).obter_busca()
+    indice_busca = time.perf_counter() - inicio
+    print(f"{tamanho} contatos: lista e índice montados em {preparo:.2f}s, "
+          f"índice de busca em {indice_busca:.2f}s", file=sys.stderr)
+
+    resultados = {"preparo_s": round(preparo, 3), "indice_busca_s": round(indice_busca, 3), "operacoes": {}}
+    for nome, funcao, execucoes in montar_operacoes(savecnt, user_id, aleatorio, opcoes, contador):
+        # Cada operação começa com o gravador vazio: o que a anterior deixou na fila não
+        # entra na conta dela
+        esvaziar_gravador(savecnt)
+        resultados["operacoes"][nome] = await medir(funcao, execucoes, min(execucoes, opcoes.execucoes_memoria))
+        dados = resultados["operacoes"][nome]
+        print(f"  {nome:<20} {dados['ops_por_s']:>10} op/s  p50 {dados['p50_ms']:>10} ms  "
+              f"p99 {dados['p99_ms']:>10} ms  pico {dados['pico_memoria_kb']:>10} KiB", file=sys.stderr)
+
+    # Libera a memória antes do próximo tamanho
+    for uid in list(savecnt.contatos_por_usuario):
+        savecnt.descartar_usuario(uid)
+    return resultados
+
+
+def revisao_git():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=DIRETORIO,
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def comparar(atual, anterior):
+    print(f"\nComparação com {anterior.get('revisao')} ({anterior.get('data')}, {anterior.get('armazenamento')}):")
+    print(f"  {'tamanho':>9} {'operação':<20} {'p50 antes':>12} {'p50 agora':>12} {'variação':>9}")
+    for tamanho, dados in atual["tamanhos"].items():
+        antigos = anterior.get("tamanhos", {}).get(tamanho, {}).get("operacoes", {})
+        for nome, medida in dados["operacoes"].items():
+            antes = antigos.get(nome)
+            if not antes or not antes["p50_ms"]:
+                continue
+            variacao = (medida["p50_ms"] - antes["p50_ms"]) / antes["p50_ms"] * 100
+            print(f"  {tamanho:>9} {nome:<20} {antes['p50_ms']:>12} {medida['p50_ms']:>12} {variacao:>+8.1f}%")
+
+
+async def principal(savecnt, opcoes):
+    tamanhos = [int(t) for t in opcoes.tamanhos.split(",") if t.strip()]
+    resultado = {
+        "data": datetime.now().isoformat(timespec="seconds"),
+        "revisao": revisao_git(),
+        "python": platform.python_version(),
+        "plataforma": platform.platform(),
+        "armazenamento": opcoes.armazenamento,
+        "semente": opcoes.semente,
+        "notas": NOTAS,
+        "tamanhos": {},
+    }
+    savecnt.armazenamento.iniciar()
+    try:
+        for tamanho in tamanhos:
+            resultado["tamanhos"][str(tamanho)] = await rodar_tamanho(savecnt, tamanho, opcoes)
+    finally:
+        savecnt.armazenamento.parar()
+    return resultado
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark offline dos handlers do SAVECNT")
+    parser.add_argument("--tamanhos", default="1000,10000,100000",
+                        help="quantidades de contatos do usuário sintético, separadas por vírgula (até 1000000)")
+    parser.add_argument("--consultas", type=int, default=1000,
+                        help="execuções das operações rápidas (contato_existe, busca, listar)")
+    parser.add_argument("--repeticoes", type=int, default=5,
+                        help="execuções das operações que percorrem a lista toda (exportações, duplicados, salvar)")
+    parser.add_argument("--execucoes-memoria", type=int, default=3,
+                        help="execuções de cada operação na rodada que mede o pico de memória")
+    parser.add_argument("--armazenamento", choices=["pickle", "sqlite"], default="pickle")
+    parser.add_argument("--semente", type=int, default=42)
+    parser.add_argument("--saida", help="grava o resultado neste arquivo JSON")
+    parser.add_argument("--comparar", metavar="JSON", help="compara com um resultado salvo antes")
+    opcoes = parser.parse_args()
+    saida = os.path.abspath(opcoes.saida) if opcoes.saida else None
+    anterior = None
+    if opcoes.comparar:
+        with open(opcoes.comparar, encoding="utf-8") as f:
+            anterior = json.load(f)
+
+    savecnt, pasta = preparar_ambiente(opcoes)
+    try:
+        resultado = asyncio.run(principal(savecnt, opcoes))
+    finally:
+        shutil.rmtree(pasta, ignore_errors=True)
+    if saida:
+        with open(saida, "w", encoding="utf-8") as f:
+            json.dump(resultado, f, ensure_ascii=False, indent=2)
+    else:
+        print(json.dumps(resultado, ensure_ascii=False, indent=2))
+    if anterior:
+        comparar(resultado, anterior)
@@ -1,7 +1,8 @@
-import vobject
-from telegram import Update, InputFile, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Bot, Update, InputFile, InputMediaDocument, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest, NetworkError, RetryAfter
 from telegram.ext import (
     ApplicationBuilder,
+    BaseRateLimiter,
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
@@ -13,43 +14,990 @@ import pickle
 import os
 import logging
 import json
-from datetime import datetime
+from datetime import datetime, timedelta
 import sys
 import time
-from multiprocessing import Process
+from multiprocessing import Process, Queue
 import signal
-from io import BytesIO
-
-# Configurar logging apenas para arquivo, sem output no console
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO,
-    handlers=[
-        logging.FileHandler("bot_contatos.log"),
-    ]
-)
+import functools
+import argparse
+import heapq
+import math
+import unicodedata
+import bisect
+import asyncio
+import zipfile
+import struct
+import mmap
+import zlib
+import csv
+import quopri
+import tempfile
+import itertools
+import threading
+import queue
+import atexit
+import contextvars
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from io import BytesIO, TextIOWrapper
+from array import array
+from contextlib import asynccontextmanager
+from urllib.parse import urlparse
+from collections import OrderedDict, Counter
+from concurrent.futures import ThreadPoolExecutor
+
+ARQUIVO_LOG = "bot_contatos.log"
+# Tamanho de cada arquivo de log antes de girar e quantos arquivos antigos são mantidos
+TAMANHO_LOG = int(os.environ.get("SAVECNT_LOG_MB", "10")) * 1024 * 1024
+ARQUIVOS_LOG = int(os.environ.get("SAVECNT_LOG_ARQUIVOS", "5"))
+# SAVECNT_LOG_JSON=1 grava uma linha JSON por registro em vez do texto
+LOG_JSON = os.environ.get("SAVECNT_LOG_JSON") == "1"
+
+# (update_id, user_id) do update atendido pela tarefa atual, para correlacionar as linhas de log
+update_atual = contextvars.ContextVar("update_atual", default=None)
+
+class AnexarCorrelacao(logging.Filter):
+    # Roda na thread de quem loga, onde o contextvar da tarefa ainda é visível
+    def filter(self, registro):
+        atual = update_atual.get()
+        registro.update_id, registro.user_id = atual or (None, None)
+        registro.correlacao = f"[update {atual[0]} user {atual[1]}] " if atual else ""
+        return True
+
+class FormatoJSON(logging.Formatter):
+    def format(self, registro):
+        return json.dumps({
+            "hora": datetime.fromtimestamp(registro.created).isoformat(timespec="milliseconds"),
+            "nivel": registro.levelname,
+            "logger": registro.name,
+            "processo": registro.processName,
+            "update_id": getattr(registro, "update_id", None),
+            "user_id": getattr(registro, "user_id", None),
+            "mensagem": registro.getMessage(),
+        }, ensure_ascii=False)
+
+# Fila do log do processo principal; vai como argumento para o bot e os shards
+fila_log = None
+
+def ligar_log(fila):
+    # Quem loga (handlers no event loop, threads, shards) só enfileira o registro; o arquivo
+    # é escrito pela thread do QueueListener do processo principal. Com fork o filho herda o
+    # handler já ligado à fila; com spawn o módulo é reimportado sem log e liga aqui.
+    global fila_log
+    raiz = logging.getLogger()
+    if any(isinstance(h, QueueHandler) and h.queue is fila for h in raiz.handlers):
+        return
+    fila_log = fila
+    entrada = QueueHandler(fila)
+    entrada.addFilter(AnexarCorrelacao())
+    # Configurar logging apenas para arquivo, sem output no console
+    raiz.setLevel(logging.INFO)
+    raiz.addHandler(entrada)
+
+def configurar_log():
+    # Só o processo principal escreve e gira o log: um RotatingFileHandler por processo
+    # giraria o mesmo arquivo por cima dos outros. A marca no ambiente passa para os filhos.
+    os.environ["SAVECNT_LOG_PROCESSO"] = str(os.getpid())
+    arquivo = RotatingFileHandler(ARQUIVO_LOG, maxBytes=TAMANHO_LOG, backupCount=ARQUIVOS_LOG, encoding="utf-8")
+    if LOG_JSON:
+        arquivo.setFormatter(FormatoJSON())
+    else:
+        arquivo.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(correlacao)s%(message)s'))
+    fila = Queue()
+    ligar_log(fila)
+    ouvinte = QueueListener(fila, arquivo)
+    ouvinte.start()
+    # Processos filhos saem sem atexit: só este processo para o ouvinte e esvazia a fila
+    atexit.register(ouvinte.stop)
+    return ouvinte
+
+# Com spawn (e forkserver) cada filho reimporta o módulo, antes mesmo de saber que é filho:
+# a marca herdada do ambiente evita um segundo arquivo de log, e o filho liga o log depois
+# à fila que recebe como argumento
+if not os.environ.get("SAVECNT_LOG_PROCESSO"):
+    configurar_log()
 logger = logging.getLogger(__name__)
 
 logging.getLogger("httpx").setLevel(logging.WARNING)
 logging.getLogger("telegram").setLevel(logging.WARNING)
 
-def carregar_contatos():
-    try:
-        if os.path.exists('contatos_salvos.pkl'):
-            with open('contatos_salvos.pkl', 'rb') as f:
-                return pickle.load(f)
-    except Exception as e:
-        logger.error(f"Erro ao carregar contatos: {e}")
-        if os.path.exists('contatos_salvos.pkl'):
-            os.remove('contatos_salvos.pkl')
-    return {}
+ARQUIVO_CONTATOS = 'contatos_salvos.pkl'
+ARQUIVO_JOURNAL = 'contatos_journal.log'
+ARQUIVO_SQLITE = 'contatos.db'
+# Quantidade de alterações no journal antes de compactar tudo em um novo snapshot
+LIMITE_JOURNAL = 1000
+# Intervalo em que o gravador junta alterações antes de ir ao disco
+INTERVALO_PERSISTENCIA = 1.0
+# Backend de armazenamento: "pickle" (padrão) ou "sqlite"
+BACKEND_ARMAZENAMENTO = os.environ.get("SAVECNT_ARMAZENAMENTO", "pickle")
+# Quantos shards os arquivos de dados estão divididos no momento (0 = arquivo único)
+ARQUIVO_SHARDS = 'shards.json'
+# Tempo que o processo da frente espera cada shard gravar tudo ao encerrar
+PRAZO_ENCERRAMENTO_SHARD = 30
+# Início (e fim) dos snapshots colunares com um bloco por usuário (formato 4)
+MAGICO_SNAPSHOT = b"SAVECNT4"
+# Formato 3: um bloco pickle por usuário, só lido para converter
+MAGICO_SNAPSHOT_3 = b"SAVECNT3"
+# Orçamento de usuários em memória; acima dele os ociosos são gravados e descartados
+LIMITE_USUARIOS_MEMORIA = int(os.environ.get("SAVECNT_USUARIOS_MEMORIA", 5000))
+LIMITE_CONTATOS_MEMORIA = int(os.environ.get("SAVECNT_CONTATOS_MEMORIA", 2000000))
+
+SEM_CATEGORIA = "Sem categoria"
+
+class Contato:
+    # Registro compacto de um contato. Nome e categoria são separados uma única vez,
+    # na entrada; categoria None significa que a linha original não tinha " - ".
+    __slots__ = ("nome", "categoria", "numero")
+
+    def __init__(self, nome, categoria, numero):
+        self.nome = nome
+        # Categorias se repetem muito: internar evita uma cópia da string por contato
+        self.categoria = sys.intern(categoria) if categoria is not None else None
+        self.numero = numero
+
+    @classmethod
+    def de_linha(cls, nome_linha, numero):
+        if ' - ' in nome_linha:
+            nome, categoria = nome_linha.split(' - ', 1)
+            return cls(nome, categoria, numero)
+        return cls(nome_linha, None, numero)
+
+    @property
+    def nome_linha(self):
+        # Forma "Nome - Categoria" exibida ao usuário, idêntica à digitada
+        if self.categoria is None:
+            return self.nome
+        return f"{self.nome} - {self.categoria}"
+
+    @property
+    def categoria_exibicao(self):
+        return SEM_CATEGORIA if self.categoria is None else self.categoria
+
+    def __reduce__(self):
+        return (Contato, (self.nome, self.categoria, self.numero))
+
+    def __eq__(self, outro):
+        if not isinstance(outro, Contato):
+            return NotImplemented
+        return (self.nome, self.categoria, self.numero) == (outro.nome, outro.categoria, outro.numero)
+
+    def __hash__(self):
+        return hash((self.nome, self.categoria, self.numero))
+
+    def __repr__(self):
+        return f"Contato({self.nome_linha!r}, {self.numero!r})"
+
+def como_contato(contato):
+    # O journal guarda (nome, categoria, numero); dados antigos guardavam (nome_linha, numero)
+    if isinstance(contato, Contato):
+        return contato
+    if len(contato) == 3:
+        return Contato(*contato)
+    return Contato.de_linha(contato[0], contato[1])
+
+def dados_para_journal(op, dados):
+    # O journal só leva tipos básicos: um Contato em pickle guarda o módulo da classe, que é
+    # "__main__" rodando o script e "savecnt" quando importado, e um não lê o do outro
+    if op == "adicionar":
+        return [(c.nome, c.categoria, c.numero) for c in map(como_contato, dados)]
+    if op == "editar":
+        idx, contato = dados
+        contato = como_contato(contato)
+        return (idx, (contato.nome, contato.categoria, contato.numero))
+    return dados
+
+class LeitorPickle(pickle.Unpickler):
+    # Journals e snapshots gravados antes guardam a classe pelo módulo de quem gravou:
+    # qualquer um deles vira o Contato daqui
+    def find_class(self, modulo, nome):
+        if nome == "Contato" and modulo in ("__main__", "__mp_main__", "savecnt"):
+            return Contato
+        return super().find_class(modulo, nome)
+
+def ler_pickle(dados):
+    return LeitorPickle(BytesIO(dados)).load()
+
+def converter_usuarios(usuarios):
+    for usuario in usuarios.values():
+        contatos = usuario.get("contatos", [])
+        if contatos and not all(isinstance(c, Contato) for c in contatos):
+            usuario["contatos"] = [como_contato(c) for c in contatos]
+    return usuarios
+
+def aplicar_alteracao(usuarios, user_id, op, dados):
+    # Mesma função para alterações ao vivo e para o replay do journal.
+    # Altera o dicionário do usuário no lugar, para que referências já obtidas continuem válidas.
+    if user_id not in usuarios:
+        usuarios[user_id] = {"contatos": []}
+    usuario = usuarios[user_id]
+    if op == "adicionar":
+        usuario["contatos"].extend(como_contato(c) for c in dados)
+    elif op == "editar":
+        idx, contato = dados
+        usuario["contatos"][idx] = como_contato(contato)
+    elif op == "remover":
+        indices = set(dados)
+        usuario["contatos"][:] = [c for i, c in enumerate(usuario["contatos"]) if i not in indices]
+    elif op == "limpar":
+        usuario["contatos"].clear()
+    elif op == "reiniciar":
+        usuario.clear()
+        usuario["contatos"] = []
+    elif op == "estado":
+        contatos = usuario["contatos"]
+        usuario.clear()
+        usuario.update(dados)
+        usuario["contatos"] = contatos
+    else:
+        logger.warning(f"Operação desconhecida no journal: {op}")
+
+class GravadorPersistencia:
+    # Thread que tira o acesso a disco do event loop: os handlers só enfileiram
+    # itens já serializados e a thread entrega tudo em lote a cada intervalo.
+    def __init__(self, gravar_lote, intervalo=INTERVALO_PERSISTENCIA):
+        self.gravar_lote = gravar_lote
+        self.intervalo = intervalo
+        self.fila = queue.Queue()
+        self.thread = None
+        # Itens já enfileirados e já entregues: quem guarda o valor de enfileirados sabe,
+        # comparando com gravados, se aquela escrita já chegou ao disco
+        self.enfileirados = 0
+        self.gravados = 0
+
+    def iniciar(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._executar, name="gravador", daemon=True)
+            self.thread.start()
+
+    def parar(self):
+        # Garante que tudo o que já foi enfileirado chegue ao disco
+        if self.thread is not None:
+            self.fila.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def enfileirar(self, tipo, dados):
+        self.enfileirados += 1
+        if self.thread is None:
+            self.gravar_lote([(tipo, dados)])
+            self.gravados = self.enfileirados
+        else:
+            self.fila.put((tipo, dados))
 
-def salvar_contatos():
-    try:
-        with open('contatos_salvos.pkl', 'wb') as f:
-            pickle.dump(contatos_por_usuario, f)
-    except Exception as e:
-        logger.error(f"Erro ao salvar contatos: {e}")
+    def _executar(self):
+        while True:
+            lote = [self.fila.get()]
+            prazo = time.monotonic() + self.intervalo
+            while lote[-1] is not None:
+                restante = prazo - time.monotonic()
+                if restante <= 0:
+                    break
+                try:
+                    lote.append(self.fila.get(timeout=restante))
+                except queue.Empty:
+                    break
+            encerrar = lote[-1] is None
+            itens = [item for item in lote if item is not None]
+            inicio = time.perf_counter()
+            try:
+                self.gravar_lote(itens)
+            except Exception as e:
+                logger.error(f"Erro no gravador de persistência: {e}")
+            if metricas.ativo and itens:
+                metricas.observar("savecnt_persistencia_gravacao_segundos", time.perf_counter() - inicio)
+                metricas.contar("savecnt_persistencia_itens_total", len(itens))
+            self.gravados += len(itens)
+            if encerrar:
+                return
+
+class SnapshotCorrompido(Exception):
+    pass
+
+class JournalCorrompido(Exception):
+    pass
+
+# Cabeçalho de cada bloco: contatos, categorias distintas e flags
+BLOCO_SNAPSHOT = struct.Struct("<IIB")
+# Flag do bloco: algum texto continha o separador e as colunas foram gravadas com posições
+TEXTOS_COM_POSICOES = 1
+# Separador dos textos de uma coluna; um split só devolve a coluna inteira
+SEPARADOR_COLUNA = "\x00"
+# Rodapé: posição da tabela de usuários, quantidade de usuários e seq (seguidos do CRC)
+RODAPE_SNAPSHOT = struct.Struct("<QQQ")
+
+def bytes_coluna(valores):
+    # Colunas sempre em little-endian, qualquer que seja a máquina
+    if sys.byteorder == "big":
+        valores = array(valores.typecode, valores)
+        valores.byteswap()
+    return valores.tobytes()
+
+def ler_coluna(tipo, dados, posicao, quantidade):
+    valores = array(tipo)
+    fim = posicao + valores.itemsize * quantidade
+    valores.frombytes(dados[posicao:fim])
+    if sys.byteorder == "big":
+        valores.byteswap()
+    return valores, fim
+
+def empacotar_textos(textos, com_posicoes):
+    # Todos os textos da coluna juntos em UTF-8, separados por SEPARADOR_COLUNA. Se algum
+    # texto contém o separador, vai antes o fim de cada um (em caracteres) para fatiar.
+    if com_posicoes:
+        texto = "".join(textos)
+        prefixo = bytes_coluna(array("I", itertools.accumulate(map(len, textos))))
+    else:
+        texto = SEPARADOR_COLUNA.join(textos)
+        prefixo = b""
+    dados = texto.encode("utf-8", "surrogatepass")
+    return prefixo + struct.pack("<I", len(dados)) + dados
+
+def desempacotar_textos(dados, posicao, quantidade, com_posicoes):
+    if com_posicoes:
+        fins, posicao = ler_coluna("I", dados, posicao, quantidade)
+    tamanho, = struct.unpack_from("<I", dados, posicao)
+    posicao += 4
+    texto = dados[posicao:posicao + tamanho].decode("utf-8", "surrogatepass")
+    posicao += tamanho
+    if not quantidade:
+        return [], posicao
+    if com_posicoes:
+        return [texto[i:j] for i, j in zip(itertools.chain((0,), fins), fins)], posicao
+    return texto.split(SEPARADOR_COLUNA), posicao
+
+def empacotar_usuario(usuario):
+    # Bloco colunar: nomes, dicionário de categorias com um código por contato, números
+    # e, por último, o restante do usuário (sessão) em pickle
+    contatos = usuario.get("contatos", [])
+    codigos_categoria = {None: 0}
+    codigos = array("I", (codigos_categoria.setdefault(c.categoria, len(codigos_categoria)) for c in contatos))
+    categorias = list(codigos_categoria)[1:]
+    nomes = [c.nome for c in contatos]
+    numeros = [c.numero for c in contatos]
+    com_posicoes = any(SEPARADOR_COLUNA in t for t in itertools.chain(nomes, categorias, numeros))
+    estado = {k: v for k, v in usuario.items() if k != "contatos"}
+    return b"".join((
+        BLOCO_SNAPSHOT.pack(len(contatos), len(categorias), TEXTOS_COM_POSICOES if com_posicoes else 0),
+        empacotar_textos(nomes, com_posicoes),
+        empacotar_textos(categorias, com_posicoes),
+        bytes_coluna(codigos),
+        empacotar_textos(numeros, com_posicoes),
+        pickle.dumps(estado, protocol=pickle.HIGHEST_PROTOCOL) if estado else b"",
+    ))
+
+def desempacotar_usuario(dados):
+    quantidade, total_categorias, flags = BLOCO_SNAPSHOT.unpack_from(dados, 0)
+    com_posicoes = bool(flags & TEXTOS_COM_POSICOES)
+    nomes, posicao = desempacotar_textos(dados, BLOCO_SNAPSHOT.size, quantidade, com_posicoes)
+    categorias, posicao = desempacotar_textos(dados, posicao, total_categorias, com_posicoes)
+    categorias.insert(0, None)
+    codigos, posicao = ler_coluna("I", dados, posicao, quantidade)
+    numeros, posicao = desempacotar_textos(dados, posicao, quantidade, com_posicoes)
+    usuario = pickle.loads(dados[posicao:]) if posicao < len(dados) else {}
+    usuario["contatos"] = list(map(Contato, nomes, map(categorias.__getitem__, codigos), numeros))
+    return usuario
+
+class IndiceSnapshot:
+    # Tabela de usuários do snapshot: ids ordenados e, na mesma ordem, posição, tamanho
+    # e CRC de cada bloco. São arrays copiados do arquivo, sem um objeto por usuário.
+    def __init__(self, ids=None, posicoes=None, tamanhos=None, crcs=None):
+        self.ids = ids if ids is not None else array("q")
+        self.posicoes = posicoes if posicoes is not None else array("Q")
+        self.tamanhos = tamanhos if tamanhos is not None else array("I")
+        self.crcs = crcs if crcs is not None else array("I")
+
+    def _posicao(self, user_id):
+        i = bisect.bisect_left(self.ids, user_id)
+        return i if i < len(self.ids) and self.ids[i] == user_id else None
+
+    def __contains__(self, user_id):
+        return self._posicao(user_id) is not None
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, user_id):
+        i = self._posicao(user_id)
+        if i is None:
+            raise KeyError(user_id)
+        return self.posicoes[i], self.tamanhos[i], self.crcs[i]
+
+class ArmazenamentoPickle:
+    # Backend padrão: snapshot binário + journal incremental (pickle) com os deltas de cada usuário.
+    # O snapshot é mapeado com mmap e guarda um bloco colunar por usuário e uma tabela no
+    # final, então abrir custa só a tabela e cada usuário é decodificado no primeiro acesso.
+    # Os deltas desde o último snapshot ficam também em memória (no máximo LIMITE_JOURNAL)
+    # para remontar quem for lido de novo.
+    def __init__(self, arquivo=ARQUIVO_CONTATOS, journal=ARQUIVO_JOURNAL):
+        self.arquivo = arquivo
+        self.journal = journal
+        self.seq = 0
+        self.registros = 0
+        self.compactacoes = 0
+        self.mapa = None
+        self.indice = IndiceSnapshot()
+        self.deltas = {}
+        # Deltas já entregues à compactação em andamento; valem até o snapshot novo entrar
+        self.compactando = None
+        # O gravador troca snapshot e compactando enquanto o event loop lê usuários
+        self.trava = threading.Lock()
+        self.gravador = GravadorPersistencia(self._gravar_lote)
+
+    def _ler_journal(self):
+        registros = []
+        if not os.path.exists(self.journal):
+            return registros
+        with open(self.journal, 'r+b') as f:
+            tamanho = os.fstat(f.fileno()).st_size
+            while True:
+                posicao = f.tell()
+                if posicao == tamanho:
+                    break
+                try:
+                    registros.append(LeitorPickle(f).load())
+                except (EOFError, pickle.UnpicklingError) as e:
+                    if f.tell() < tamanho:
+                        raise self._journal_corrompido(posicao, e) from e
+                    # Só o último registro, interrompido no fim do arquivo (queda no meio da
+                    # escrita), é descartado
+                    logger.warning(f"Journal truncado na posição {posicao}: {e}")
+                    f.truncate(posicao)
+                    break
+                except Exception as e:
+                    raise self._journal_corrompido(posicao, e) from e
+        return registros
+
+    def _journal_corrompido(self, posicao, erro):
+        # Um registro ruim no meio não é final incompleto: descartar dali em diante perderia os
+        # seguintes. O bot não inicia e o journal fica intacto.
+        logger.error(f"Journal corrompido na posição {posicao}: {erro}")
+        return JournalCorrompido(
+            f"{self.journal} está corrompido na posição {posicao} ({erro}). Nada foi descartado; "
+            f"restaure um backup dele ou corrija o registro antes de iniciar"
+        )
+
+    def _abrir_snapshot(self, caminho):
+        # Formato 4: MAGICO_SNAPSHOT, blocos dos usuários, tabela de usuários, rodapé, CRC da
+        # tabela com o rodapé e MAGICO_SNAPSHOT de novo (um arquivo truncado não termina nele)
+        with open(caminho, 'rb') as f:
+            if f.read(len(MAGICO_SNAPSHOT)) != MAGICO_SNAPSHOT:
+                return None
+            mapa = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            fim = len(mapa) - len(MAGICO_SNAPSHOT) - 4
+            rodape = fim - RODAPE_SNAPSHOT.size
+            if rodape < len(MAGICO_SNAPSHOT) or mapa[fim + 4:] != MAGICO_SNAPSHOT:
+                raise SnapshotCorrompido(f"{caminho} está truncado")
+            posicao, usuarios, seq = RODAPE_SNAPSHOT.unpack_from(mapa, rodape)
+            crc, = struct.unpack_from("<I", mapa, fim)
+            if posicao + usuarios * 24 != rodape or zlib.crc32(mapa[posicao:fim]) != crc:
+                raise SnapshotCorrompido(f"Tabela de usuários de {caminho} não confere com o CRC")
+            ids, posicao = ler_coluna("q", mapa, posicao, usuarios)
+            posicoes, posicao = ler_coluna("Q", mapa, posicao, usuarios)
+            tamanhos, posicao = ler_coluna("I", mapa, posicao, usuarios)
+            crcs, posicao = ler_coluna("I", mapa, posicao, usuarios)
+        except Exception:
+            mapa.close()
+            raise
+        self._fechar_snapshot()
+        self.mapa = mapa
+        self.indice = IndiceSnapshot(ids, posicoes, tamanhos, crcs)
+        return seq
+
+    def _fechar_snapshot(self):
+        if self.mapa is not None:
+            self.mapa.close()
+            self.mapa = None
+        self.indice = IndiceSnapshot()
+
+    def _ler_snapshot_antigo(self, caminho):
+        # Formatos anteriores, lidos inteiros só para converter: 3 (um pickle por usuário),
+        # 2 (dicionário com seq) e o dicionário de usuários gravado direto
+        with open(caminho, 'rb') as f:
+            if f.read(len(MAGICO_SNAPSHOT_3)) == MAGICO_SNAPSHOT_3:
+                # seek/read em vez de os.pread, que não existe no Windows
+                f.seek(-8, os.SEEK_END)
+                fim = f.tell()
+                posicao, = struct.unpack("<Q", f.read(8))
+                f.seek(posicao)
+                cabecalho = ler_pickle(f.read(fim - posicao))
+                usuarios = {}
+                for user_id, (inicio, tamanho_bloco) in cabecalho["indice"].items():
+                    f.seek(inicio)
+                    usuarios[user_id] = ler_pickle(f.read(tamanho_bloco))
+                return usuarios, cabecalho["seq"]
+            f.seek(0)
+            snapshot = LeitorPickle(f).load()
+        if snapshot.get("formato") == 2:
+            return snapshot["usuarios"], snapshot["seq"]
+        return snapshot, 0
+
+    def _escrever_snapshot(self, caminho, blocos, seq):
+        # blocos: (user_id, bytes, crc) gravados um a um, sem montar tudo em memória; crc None
+        # é calculado aqui. Blocos copiados do snapshot anterior mantêm o CRC original, para
+        # que um bloco estragado continue acusado em vez de ganhar um CRC novo e válido.
+        entradas = []
+        with open(caminho, 'wb') as f:
+            f.write(MAGICO_SNAPSHOT)
+            for user_id, dados, crc in blocos:
+                entradas.append((user_id, f.tell(), len(dados), zlib.crc32(dados) if crc is None else crc))
+                f.write(dados)
+            posicao = f.tell()
+            # Ordenada por user_id: a busca na tabela é binária, direto nos arrays
+            entradas.sort()
+            colunas = list(zip(*entradas)) or [(), (), (), ()]
+            tabela = b"".join(bytes_coluna(array(tipo, coluna)) for tipo, coluna in zip("qQII", colunas))
+            tabela += RODAPE_SNAPSHOT.pack(posicao, len(entradas), seq)
+            f.write(tabela)
+            f.write(struct.pack("<I", zlib.crc32(tabela)))
+            f.write(MAGICO_SNAPSHOT)
+
+    def _ler_bloco(self, user_id):
+        posicao, tamanho, crc = self.indice[user_id]
+        return self.mapa[posicao:posicao + tamanho], crc
+
+    def _proximo_temporario(self):
+        self.compactacoes += 1
+        return f"{self.arquivo}.{self.compactacoes}.tmp"
+
+    def carregar(self):
+        usuarios = None
+        seq_snapshot = 0
+        self._fechar_snapshot()
+        self.deltas = {}
+        try:
+            if os.path.exists(self.arquivo):
+                seq_snapshot = self._abrir_snapshot(self.arquivo)
+                if seq_snapshot is None:
+                    usuarios, seq_snapshot = self._ler_snapshot_antigo(self.arquivo)
+        except Exception as e:
+            # Seguir só com o journal serviria listas vazias e a próxima compactação as gravaria
+            # por cima dos contatos: o bot não inicia e snapshot e journal ficam intactos
+            self._fechar_snapshot()
+            logger.error(f"Erro ao carregar contatos: {e}")
+            raise SnapshotCorrompido(
+                f"{self.arquivo} está ilegível ({e}). Restaure um backup dele; o journal "
+                f"{self.journal} foi mantido e é reaplicado sobre o snapshot restaurado"
+            ) from e
+
+        self.seq = seq_snapshot
+        self.registros = 0
+        try:
+            for registro in self._ler_journal():
+                seq, user_id, op, dados = registro
+                self.registros += 1
+                if seq <= seq_snapshot:
+                    continue
+                if usuarios is not None:
+                    aplicar_alteracao(usuarios, user_id, op, dados)
+                else:
+                    registro = (seq, user_id, op, dados_para_journal(op, dados))
+                    self.deltas.setdefault(user_id, []).append(
+                        pickle.dumps(registro, protocol=pickle.HIGHEST_PROTOCOL)
+                    )
+                self.seq = seq
+        except JournalCorrompido:
+            self._fechar_snapshot()
+            raise
+        except Exception as e:
+            self._fechar_snapshot()
+            logger.error(f"Erro ao aplicar journal: {e}")
+            raise JournalCorrompido(
+                f"Registro {self.registros} de {self.journal} não pôde ser aplicado ({e}). "
+                f"Nada foi descartado; restaure um backup dele ou corrija o registro antes de iniciar"
+            ) from e
+
+        if usuarios is not None:
+            # Snapshot de formato antigo: converte uma vez para o formato colunar;
+            # daqui em diante nada mais é lido inteiro na inicialização
+            self.importar_usuarios(converter_usuarios(usuarios))
+            logger.info(f"Snapshot {self.arquivo} convertido para leitura por usuário")
+        # Ninguém é carregado de antemão: cada usuário vem do snapshot no primeiro acesso
+        return {}
+
+    def _remontar(self, user_id, listas_deltas):
+        # Bloco do snapshot atual mais os deltas, na ordem em que foram registrados
+        usuarios = {}
+        if user_id in self.indice:
+            dados, crc = self._ler_bloco(user_id)
+            if zlib.crc32(dados) != crc:
+                # Melhor não atender o usuário do que atendê-lo sem contatos e gravar por cima
+                logger.error(f"Bloco do usuário {user_id} em {self.arquivo} não confere com o CRC")
+                raise SnapshotCorrompido(f"Contatos do usuário {user_id} corrompidos no snapshot")
+            usuarios[user_id] = desempacotar_usuario(dados)
+        for deltas in listas_deltas:
+            for registro in deltas.get(user_id, ()):
+                _, _, op, dados = pickle.loads(registro)
+                aplicar_alteracao(usuarios, user_id, op, dados)
+        return converter_usuarios(usuarios).get(user_id)
+
+    def carregar_usuario(self, user_id):
+        with self.trava:
+            return self._remontar(user_id, (self.compactando or {}, self.deltas))
+
+    def descartar(self, user_id, usuario):
+        # Nada a soltar de propósito: os deltas do usuário são a única cópia em memória do que
+        # ainda não entrou no snapshot (o journal em disco só é lido na partida) e remontam o
+        # usuário no próximo acesso. Não crescem sem limite: a cada LIMITE_JOURNAL registros
+        # uma compactação os leva para o snapshot e os solta.
+        pass
+
+    def exportar_usuarios(self):
+        self.carregar()
+        return {user_id: self.carregar_usuario(user_id) for user_id in set(self.indice) | set(self.deltas)}
+
+    def importar_usuarios(self, usuarios):
+        # Substitui todo o conteúdo de uma vez, sem passar pelo gravador
+        self.seq = 0
+        self.registros = 0
+        self.deltas = {}
+        self.compactando = None
+        temporario = self._proximo_temporario()
+        self._escrever_snapshot(temporario, (
+            (user_id, empacotar_usuario(usuario), None) for user_id, usuario in usuarios.items()
+        ), 0)
+        self._gravar_snapshot(temporario)
+
+    def registrar(self, user_id, op, dados, usuarios):
+        # Grava apenas o delta do usuário; o custo acompanha o tamanho da alteração
+        self.seq += 1
+        registro = pickle.dumps(
+            (self.seq, user_id, op, dados_para_journal(op, dados)), protocol=pickle.HIGHEST_PROTOCOL
+        )
+        # Se a compactação falhar, o gravador devolve os deltas dela a self.deltas pela trava;
+        # sem ela, um registro acrescentado durante a troca ficaria no dicionário descartado
+        with self.trava:
+            self.deltas.setdefault(user_id, []).append(registro)
+        self.gravador.enfileirar("journal", registro)
+        self.registros += 1
+        if self.registros >= LIMITE_JOURNAL:
+            self.salvar(usuarios)
+
+    def salvar(self, usuarios):
+        # Compactação: escreve um novo snapshot e zera o journal. No event loop só os deltas
+        # desde o último snapshot mudam de lugar (para self.compactando); montar e gravar o
+        # arquivo fica com o gravador. Quem tem deltas é remontado do bloco antigo com eles,
+        # que é o mesmo estado que está em memória; os demais reaproveitam o bloco antigo.
+        if not self.deltas or self.compactando is not None:
+            # Nada mudou, ou já há uma compactação na fila: os deltas novos vão para a próxima
+            return
+        with self.trava:
+            self.compactando = self.deltas
+            self.deltas = {}
+        self.registros = 0
+        self.gravador.enfileirar("snapshot", self.seq)
+
+    def iniciar(self):
+        self.gravador.iniciar()
+
+    def parar(self):
+        self.gravador.parar()
+
+    def fechar(self):
+        # Solta o mapa do snapshot: no Windows outro processo não consegue substituí-lo
+        with self.trava:
+            self._fechar_snapshot()
+
+    def _gravar_lote(self, lote):
+        pendentes = []
+        for tipo, dados in lote:
+            if tipo == "journal":
+                pendentes.append(dados)
+            else:
+                # Registros anteriores ao snapshot vão antes; o snapshot já os inclui
+                self._gravar_journal(pendentes)
+                pendentes = []
+                self._compactar(dados)
+        self._gravar_journal(pendentes)
+
+    def _compactar(self, seq):
+        # Roda no gravador. Só este método troca o snapshot, então ler o atual aqui sem a
+        # trava é seguro; a trava só cobre a troca, que o event loop não pode ver pela metade.
+        deltas = self.compactando
+
+        def blocos():
+            for user_id in set(self.indice) | set(deltas):
+                if user_id in deltas:
+                    try:
+                        usuario = self._remontar(user_id, (deltas,))
+                    except SnapshotCorrompido:
+                        # Só este usuário fica de fora: o bloco segue como está (com o CRC
+                        # antigo, ainda acusando o defeito) e os deltas vão para um arquivo à parte
+                        self._guardar_deltas(user_id, deltas[user_id])
+                        yield (user_id, *self._ler_bloco(user_id))
+                        continue
+                    yield user_id, empacotar_usuario(usuario), None
+                else:
+                    yield (user_id, *self._ler_bloco(user_id))
+
+        temporario = self._proximo_temporario()
+        try:
+            self._escrever_snapshot(temporario, blocos(), seq)
+            self._gravar_snapshot(temporario)
+        except Exception as e:
+            # O journal não foi zerado. Os deltas voltam para a próxima compactação, antes dos
+            # mais novos; como registros já foi zerado, ela só vem depois de outras
+            # LIMITE_JOURNAL alterações, em vez de a cada alteração
+            logger.error(f"Erro ao compactar contatos: {e}")
+            with self.trava:
+                for user_id, registros in self.deltas.items():
+                    deltas.setdefault(user_id, []).extend(registros)
+                self.deltas = deltas
+                self.compactando = None
+        finally:
+            if os.path.exists(temporario):
+                os.remove(temporario)
+
+    def _guardar_deltas(self, user_id, registros):
+        # Mesmo formato do journal: dá para reaplicar depois de recuperar o bloco do usuário
+        destino = f"{self.arquivo}.usuario{user_id}.corrompido-{datetime.now():%Y%m%d%H%M%S}"
+        with open(destino, 'ab') as f:
+            f.write(b"".join(registros))
+        logger.error(f"Alterações do usuário {user_id}, cujo bloco está corrompido, guardadas em {destino}")
+
+    def _gravar_journal(self, registros):
+        if not registros:
+            return
+        try:
+            with open(self.journal, 'ab') as f:
+                f.write(b"".join(registros))
+        except Exception as e:
+            logger.error(f"Erro ao gravar journal: {e}")
+
+    def _gravar_snapshot(self, temporario):
+        descritor = os.open(temporario, os.O_RDONLY)
+        try:
+            os.fsync(descritor)
+        finally:
+            os.close(descritor)
+        with self.trava:
+            # No Windows um arquivo mapeado não pode ser substituído: o mapa sai antes da troca
+            self._fechar_snapshot()
+            try:
+                os.replace(temporario, self.arquivo)
+            except Exception:
+                self._abrir_snapshot(self.arquivo)
+                raise
+            if os.name != 'nt':
+                # A troca só é definitiva quando o diretório chega ao disco; antes disso
+                # o journal não pode ser zerado
+                descritor = os.open(os.path.dirname(os.path.abspath(self.arquivo)), os.O_RDONLY)
+                try:
+                    os.fsync(descritor)
+                finally:
+                    os.close(descritor)
+            self._abrir_snapshot(self.arquivo)
+            self.compactando = None
+        open(self.journal, 'wb').close()
+
+class ArmazenamentoSQLite:
+    # Backend com uma linha por contato e uma linha de sessão por usuário.
+    # Os usuários são lidos sob demanda; as escritas vão em transações pelo gravador.
+    ESQUEMA = """
+        CREATE TABLE IF NOT EXISTS contatos (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            nome TEXT NOT NULL,
+            categoria TEXT,
+            numero TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_contatos_usuario ON contatos (user_id);
+        CREATE INDEX IF NOT EXISTS idx_contatos_nome ON contatos (user_id, nome COLLATE NOCASE);
+        CREATE INDEX IF NOT EXISTS idx_contatos_numero ON contatos (user_id, numero);
+        CREATE TABLE IF NOT EXISTS sessoes (
+            user_id INTEGER PRIMARY KEY,
+            dados BLOB NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS metadados (
+            chave TEXT PRIMARY KEY,
+            valor TEXT NOT NULL
+        );
+    """
+
+    def __init__(self, caminho=ARQUIVO_SQLITE, arquivo_pickle=ARQUIVO_CONTATOS, journal_pickle=ARQUIVO_JOURNAL):
+        self.caminho = caminho
+        self.arquivo_pickle = arquivo_pickle
+        self.journal_pickle = journal_pickle
+        import sqlite3
+        # A ordem de inserção é a ordem do id; edições mantêm o id e portanto a posição
+        self.conexao = sqlite3.connect(caminho, check_same_thread=False)
+        self.conexao.execute("PRAGMA journal_mode=WAL")
+        self.conexao.execute("PRAGMA synchronous=NORMAL")
+        self.conexao.executescript(self.ESQUEMA)
+        self._migrar_categoria()
+        self.leitura = sqlite3.connect(caminho, check_same_thread=False)
+        self.gravador = GravadorPersistencia(self._gravar_lote)
+        # Marca do gravador na última alteração de cada usuário
+        self.ultima_escrita = {}
+        # Usuários tirados da memória com alterações ainda na fila do gravador: até elas
+        # chegarem ao banco, voltar a ler do banco traria dados velhos
+        self.saindo = {}
+        self._migrar_pickle()
+
+    def _migrar_categoria(self):
+        # Bancos antigos guardavam "Nome - Categoria" inteiro na coluna nome
+        colunas = [linha[1] for linha in self.conexao.execute("PRAGMA table_info(contatos)")]
+        if "categoria" in colunas:
+            return
+        with self.conexao:
+            self.conexao.execute("ALTER TABLE contatos ADD COLUMN categoria TEXT")
+            self.conexao.execute(
+                "UPDATE contatos SET categoria = substr(nome, instr(nome, ' - ') + 3), "
+                "nome = substr(nome, 1, instr(nome, ' - ') - 1) WHERE instr(nome, ' - ') > 0"
+            )
+
+    def _migrar_pickle(self):
+        # Migração única do contatos_salvos.pkl (snapshot + journal) para o banco
+        if self.conexao.execute("SELECT 1 FROM metadados WHERE chave = 'migrado_pickle'").fetchone():
+            return
+        usuarios = {}
+        if os.path.exists(self.arquivo_pickle) or os.path.exists(self.journal_pickle):
+            usuarios = ArmazenamentoPickle(self.arquivo_pickle, self.journal_pickle).exportar_usuarios()
+        with self.conexao:
+            for user_id, usuario in usuarios.items():
+                self._gravar_usuario(user_id, usuario)
+            self.conexao.execute(
+                "INSERT INTO metadados (chave, valor) VALUES ('migrado_pickle', ?)",
+                (datetime.now().isoformat(),)
+            )
+        if usuarios:
+            logger.info(f"Migrados {len(usuarios)} usuários de {self.arquivo_pickle} para {self.caminho}")
+
+    def _gravar_usuario(self, user_id, usuario):
+        self.conexao.execute("DELETE FROM contatos WHERE user_id = ?", (user_id,))
+        self.conexao.executemany(
+            "INSERT INTO contatos (user_id, nome, categoria, numero) VALUES (?, ?, ?, ?)",
+            ((user_id, c.nome, c.categoria, c.numero) for c in usuario.get("contatos", []))
+        )
+        estado = {k: v for k, v in usuario.items() if k != "contatos"}
+        self.conexao.execute(
+            "INSERT OR REPLACE INTO sessoes (user_id, dados) VALUES (?, ?)",
+            (user_id, pickle.dumps(estado, protocol=pickle.HIGHEST_PROTOCOL))
+        )
+
+    def carregar(self):
+        # Nada é carregado de antemão: cada usuário vem do banco no primeiro acesso
+        return {}
+
+    def carregar_usuario(self, user_id):
+        if user_id in self.saindo:
+            marca, usuario = self.saindo.pop(user_id)
+            self.ultima_escrita[user_id] = marca
+            return usuario
+        # fetchall encerra o cursor: um cursor pela metade mantém a leitura presa a um retrato antigo do WAL
+        linhas = self.leitura.execute("SELECT dados FROM sessoes WHERE user_id = ?", (user_id,)).fetchall()
+        linha = linhas[0] if linhas else None
+        contatos = [
+            Contato(nome, categoria, numero) for nome, categoria, numero in self.leitura.execute(
+                "SELECT nome, categoria, numero FROM contatos WHERE user_id = ? ORDER BY id", (user_id,)
+            )
+        ]
+        if linha is None and not contatos:
+            return None
+        usuario = pickle.loads(linha[0]) if linha else {}
+        usuario["contatos"] = contatos
+        return usuario
+
+    def exportar_usuarios(self):
+        ids = self.leitura.execute("SELECT user_id FROM contatos UNION SELECT user_id FROM sessoes").fetchall()
+        return {user_id: self.carregar_usuario(user_id) for (user_id,) in ids}
+
+    def importar_usuarios(self, usuarios):
+        with self.conexao:
+            self.conexao.execute("DELETE FROM contatos")
+            self.conexao.execute("DELETE FROM sessoes")
+            for user_id, usuario in usuarios.items():
+                self._gravar_usuario(user_id, usuario)
+
+    def registrar(self, user_id, op, dados, usuarios):
+        if op == "estado":
+            # Serializa já, para não gravar mudanças feitas depois na sessão
+            dados = pickle.dumps(dados, protocol=pickle.HIGHEST_PROTOCOL)
+        self.gravador.enfileirar("op", (user_id, op, dados))
+        self.ultima_escrita[user_id] = self.gravador.enfileirados
+
+    def descartar(self, user_id, usuario):
+        gravados = self.gravador.gravados
+        for antigo in [u for u, (marca, _) in self.saindo.items() if marca <= gravados]:
+            del self.saindo[antigo]
+        marca = self.ultima_escrita.pop(user_id, 0)
+        if marca > gravados:
+            self.saindo[user_id] = (marca, usuario)
+
+    def salvar(self, usuarios):
+        # Contatos e preferências já são gravados a cada alteração: resta um checkpoint do WAL
+        self.gravador.enfileirar("checkpoint", None)
+
+    def iniciar(self):
+        self.gravador.iniciar()
+
+    def parar(self):
+        self.gravador.parar()
+
+    def fechar(self):
+        self.conexao.close()
+        self.leitura.close()
+
+    def _ids_usuario(self, user_id):
+        return [linha[0] for linha in self.conexao.execute(
+            "SELECT id FROM contatos WHERE user_id = ? ORDER BY id", (user_id,)
+        )]
+
+    def _gravar_lote(self, lote):
+        # Um lote inteiro vira uma única transação
+        with self.conexao:
+            for tipo, dados in lote:
+                if tipo == "checkpoint":
+                    continue
+                user_id, op, valor = dados
+                if op == "adicionar":
+                    self.conexao.executemany(
+                        "INSERT INTO contatos (user_id, nome, categoria, numero) VALUES (?, ?, ?, ?)",
+                        ((user_id, c.nome, c.categoria, c.numero) for c in map(como_contato, valor))
+                    )
+                elif op == "editar":
+                    idx, contato = valor
+                    contato = como_contato(contato)
+                    self.conexao.execute(
+                        "UPDATE contatos SET nome = ?, categoria = ?, numero = ? WHERE id = "
+                        "(SELECT id FROM contatos WHERE user_id = ? ORDER BY id LIMIT 1 OFFSET ?)",
+                        (contato.nome, contato.categoria, contato.numero, user_id, idx)
+                    )
+                elif op == "remover":
+                    ids = self._ids_usuario(user_id)
+                    self.conexao.executemany(
+                        "DELETE FROM contatos WHERE id = ?",
+                        ((ids[idx],) for idx in valor if idx < len(ids))
+                    )
+                elif op == "limpar":
+                    self.conexao.execute("DELETE FROM contatos WHERE user_id = ?", (user_id,))
+                elif op == "reiniciar":
+                    self.conexao.execute("DELETE FROM contatos WHERE user_id = ?", (user_id,))
+                    self.conexao.execute("DELETE FROM sessoes WHERE user_id = ?", (user_id,))
+                elif op == "estado":
+                    self.conexao.execute(
+                        "INSERT OR REPLACE INTO sessoes (user_id, dados) VALUES (?, ?)",
+                        (user_id, valor)
+                    )
+        if any(tipo == "checkpoint" for tipo, _ in lote):
+            self.conexao.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+def arquivo_do_shard(arquivo, shard):
+    # contatos_salvos.pkl -> contatos_salvos.shard2.pkl
+    if shard is None:
+        return arquivo
+    base, extensao = os.path.splitext(arquivo)
+    return f"{base}.shard{shard}{extensao}"
+
+def criar_armazenamento(backend=BACKEND_ARMAZENAMENTO, shard=None):
+    arquivo = arquivo_do_shard(ARQUIVO_CONTATOS, shard)
+    journal = arquivo_do_shard(ARQUIVO_JOURNAL, shard)
+    if backend == "sqlite":
+        return ArmazenamentoSQLite(arquivo_do_shard(ARQUIVO_SQLITE, shard), arquivo, journal)
+    return ArmazenamentoPickle(arquivo, journal)
 
 def carregar_token():
     try:
@@ -76,33 +1024,648 @@ def remover_token():
         logger.error(f"Erro ao remover token: {e}")
         return False
 
-contatos_por_usuario = carregar_contatos()
+armazenamento = criar_armazenamento()
+
+def carregar_contatos():
+    return armazenamento.carregar()
+
+def salvar_contatos():
+    inicio = time.perf_counter()
+    try:
+        armazenamento.salvar(contatos_por_usuario)
+    except Exception as e:
+        logger.error(f"Erro ao salvar contatos: {e}")
+    if metricas.ativo:
+        metricas.observar("savecnt_salvar_contatos_segundos", time.perf_counter() - inicio)
+
+def registrar_alteracao(user_id, op, dados):
+    try:
+        armazenamento.registrar(user_id, op, dados, contatos_por_usuario)
+    except Exception as e:
+        logger.error(f"Erro ao gravar alteração: {e}")
+
+# Campos duráveis do usuário; o estado da conversa fica em sessoes_usuarios
+CAMPOS_USUARIO = ("contatos", "ordenacao")
+
+# Usuários em memória, do acessado há mais tempo para o mais recente. Cada um é lido
+# do armazenamento no primeiro acesso; os ociosos saem quando o orçamento estoura.
+contatos_por_usuario = OrderedDict(carregar_contatos())
+# Soma dos contatos de quem está em contatos_por_usuario, mantida a cada carga, alteração
+# e descarte: o orçamento de memória é conferido sem percorrer todos os usuários
+contatos_em_memoria = sum(len(u["contatos"]) for u in contatos_por_usuario.values())
+
+def obter_usuario(user_id):
+    global contatos_em_memoria
+    usuario = contatos_por_usuario.get(user_id)
+    if usuario is None:
+        usuario = armazenamento.carregar_usuario(user_id) or {"contatos": []}
+        # Dados gravados antes das sessões separadas ainda trazem o estado da conversa junto
+        for chave in [k for k in usuario if k not in CAMPOS_USUARIO]:
+            del usuario[chave]
+        contatos_por_usuario[user_id] = usuario
+        contatos_em_memoria += len(usuario["contatos"])
+        descartar_ociosos(manter=user_id)
+    else:
+        contatos_por_usuario.move_to_end(user_id)
+    return usuario
+
+def dobrar_texto(texto):
+    # Minúsculas e sem acentos: "João" e "joao" viram a mesma coisa na busca
+    decomposto = unicodedata.normalize('NFKD', texto.casefold())
+    return "".join(c for c in decomposto if not unicodedata.combining(c))
+
+def trigramas(texto):
+    return {texto[i:i + 3] for i in range(len(texto) - 2)}
+
+def distancia_edicao(a, b, maximo):
+    # Damerau-Levenshtein restrita: inserir, apagar, trocar ou inverter duas letras vizinhas
+    # custa 1. Para assim que passa do máximo, devolvendo maximo + 1.
+    if abs(len(a) - len(b)) > maximo:
+        return maximo + 1
+    penultima = None
+    anterior = list(range(len(b) + 1))
+    for i, letra_a in enumerate(a, 1):
+        atual = [i] + [0] * len(b)
+        for j, letra_b in enumerate(b, 1):
+            atual[j] = min(anterior[j] + 1, atual[j - 1] + 1, anterior[j - 1] + (letra_a != letra_b))
+            if i > 1 and j > 1 and letra_a == b[j - 2] and a[i - 2] == letra_b:
+                atual[j] = min(atual[j], penultima[j - 2] + 1)
+        if min(atual) > maximo:
+            return maximo + 1
+        penultima, anterior = anterior, atual
+    return anterior[-1]
+
+# Coeficiente de Dice mínimo entre os trigramas da busca e os do trecho do nome com o mesmo
+# número de palavras (ambos com espaço nas pontas, como no índice)
+LIMIAR_BUSCA_APROXIMADA = 0.5
+# Erros de digitação aceitos mesmo abaixo do limiar: em palavras curtas uma letra invertida
+# ("mraia") quebra quase todos os trigramas
+def erros_tolerados(consulta):
+    return 1 if len(consulta) < 10 else 2
+
+class IndiceBusca:
+    # Índice invertido de trigramas sobre os nomes sem acento, por serial de contato.
+    # Acha substring, prefixo e nomes parecidos (erros de digitação) sem varrer a lista toda.
+    def __init__(self):
+        self.postagens = {}
+        self.textos = {}
+        self.contatos = {}
+
+    def adicionar(self, serial, contato):
+        texto = dobrar_texto(contato.nome_linha)
+        self.textos[serial] = texto
+        self.contatos[serial] = contato
+        # Espaços nas pontas marcam início e fim de palavra
+        for trigrama in trigramas(f" {texto} "):
+            self.postagens.setdefault(trigrama, set()).add(serial)
+
+    def remover(self, serial):
+        self.remover_varios((serial,))
+
+    def remover_varios(self, seriais):
+        # Junta os seriais por trigrama: cada postagem perde todos os do lote numa só operação
+        por_trigrama = {}
+        for serial in seriais:
+            texto = self.textos.pop(serial, None)
+            self.contatos.pop(serial, None)
+            if texto is None:
+                continue
+            for trigrama in trigramas(f" {texto} "):
+                por_trigrama.setdefault(trigrama, []).append(serial)
+        for trigrama, removidos in por_trigrama.items():
+            postagem = self.postagens.get(trigrama)
+            if postagem is not None:
+                postagem.difference_update(removidos)
+                if not postagem:
+                    del self.postagens[trigrama]
+
+    def buscar(self, consulta, limite):
+        consulta = " ".join(dobrar_texto(consulta).split())
+        if not consulta:
+            return []
+        trigramas_consulta = trigramas(consulta)
+        postagens = sorted((self.postagens.get(t, set()) for t in trigramas_consulta), key=len)
+        if not postagens:
+            # Buscas com menos de 3 letras: não há trigrama, sobra a comparação direta
+            candidatos = self.textos.keys()
+        elif postagens[0]:
+            # Quem contém a busca como substring tem todos os trigramas dela
+            candidatos = set.intersection(*postagens)
+        else:
+            candidatos = ()
+        resultados = {}
+        for serial in candidatos:
+            texto = self.textos[serial]
+            if texto == consulta:
+                resultados[serial] = 5
+            elif texto.startswith(consulta):
+                resultados[serial] = 4
+            elif f" {consulta}" in f" {texto}":
+                resultados[serial] = 3
+            elif consulta in texto:
+                resultados[serial] = 2
+        if len(resultados) < limite and postagens:
+            # Poucos resultados exatos: completa com nomes parecidos (erros de digitação, letras trocadas)
+            self._aproximados(consulta, resultados)
+        melhores = heapq.nsmallest(limite, ((-nota, serial) for serial, nota in resultados.items()))
+        return [serial for _, serial in melhores]
+
+    def _aproximados(self, consulta, resultados):
+        # Notas abaixo de 1, depois de qualquer resultado exato
+        trigramas_consulta = trigramas(f" {consulta} ")
+        contagem = Counter()
+        for trigrama in trigramas_consulta:
+            contagem.update(self.postagens.get(trigrama, ()))
+        # Cada erro de digitação derruba no máximo 4 trigramas; abaixo disso nem o Dice
+        # nem a distância de edição aceitariam o nome
+        tolerancia = erros_tolerados(consulta)
+        comuns_minimos = max(1, len(trigramas_consulta) - 4 * tolerancia)
+        minimo = max(1, min(comuns_minimos, math.ceil(LIMIAR_BUSCA_APROXIMADA * len(trigramas_consulta) / 2)))
+        palavras_consulta = len(consulta.split())
+        # Nomes e sobrenomes se repetem muito numa agenda: cada trecho é avaliado uma vez
+        notas = {}
+        for serial, quantidade in contagem.items():
+            if quantidade < minimo or serial in resultados:
+                continue
+            palavras = self.textos[serial].split()
+            nota = 0
+            for i in range(max(1, len(palavras) - palavras_consulta + 1)):
+                trecho = " ".join(palavras[i:i + palavras_consulta])
+                if trecho not in notas:
+                    notas[trecho] = self._nota_aproximada(consulta, trigramas_consulta, trecho, tolerancia, comuns_minimos)
+                nota = max(nota, notas[trecho])
+            if nota:
+                resultados[serial] = min(nota, 0.99)
+
+    def _nota_aproximada(self, consulta, trigramas_consulta, trecho, tolerancia, comuns_minimos):
+        trigramas_trecho = trigramas(f" {trecho} ")
+        comuns = len(trigramas_consulta & trigramas_trecho)
+        dice = 2 * comuns / (len(trigramas_consulta) + len(trigramas_trecho))
+        if dice >= LIMIAR_BUSCA_APROXIMADA:
+            return dice
+        if len(consulta) > 3 and comuns >= comuns_minimos:
+            erros = distancia_edicao(consulta, trecho, tolerancia)
+            if erros <= tolerancia:
+                return 1 - erros / len(consulta)
+        return 0
+
+class IndiceContatos:
+    # Estruturas derivadas da lista de um usuário, mantidas a cada alteração:
+    # - chaves: (nome em minúsculas, número normalizado) -> ocorrências, para duplicados em O(1)
+    # - ordenados: (nome em minúsculas, serial, contato) em ordem, para a listagem ABCD
+    # - categorias: categoria -> quantidade, para as estatísticas do /listar
+    # O serial acompanha cada posição da lista e desempata nomes iguais pela ordem de inserção.
+    # O índice de busca por nome é montado só quando o usuário busca pela primeira vez.
+    def __init__(self, contatos):
+        self.chaves = {}
+        self.ordenados = []
+        self.categorias = {}
+        self.seriais = []
+        self.proximo_serial = 0
+        self.busca = None
+        # Identifica esta instância; seriais de botões gerados antes de um rebuild não valem mais
+        self.geracao = time.time_ns()
+        self.adicionar(contatos)
+
+    @staticmethod
+    def chave(nome, numero):
+        return (nome.lower(), numero)
+
+    def _contar(self, contato, delta):
+        chave = self.chave(contato.nome_linha, contato.numero)
+        restantes = self.chaves.get(chave, 0) + delta
+        if restantes > 0:
+            self.chaves[chave] = restantes
+        else:
+            self.chaves.pop(chave, None)
+        categoria = contato.categoria_exibicao
+        restantes = self.categorias.get(categoria, 0) + delta
+        if restantes > 0:
+            self.categorias[categoria] = restantes
+        else:
+            self.categorias.pop(categoria, None)
+
+    def adicionar(self, contatos):
+        contatos = list(contatos)
+        novos = []
+        for contato in contatos:
+            self._contar(contato, 1)
+            novos.append((contato.nome_linha.lower(), self.proximo_serial, contato))
+            self.seriais.append(self.proximo_serial)
+            if self.busca is not None:
+                self.busca.adicionar(self.proximo_serial, contato)
+            self.proximo_serial += 1
+        if len(novos) > len(self.ordenados) // 8:
+            # Lote grande: reordenar tudo de uma vez sai mais barato que inserir um a um
+            self.ordenados.extend(novos)
+            self.ordenados.sort()
+        else:
+            for entrada in novos:
+                bisect.insort(self.ordenados, entrada)
+
+    def editar(self, idx, antigo, novo):
+        serial = self.seriais[idx]
+        self._contar(antigo, -1)
+        self._contar(novo, 1)
+        del self.ordenados[bisect.bisect_left(self.ordenados, (antigo.nome_linha.lower(), serial))]
+        bisect.insort(self.ordenados, (novo.nome_linha.lower(), serial, novo))
+        if self.busca is not None:
+            self.busca.remover(serial)
+            self.busca.adicionar(serial, novo)
+
+    def remover(self, indices, contatos):
+        indices = set(indices)
+        removidos = set()
+        for idx in indices:
+            self._contar(contatos[idx], -1)
+            removidos.add(self.seriais[idx])
+        self.seriais = [serial for i, serial in enumerate(self.seriais) if i not in indices]
+        self.ordenados = [entrada for entrada in self.ordenados if entrada[1] not in removidos]
+        if self.busca is not None:
+            self.busca.remover_varios(removidos)
+
+    def contem(self, nome, numero):
+        return self.chave(nome, numero) in self.chaves
+
+    def pagina_ordenada(self, inicio, fim):
+        return [contato for _, _, contato in self.ordenados[inicio:fim]]
+
+    def obter_busca(self):
+        if self.busca is None:
+            self.busca = IndiceBusca()
+            for _, serial, contato in self.ordenados:
+                self.busca.adicionar(serial, contato)
+        return self.busca
+
+    def buscar(self, consulta, limite):
+        return self.obter_busca().buscar(consulta, limite)
+
+    def contato(self, serial):
+        return self.obter_busca().contatos.get(serial)
+
+    def posicao(self, serial):
+        # Seriais crescem na ordem da lista e remoções preservam a ordem: busca binária
+        i = bisect.bisect_left(self.seriais, serial)
+        return i if i < len(self.seriais) and self.seriais[i] == serial else None
+
+    def posicoes(self, seriais):
+        # Seriais que não existem mais ficam de fora
+        resultado = {}
+        for serial in seriais:
+            i = self.posicao(serial)
+            if i is not None:
+                resultado[serial] = i
+        return resultado
+
+# Estruturas derivadas, nunca persistidas: são reconstruídas sob demanda
+indices_por_usuario = {}
+
+def obter_indice(user_id):
+    indice = indices_por_usuario.get(user_id)
+    if indice is None:
+        indice = IndiceContatos(obter_usuario(user_id)["contatos"])
+        indices_por_usuario[user_id] = indice
+    return indice
+
+def atualizar_indice(user_id, op, dados):
+    # Chamada antes de aplicar a alteração, enquanto os contatos antigos ainda existem
+    indice = indices_por_usuario.get(user_id)
+    if indice is None:
+        return
+    contatos = obter_usuario(user_id)["contatos"]
+    if op == "adicionar":
+        indice.adicionar(como_contato(c) for c in dados)
+    elif op == "editar":
+        idx, contato = dados
+        indice.editar(idx, contatos[idx], como_contato(contato))
+    elif op == "remover":
+        indice.remover(dados, contatos)
+    elif op in ("limpar", "reiniciar"):
+        indices_por_usuario.pop(user_id, None)
+
+# Versão do conteúdo da lista de cada usuário; muda a cada alteração nos contatos
+versoes_por_usuario = {}
+
+def versao_usuario(user_id):
+    return versoes_por_usuario.get(user_id, 0)
+
+def alterar_contatos(user_id, op, dados=None):
+    global contatos_em_memoria
+    antes = len(obter_usuario(user_id)["contatos"])
+    atualizar_indice(user_id, op, dados)
+    aplicar_alteracao(contatos_por_usuario, user_id, op, dados)
+    # "reiniciar" troca a lista: o tamanho novo é lido do dicionário
+    contatos_em_memoria += len(contatos_por_usuario[user_id]["contatos"]) - antes
+    registrar_alteracao(user_id, op, dados)
+    if op != "estado":
+        versoes_por_usuario[user_id] = versao_usuario(user_id) + 1
+        cache_exportacoes.invalidar(user_id)
+
+def adicionar_contatos(user_id, novos):
+    alterar_contatos(user_id, "adicionar", list(novos))
+
+def editar_contato(user_id, idx, contato):
+    alterar_contatos(user_id, "editar", (idx, contato))
+
+def remover_contatos(user_id, indices):
+    alterar_contatos(user_id, "remover", sorted(indices))
+
+def remover_lote(user_id, pares):
+    # Remove de uma vez todos os contatos que casam com algum (nome, número) do lote: uma
+    # passada pela lista contra um conjunto de chaves e uma única alteração "remover".
+    # Devolve os contatos removidos, na ordem da lista, e os pares do lote que não existiam.
+    procurados = {IndiceContatos.chave(nome, numero): (nome, numero) for nome, numero in pares}
+    indice = obter_indice(user_id)
+    # O índice já diz quais chaves existem: a lista só é percorrida se alguma delas existir
+    if not any(indice.contem(nome, numero) for nome, numero in procurados.values()):
+        return [], list(procurados.values())
+    contatos = obter_usuario(user_id)["contatos"]
+    posicoes = []
+    encontrados = set()
+    for i, contato in enumerate(contatos):
+        chave = IndiceContatos.chave(contato.nome_linha, contato.numero)
+        if chave in procurados:
+            posicoes.append(i)
+            encontrados.add(chave)
+    removidos = [contatos[i] for i in posicoes]
+    remover_contatos(user_id, posicoes)
+    return removidos, [par for chave, par in procurados.items() if chave not in encontrados]
+
+def limpar_contatos(user_id):
+    alterar_contatos(user_id, "limpar")
+
+def reiniciar_usuario(user_id):
+    alterar_contatos(user_id, "reiniciar")
+    sessoes_usuarios.descartar(user_id)
+
+def salvar_estado(user_id):
+    # Persiste as preferências do usuário (tudo menos a lista de contatos), como a ordenação
+    estado = {k: v for k, v in obter_usuario(user_id).items() if k != "contatos"}
+    alterar_contatos(user_id, "estado", estado)
+
+def descartar_ociosos(manter=None):
+    # Tira da memória os usuários acessados há mais tempo até voltar ao orçamento.
+    # Quem tem update em andamento (trava ativa) fica: o handler ainda usa o dicionário dele.
+    for user_id in list(contatos_por_usuario):
+        if len(contatos_por_usuario) <= LIMITE_USUARIOS_MEMORIA and contatos_em_memoria <= LIMITE_CONTATOS_MEMORIA:
+            break
+        if user_id == manter or user_id in travas_usuarios.travas:
+            continue
+        descartar_usuario(user_id)
+
+def descartar_usuario(user_id):
+    global contatos_em_memoria
+    usuario = contatos_por_usuario.pop(user_id)
+    contatos_em_memoria -= len(usuario["contatos"])
+    # Contatos e preferências já estão no armazenamento; a sessão fica em sessoes_usuarios
+    armazenamento.descartar(user_id, usuario)
+    indices_por_usuario.pop(user_id, None)
+    versoes_por_usuario.pop(user_id, None)
+    cache_exportacoes.invalidar(user_id)
+
+# Tempo que a sessão de um usuário (edição, busca, lote de remoção...) sobrevive sem uso
+TTL_SESSAO = int(os.environ.get("SAVECNT_SESSAO_MINUTOS", "30")) * 60
+# Sessões em memória; acima disso as usadas há mais tempo são descartadas
+LIMITE_SESSOES = int(os.environ.get("SAVECNT_SESSOES", "10000"))
+# Onde as sessões vivas ficam entre um reinício e outro ("" desliga)
+ARQUIVO_SESSOES = os.environ.get("SAVECNT_ARQUIVO_SESSOES", "sessoes.pkl")
+
+class SessoesUsuarios:
+    # Estado de conversa (modos de edição e remoção, buscas, lotes, duplicados, ids de
+    # mensagens) separado dos contatos: nunca passa pelo journal nem pelo snapshot, expira
+    # depois de TTL_SESSAO sem uso e tem tamanho limitado. Ordenadas do acesso mais antigo
+    # ao mais recente; como o TTL é o mesmo para todas, as expiradas estão sempre no começo.
+    def __init__(self, ttl=TTL_SESSAO, limite=LIMITE_SESSOES, arquivo=ARQUIVO_SESSOES):
+        self.ttl = ttl
+        self.limite = limite
+        self.arquivo = arquivo
+        # user_id -> [expira_em (monotonic), sessão]
+        self.sessoes = OrderedDict()
+
+    def obter(self, user_id):
+        agora = time.monotonic()
+        self._expirar(agora)
+        entrada = self.sessoes.get(user_id)
+        if entrada is None:
+            entrada = self.sessoes[user_id] = [0, {}]
+            self._limitar(manter=user_id)
+        else:
+            self.sessoes.move_to_end(user_id)
+        entrada[0] = agora + self.ttl
+        return entrada[1]
+
+    def descartar(self, user_id):
+        self.sessoes.pop(user_id, None)
+
+    def _expirar(self, agora):
+        while self.sessoes:
+            user_id, (expira_em, _) = next(iter(self.sessoes.items()))
+            if expira_em > agora:
+                break
+            del self.sessoes[user_id]
+
+    def _limitar(self, manter):
+        # Quem tem update em andamento (trava ativa) fica: o handler ainda usa a sessão
+        excesso = len(self.sessoes) - self.limite
+        if excesso <= 0:
+            return
+        descartadas = []
+        for user_id in self.sessoes:
+            if len(descartadas) >= excesso:
+                break
+            if user_id != manter and user_id not in travas_usuarios.travas:
+                descartadas.append(user_id)
+        for user_id in descartadas:
+            del self.sessoes[user_id]
+
+    def carregar(self):
+        self.sessoes.clear()
+        if not self.arquivo or not os.path.exists(self.arquivo):
+            return
+        try:
+            with open(self.arquivo, 'rb') as f:
+                salvo = pickle.load(f)
+            # O tempo restante de cada sessão conta também o tempo em que o bot ficou parado
+            decorrido = time.time() - salvo["salvo_em"]
+            agora = time.monotonic()
+            for user_id, restante, sessao in salvo["sessoes"]:
+                if restante > decorrido:
+                    self.sessoes[user_id] = [agora + min(restante - decorrido, self.ttl), sessao]
+        except Exception as e:
+            # Sessões são descartáveis: na pior das hipóteses o usuário recomeça o fluxo
+            logger.error(f"Erro ao carregar sessões: {e}")
+
+    def salvar(self):
+        if not self.arquivo:
+            return
+        agora = time.monotonic()
+        self._expirar(agora)
+        temporario = self.arquivo + '.tmp'
+        try:
+            with open(temporario, 'wb') as f:
+                pickle.dump({
+                    "salvo_em": time.time(),
+                    "sessoes": [(user_id, expira_em - agora, sessao)
+                                for user_id, (expira_em, sessao) in self.sessoes.items() if sessao],
+                }, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temporario, self.arquivo)
+        except Exception as e:
+            logger.error(f"Erro ao salvar sessões: {e}")
+
+sessoes_usuarios = SessoesUsuarios()
+sessoes_usuarios.carregar()
+
+def obter_sessao(user_id):
+    return sessoes_usuarios.obter(user_id)
+
+NAO_DIGITO = re.compile(r'[^\d]')
+# Mesma limpeza, mas preservando as quebras de linha que separam os números de um bloco
+NAO_DIGITO_NEM_QUEBRA = re.compile(r'[^\d\n]')
+# Quantos números inválidos aparecem listados no aviso de uma mensagem
+LIMITE_INVALIDOS_EXIBIDOS = 20
+# Quantos contatos do lote de remoção aparecem listados nas mensagens
+LIMITE_LOTE_EXIBIDOS = 20
 
 def limpar_numero(numero):
-    numero_limpo = re.sub(r'[^\d]', '', numero)
+    numero_limpo = NAO_DIGITO.sub('', numero)
     if numero_limpo.startswith('55'):
         numero_limpo = numero_limpo[2:]
     return numero_limpo
 
-def validar_numero_brasileiro(numero):
-    numero_limpo = limpar_numero(numero)
-    if len(numero_limpo) not in [10, 11]:
-        return False
-    return True
+def normalizar_numeros(numeros):
+    # Limpa todos os números de uma mensagem numa única passada do regex sobre o bloco
+    # inteiro, em vez de uma chamada por número
+    if not numeros:
+        return []
+    limpos = NAO_DIGITO_NEM_QUEBRA.sub('', '\n'.join(numeros)).split('\n')
+    return [n[2:] if n.startswith('55') else n for n in limpos]
+
+def validar_numero_brasileiro(numero_limpo):
+    # Recebe o número já limpo (limpar_numero/normalizar_numeros); não limpa de novo
+    return len(numero_limpo) in (10, 11)
+
+def relatorio_recusados(titulo, recusados, rotulo):
+    # Um único aviso com todas as entradas recusadas da mensagem (ou do arquivo importado)
+    linhas = [titulo]
+    linhas += [f"• {rotulo} {linha}: {valor[:30]}" for linha, valor in recusados[:LIMITE_INVALIDOS_EXIBIDOS]]
+    if len(recusados) > LIMITE_INVALIDOS_EXIBIDOS:
+        linhas.append(f"… e mais {len(recusados) - LIMITE_INVALIDOS_EXIBIDOS} inválido(s).")
+    return "\n".join(linhas)
+
+def relatorio_invalidos(invalidos, rotulo="linha"):
+    titulo = f"❌ {len(invalidos)} número(s) inválido(s). Devem ter 10 ou 11 dígitos (DDD + número):"
+    return relatorio_recusados(titulo, invalidos, rotulo)
+
+def relatorio_sem_nome(sem_nome, rotulo="contato"):
+    # O número aparece para o usuário achar a linha; ele pode estar certo, o que falta é o nome
+    return relatorio_recusados(f"❌ {len(sem_nome)} contato(s) sem nome, não importado(s):", sem_nome, rotulo)
 
 def contato_existe(user_id, nome, numero):
-    return any((c[0].lower() == nome.lower() and c[1] == numero) for c in contatos_por_usuario.get(user_id, {}).get("contatos", []))
+    return obter_indice(user_id).contem(nome, numero)
+
+# Limite de bytes por linha do vCard antes de dobrar (RFC 2425), igual ao vobject
+TAMANHO_LINHA_VCARD = 75
+# Tamanho dos blocos já codificados que vão para o buffer de saída na exportação
+TAMANHO_BLOCO_EXPORTACAO = 64 * 1024
+
+def escapar_vcard(texto):
+    texto = texto.replace("\\", "\\\\").replace(";", "\\;").replace(",", "\\,")
+    return texto.replace("\r\n", "\\n").replace("\n", "\\n").replace("\r", "\\n")
+
+def linha_vcard(linha):
+    # Mesma regra do vobject: linhas com menos de 75 caracteres saem inteiras,
+    # as demais são dobradas a cada 75 bytes sem quebrar caracteres UTF-8
+    if len(linha) < TAMANHO_LINHA_VCARD:
+        return linha.encode('utf-8') + b"\r\n"
+    partes = []
+    atual = []
+    tamanho = 0
+    for caractere in linha:
+        codificado = caractere.encode('utf-8')
+        if tamanho + len(codificado) > TAMANHO_LINHA_VCARD:
+            partes.append(b"".join(atual))
+            atual = [b" "]
+            tamanho = 1
+        atual.append(codificado)
+        tamanho += len(codificado)
+    partes.append(b"".join(atual))
+    return b"\r\n".join(partes) + b"\r\n"
+
+def preparar_registros(contatos):
+    # Formata o número uma única vez para todos os formatos
+    return [(c.nome, c.categoria_exibicao, "+55" + c.numero) for c in contatos]
+
+def escrever_vcf(registros, destino):
+    # Gera o vCard 3.0 direto em bytes, sem montar objetos do vobject nem concatenar strings
+    bloco = []
+    tamanho_bloco = 0
+    for nome, categoria, numero_formatado in registros:
+        nome_split = nome.split(' ', 1)
+        sobrenome = nome_split[1] if len(nome_split) > 1 else ''
+
+        cartao = b"".join((
+            b"BEGIN:VCARD\r\nVERSION:3.0\r\n",
+            linha_vcard("FN:" + escapar_vcard(f"{nome} - {categoria}")),
+            linha_vcard("N:" + escapar_vcard(sobrenome) + ";" + escapar_vcard(nome_split[0]) + ";;;"),
+            linha_vcard("NOTE:" + escapar_vcard(f"Categoria: {categoria}")),
+            linha_vcard("TEL;TYPE=CELL:" + numero_formatado),
+            b"END:VCARD\r\n",
+        ))
+        bloco.append(cartao)
+        tamanho_bloco += len(cartao)
+        if tamanho_bloco >= TAMANHO_BLOCO_EXPORTACAO:
+            destino.write(b"".join(bloco))
+            bloco = []
+            tamanho_bloco = 0
+    if bloco:
+        destino.write(b"".join(bloco))
+
+def escrever_csv(registros, destino):
+    destino.write("Nome,Número,Categoria\n".encode('utf-8'))
+    for inicio in range(0, len(registros), 1000):
+        linhas = [
+            f'"{nome}","{numero_formatado}","{categoria}"\n'
+            for nome, categoria, numero_formatado in registros[inicio:inicio + 1000]
+        ]
+        destino.write("".join(linhas).encode('utf-8'))
+
+def escrever_json(registros, destino):
+    contatos_lista = [
+        {"nome": nome, "numero": numero_formatado, "categoria": categoria}
+        for nome, categoria, numero_formatado in registros
+    ]
+    destino.write(json.dumps(contatos_lista, ensure_ascii=False, indent=2).encode('utf-8'))
+
+ESCRITORES_EXPORTACAO = {
+    "vcf": escrever_vcf,
+    "csv": escrever_csv,
+    "json": escrever_json,
+}
+
+def gerar_arquivo(formato, registros):
+    # Criar arquivo em memória
+    inicio = time.perf_counter()
+    arquivo = BytesIO()
+    ESCRITORES_EXPORTACAO[formato](registros, arquivo)
+    if metricas.ativo:
+        metricas.observar("savecnt_exportacao_segundos", time.perf_counter() - inicio, formato=formato)
+        metricas.contar("savecnt_exportacao_bytes_total", arquivo.tell(), formato=formato)
+    arquivo.seek(0)
+    arquivo.name = f"contatos.{formato}"
+    return arquivo
 
 def salvar_vcf(contatos):
-    vcf_texto = ""
+    return gerar_arquivo("vcf", preparar_registros(contatos))
+
+def salvar_vcf_vobject(contatos):
+    # Implementação de referência com o vobject, usada para validar o escritor rápido
+    # (importado só aqui: o bot em si não precisa dele)
+    import vobject
+    partes = []
     for c in contatos:
-        nome_linha = c[0]
-        numero = c[1]
-        if ' - ' in nome_linha:
-            nome, categoria = nome_linha.split(' - ', 1)
-        else:
-            nome = nome_linha
-            categoria = "Sem categoria"
+        nome = c.nome
+        numero = c.numero
+        categoria = c.categoria_exibicao
         contato_completo = f"{nome} - {categoria}"
         numero_formatado = "+55" + numero
 
@@ -118,57 +1681,742 @@ def salvar_vcf(contatos):
         tel.type_param = ['CELL']
         tel.value = numero_formatado
         card.add('note').value = f"Categoria: {categoria}"
-        vcf_texto += card.serialize()
+        partes.append(card.serialize())
 
     # Criar arquivo em memória
-    vcf_file = BytesIO(vcf_texto.encode('utf-8'))
+    vcf_file = BytesIO("".join(partes).encode('utf-8'))
     vcf_file.name = "contatos.vcf"
     return vcf_file
 
 def salvar_csv(contatos):
-    csv_texto = "Nome,Número,Categoria\n"
-    for c in contatos:
-        nome_linha = c[0]
-        numero = c[1]
-        if ' - ' in nome_linha:
-            nome, categoria = nome_linha.split(' - ', 1)
-        else:
-            nome = nome_linha
-            categoria = "Sem categoria"
-        csv_texto += f'"{nome}","+55{numero}","{categoria}"\n'
-
-    # Criar arquivo em memória
-    csv_file = BytesIO(csv_texto.encode('utf-8'))
-    csv_file.name = "contatos.csv"
-    return csv_file
+    return gerar_arquivo("csv", preparar_registros(contatos))
 
 def salvar_json(contatos):
-    contatos_lista = []
-    for c in contatos:
-        nome_linha = c[0]
-        numero = c[1]
-        if ' - ' in nome_linha:
-            nome, categoria = nome_linha.split(' - ', 1)
-        else:
-            nome = nome_linha
-            categoria = "Sem categoria"
-        contatos_lista.append({
-            "nome": nome,
-            "numero": f"+55{numero}",
-            "categoria": categoria
-        })
+    return gerar_arquivo("json", preparar_registros(contatos))
+
+# Pool para gerar os formatos em paralelo, fora do event loop
+executor_exportacao = ThreadPoolExecutor(max_workers=len(ESCRITORES_EXPORTACAO), thread_name_prefix="exportacao")
+
+async def gerar_exportacoes(contatos, formatos):
+    loop = asyncio.get_running_loop()
+    # Cópia rasa feita no loop: os escritores não enxergam alterações feitas durante a geração
+    registros = await loop.run_in_executor(executor_exportacao, preparar_registros, list(contatos))
+    arquivos = await asyncio.gather(*(
+        loop.run_in_executor(executor_exportacao, gerar_arquivo, formato, registros)
+        for formato in formatos
+    ))
+    return dict(zip(formatos, arquivos))
+
+# Memória máxima ocupada pelos arquivos exportados guardados em cache
+LIMITE_CACHE_EXPORTACAO = int(os.environ.get("SAVECNT_CACHE_EXPORTACAO_MB", "64")) * 1024 * 1024
+# Quantidade máxima de file_ids do Telegram lembrados para reenvio sem upload
+LIMITE_FILE_IDS = 10000
+
+class CacheExportacoes:
+    # LRU dos bytes exportados, por (user_id, formato, versão), limitado pelo tamanho total.
+    # Guarda também o file_id devolvido pelo Telegram para reenviar sem novo upload.
+    def __init__(self, limite_bytes=LIMITE_CACHE_EXPORTACAO, limite_file_ids=LIMITE_FILE_IDS):
+        self.limite_bytes = limite_bytes
+        self.limite_file_ids = limite_file_ids
+        self.arquivos = OrderedDict()
+        self.file_ids = OrderedDict()
+        self.tamanho = 0
+
+    def obter(self, chave):
+        dados = self.arquivos.get(chave)
+        if dados is not None:
+            self.arquivos.move_to_end(chave)
+        return dados
+
+    def guardar(self, chave, dados):
+        if len(dados) > self.limite_bytes:
+            return
+        self._descartar(chave)
+        self.arquivos[chave] = dados
+        self.tamanho += len(dados)
+        while self.tamanho > self.limite_bytes:
+            _, antigo = self.arquivos.popitem(last=False)
+            self.tamanho -= len(antigo)
+
+    def obter_file_id(self, chave):
+        file_id = self.file_ids.get(chave)
+        if file_id is not None:
+            self.file_ids.move_to_end(chave)
+        return file_id
+
+    def guardar_file_id(self, chave, file_id):
+        self.file_ids[chave] = file_id
+        self.file_ids.move_to_end(chave)
+        while len(self.file_ids) > self.limite_file_ids:
+            self.file_ids.popitem(last=False)
+
+    def invalidar(self, user_id):
+        # Versões antigas nunca mais serão pedidas; libera a memória na hora
+        for chave in [c for c in self.arquivos if c[0] == user_id]:
+            self._descartar(chave)
+        for chave in [c for c in self.file_ids if c[0] == user_id]:
+            del self.file_ids[chave]
+
+    def _descartar(self, chave):
+        antigo = self.arquivos.pop(chave, None)
+        if antigo is not None:
+            self.tamanho -= len(antigo)
+
+cache_exportacoes = CacheExportacoes()
+
+# Formatos dentro do .zip, na ordem em que entram nele
+FORMATOS_ZIP = ("vcf", "csv", "json")
+
+def arquivo_em_memoria(formato, dados):
+    arquivo = BytesIO(dados)
+    arquivo.name = f"contatos.{formato}"
+    return arquivo
+
+async def obter_arquivos(user_id, formatos):
+    # Devolve os arquivos pedidos, gerando só os que não estão no cache para a versão atual
+    versao = versao_usuario(user_id)
+    dados = {f: cache_exportacoes.obter((user_id, f, versao)) for f in formatos}
+    montar_zip = "zip" in dados and dados["zip"] is None
+    if montar_zip:
+        # O zip é montado com os três formatos: os que já estão no cache não são gerados de novo
+        for formato in FORMATOS_ZIP:
+            if formato not in dados:
+                dados[formato] = cache_exportacoes.obter((user_id, formato, versao))
+    faltando = [f for f, arquivo in dados.items() if arquivo is None and f != "zip"]
+    if faltando:
+        gerados = await gerar_exportacoes(obter_usuario(user_id)["contatos"], faltando)
+        for formato, arquivo in gerados.items():
+            dados[formato] = arquivo.getvalue()
+            cache_exportacoes.guardar((user_id, formato, versao), dados[formato])
+    if montar_zip:
+        dados["zip"] = empacotar_zip({f: arquivo_em_memoria(f, dados[f]) for f in FORMATOS_ZIP}).getvalue()
+        cache_exportacoes.guardar((user_id, "zip", versao), dados["zip"])
+    return {formato: arquivo_em_memoria(formato, dados[formato]) for formato in formatos}
+
+LEGENDAS_EXPORTACAO = {
+    "vcf": "📇 Aqui estão seus contatos no formato VCF!",
+    "csv": "📊 Aqui estão seus contatos no formato CSV!",
+    "json": "📝 Aqui estão seus contatos no formato JSON!",
+    "zip": "📦 Todos os formatos em um único .ZIP",
+}
+
+async def enviar_exportacao(message, user_id, formato):
+    # Lista inalterada desde o último envio: reaproveita o arquivo que já está no Telegram
+    chave = (user_id, formato, versao_usuario(user_id))
+    file_id = cache_exportacoes.obter_file_id(chave)
+    if file_id:
+        await message.reply_document(document=file_id, caption=LEGENDAS_EXPORTACAO[formato])
+        return
+    arquivo = (await obter_arquivos(user_id, [formato]))[formato]
+    enviada = await message.reply_document(
+        document=InputFile(arquivo, filename=arquivo.name),
+        caption=LEGENDAS_EXPORTACAO[formato]
+    )
+    if enviada.document:
+        cache_exportacoes.guardar_file_id(chave, enviada.document.file_id)
+
+async def enviar_todos_formatos(message, user_id):
+    legendas = {
+        "vcf": "📇 Contatos em formato VCF",
+        "csv": "📊 Contatos em formato CSV",
+        "json": "📝 Contatos em formato JSON",
+    }
+    versao = versao_usuario(user_id)
+    file_ids = {f: cache_exportacoes.obter_file_id((user_id, f, versao)) for f in legendas}
+    faltando = [f for f, file_id in file_ids.items() if not file_id]
+    arquivos = await obter_arquivos(user_id, faltando) if faltando else {}
+    enviadas = await message.reply_media_group(media=[
+        InputMediaDocument(file_ids[f] or arquivos[f], filename=f"contatos.{f}", caption=legenda)
+        for f, legenda in legendas.items()
+    ])
+    for formato, enviada in zip(legendas, enviadas):
+        if enviada.document:
+            cache_exportacoes.guardar_file_id((user_id, formato, versao), enviada.document.file_id)
+
+def empacotar_zip(arquivos):
+    inicio = time.perf_counter()
+    zip_file = BytesIO()
+    with zipfile.ZipFile(zip_file, 'w', compression=zipfile.ZIP_DEFLATED) as pacote:
+        for arquivo in arquivos.values():
+            pacote.writestr(arquivo.name, arquivo.getvalue())
+    if metricas.ativo:
+        metricas.observar("savecnt_exportacao_segundos", time.perf_counter() - inicio, formato="zip")
+        metricas.contar("savecnt_exportacao_bytes_total", zip_file.tell(), formato="zip")
+    zip_file.seek(0)
+    zip_file.name = "contatos.zip"
+    return zip_file
+
+# ------------------- IMPORTAÇÃO DE ARQUIVOS -------------------
+
+# Maior arquivo que a Bot API deixa um bot baixar
+LIMITE_ARQUIVO_IMPORTACAO = 20 * 1024 * 1024
+# Contatos lidos, normalizados e gravados por vez; cada lote vira uma única alteração
+TAMANHO_LOTE_IMPORTACAO = 5000
+# Tamanho dos pedaços lidos do JSON por vez
+TAMANHO_BLOCO_IMPORTACAO = 64 * 1024
+# Intervalo mínimo entre edições da mensagem de progresso (o Telegram limita edições)
+INTERVALO_PROGRESSO = 1.5
+
+# Nomes de coluna (CSV) e de chave (JSON) aceitos para cada campo
+CAMPOS_IMPORTACAO = {
+    "nome": "nome", "name": "nome",
+    "numero": "numero", "número": "numero", "telefone": "numero", "celular": "numero",
+    "phone": "numero", "tel": "numero",
+    "categoria": "categoria", "category": "categoria", "grupo": "categoria",
+}
+
+ESCAPE_VCARD = re.compile(r'\\(.)')
+# Separa os componentes de N: ignorando "\;" escapado
+SEPARADOR_N_VCARD = re.compile(r'(?<!\\);')
+
+def campo_importacao(chave):
+    return CAMPOS_IMPORTACAO.get(str(chave).strip().lower())
+
+def categoria_importada(categoria):
+    # "Sem categoria" é como a exportação escreve quem não tem categoria: volta a ser None
+    categoria = str(categoria or "").strip()
+    if not categoria or categoria == SEM_CATEGORIA:
+        return None
+    return categoria
+
+def desescapar_vcard(texto):
+    return ESCAPE_VCARD.sub(lambda m: "\n" if m.group(1) in "nN" else m.group(1), texto)
+
+def linhas_desdobradas(texto):
+    # Junta as linhas dobradas do vCard (continuação começa com espaço ou tab) e as
+    # quebras suaves do quoted-printable do vCard 2.1 (linha terminada em "=")
+    atual = None
+    for linha in texto:
+        linha = linha.rstrip("\r\n")
+        if atual is not None:
+            if linha[:1] in (" ", "\t"):
+                atual += linha[1:]
+                continue
+            if atual.endswith("=") and "QUOTED-PRINTABLE" in atual.split(":", 1)[0].upper():
+                atual = atual[:-1] + linha
+                continue
+            yield atual
+        atual = linha
+    if atual is not None:
+        yield atual
+
+def ler_vcf(texto):
+    # Um cartão por vez: só o nome (FN, ou N se faltar) e o primeiro TEL interessam
+    nome = nome_n = numero = None
+    for linha in linhas_desdobradas(texto):
+        propriedade, _, valor = linha.partition(":")
+        parametros = propriedade.upper().split(";")
+        # "item1.TEL" (Apple) vira "TEL"
+        tipo = parametros[0].rsplit(".", 1)[-1]
+        if "ENCODING=QUOTED-PRINTABLE" in parametros or "QUOTED-PRINTABLE" in parametros:
+            charset = next((p[8:] for p in parametros if p.startswith("CHARSET=")), "UTF-8")
+            valor = quopri.decodestring(valor.encode("utf-8")).decode(charset, "replace")
+        if tipo == "BEGIN":
+            nome = nome_n = numero = None
+        elif tipo == "FN":
+            nome = desescapar_vcard(valor).strip()
+        elif tipo == "N":
+            partes = [desescapar_vcard(p) for p in SEPARADOR_N_VCARD.split(valor)] + ["", ""]
+            nome_n = f"{partes[1]} {partes[0]}".strip()
+        elif tipo == "TEL" and numero is None:
+            numero = valor
+        elif tipo == "END":
+            nome_linha = nome or nome_n or ""
+            if " - " in nome_linha:
+                nome_contato, categoria = nome_linha.split(" - ", 1)
+            else:
+                nome_contato, categoria = nome_linha, None
+            yield nome_contato, categoria, numero or ""
 
-    # Criar arquivo em memória
-    json_data = json.dumps(contatos_lista, ensure_ascii=False, indent=2)
-    json_file = BytesIO(json_data.encode('utf-8'))
-    json_file.name = "contatos.json"
-    return json_file
+def ler_csv(texto):
+    primeira = texto.readline()
+    if not primeira:
+        return
+    # Planilhas em português costumam sair com ";" no lugar da vírgula
+    separador = ";" if primeira.count(";") > primeira.count(",") else ","
+    leitor = csv.reader(itertools.chain([primeira], texto), delimiter=separador)
+    cabecalho = next(leitor)
+    colunas = [campo_importacao(c) for c in cabecalho]
+    if "nome" in colunas and "numero" in colunas:
+        posicoes = {campo: colunas.index(campo) for campo in ("nome", "numero", "categoria") if campo in colunas}
+    else:
+        # Sem cabeçalho reconhecível: nome, número e categoria, nessa ordem, desde a primeira linha
+        posicoes = {"nome": 0, "numero": 1, "categoria": 2}
+        leitor = itertools.chain([cabecalho], leitor)
+    for linha in leitor:
+        valores = {campo: linha[i] if i < len(linha) else "" for campo, i in posicoes.items()}
+        yield valores.get("nome", ""), valores.get("categoria"), valores.get("numero", "")
+
+def campos_json(objeto):
+    campos = {campo_importacao(chave): valor for chave, valor in objeto.items()}
+    return str(campos.get("nome") or ""), campos.get("categoria"), str(campos.get("numero") or "")
+
+def ler_json(texto):
+    # Decodifica um objeto por vez de um buffer que anda pelo arquivo, em vez de json.load
+    # no arquivo inteiro. Aceita o array gerado pela exportação e também JSON Lines.
+    decodificador = json.JSONDecoder()
+    buffer = ""
+    posicao = 0
+    while True:
+        while posicao < len(buffer) and buffer[posicao] in " \t\r\n[],":
+            posicao += 1
+        if posicao == len(buffer):
+            buffer = texto.read(TAMANHO_BLOCO_IMPORTACAO)
+            posicao = 0
+            if not buffer:
+                return
+            continue
+        try:
+            objeto, posicao = decodificador.raw_decode(buffer, posicao)
+        except json.JSONDecodeError:
+            # Objeto cortado no fim do buffer: lê mais um pedaço e tenta de novo
+            bloco = texto.read(TAMANHO_BLOCO_IMPORTACAO)
+            if not bloco:
+                raise
+            buffer = buffer[posicao:] + bloco
+            posicao = 0
+            continue
+        if isinstance(objeto, dict) and "nome" not in {campo_importacao(c) for c in objeto}:
+            # Objeto que embrulha a lista, como {"contatos": [...]}
+            objeto = next((v for v in objeto.values() if isinstance(v, list)), [])
+        for item in objeto if isinstance(objeto, list) else [objeto]:
+            if isinstance(item, dict):
+                yield campos_json(item)
+
+LEITORES_IMPORTACAO = {
+    "vcf": ler_vcf,
+    "csv": ler_csv,
+    "json": ler_json,
+}
+
+TIPOS_IMPORTACAO = {
+    "text/vcard": "vcf", "text/x-vcard": "vcf", "text/directory": "vcf",
+    "text/csv": "csv", "text/comma-separated-values": "csv",
+    "application/json": "json",
+}
+
+def formato_importacao(documento):
+    extensao = os.path.splitext(documento.file_name or "")[1].lower().lstrip(".")
+    if extensao == "vcard":
+        extensao = "vcf"
+    if extensao in LEITORES_IMPORTACAO:
+        return extensao
+    return TIPOS_IMPORTACAO.get((documento.mime_type or "").lower())
+
+def proximo_lote(registros):
+    return list(itertools.islice(registros, TAMANHO_LOTE_IMPORTACAO))
+
+# ------------------- MÉTRICAS -------------------
+
+# Limites superiores (em segundos) das faixas dos histogramas, como os buckets do Prometheus
+FAIXAS_LATENCIA = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histograma:
+    __slots__ = ("contagens", "soma", "total", "maximo")
+
+    def __init__(self):
+        # Uma contagem por faixa e a última para o que passou de todas (+Inf)
+        self.contagens = [0] * (len(FAIXAS_LATENCIA) + 1)
+        self.soma = 0.0
+        self.total = 0
+        self.maximo = 0.0
+
+    def observar(self, valor):
+        self.contagens[bisect.bisect_left(FAIXAS_LATENCIA, valor)] += 1
+        self.soma += valor
+        self.total += 1
+        self.maximo = max(self.maximo, valor)
+
+    def percentil(self, fracao):
+        # Interpola dentro da faixa em que o percentil cai, como o histogram_quantile
+        alvo = fracao * self.total
+        acumulado = 0
+        piso = 0.0
+        for i, quantidade in enumerate(self.contagens):
+            teto = FAIXAS_LATENCIA[i] if i < len(FAIXAS_LATENCIA) else self.maximo
+            if quantidade and acumulado + quantidade >= alvo:
+                # Com poucas amostras a interpolação passaria do maior valor visto
+                return min(self.maximo, piso + (teto - piso) * (alvo - acumulado) / quantidade)
+            acumulado += quantidade
+            piso = teto
+        return 0.0
+
+def rotulos_prometheus(rotulos, extra=()):
+    pares = [f'{nome}="{valor}"' for nome, valor in rotulos + tuple(extra)]
+    return "{" + ",".join(pares) + "}" if pares else ""
+
+class Metricas:
+    # Contadores e histogramas do processo, por nome e rótulos. Desligadas (padrão), os
+    # handlers nem são embrulhados e os demais pontos custam só o teste de self.ativo.
+    # Os exportadores e o gravador rodam em outras threads: tudo passa pela trava.
+    def __init__(self):
+        self.ativo = False
+        self.inicio = time.time()
+        self.trava = threading.Lock()
+        self.contadores = {}
+        self.histogramas = {}
+        self.limitador = None
+
+    def contar(self, nome, valor=1, **rotulos):
+        chave = (nome, tuple(sorted(rotulos.items())))
+        with self.trava:
+            self.contadores[chave] = self.contadores.get(chave, 0) + valor
+
+    def observar(self, nome, valor, **rotulos):
+        chave = (nome, tuple(sorted(rotulos.items())))
+        with self.trava:
+            histograma = self.histogramas.get(chave)
+            if histograma is None:
+                histograma = self.histogramas[chave] = Histograma()
+            histograma.observar(valor)
+
+    def medidores(self):
+        # Valores do momento, calculados só quando alguém pede as métricas
+        valores = {
+            "savecnt_usuarios_em_memoria": len(contatos_por_usuario),
+            "savecnt_contatos_em_memoria": contatos_em_memoria,
+            "savecnt_sessoes_em_memoria": len(sessoes_usuarios.sessoes),
+        }
+        gravador = getattr(armazenamento, "gravador", None)
+        if gravador is not None:
+            valores["savecnt_persistencia_pendentes"] = gravador.enfileirados - gravador.gravados
+        if self.limitador is not None:
+            for nome, valor in self.limitador.resumo_metricas().items():
+                valores[f"savecnt_envios_{nome}"] = valor
+        return valores
+
+    def texto_prometheus(self):
+        with self.trava:
+            contadores = sorted(self.contadores.items())
+            histogramas = sorted(
+                (chave, (list(h.contagens), h.soma, h.total)) for chave, h in self.histogramas.items()
+            )
+        linhas = []
+        tipos = set()
+        for (nome, rotulos), valor in contadores:
+            if nome not in tipos:
+                tipos.add(nome)
+                linhas.append(f"# TYPE {nome} counter")
+            linhas.append(f"{nome}{rotulos_prometheus(rotulos)} {valor}")
+        for (nome, rotulos), (contagens, soma, total) in histogramas:
+            if nome not in tipos:
+                tipos.add(nome)
+                linhas.append(f"# TYPE {nome} histogram")
+            acumulado = 0
+            for limite, quantidade in zip(FAIXAS_LATENCIA + ("+Inf",), contagens):
+                acumulado += quantidade
+                linhas.append(f"{nome}_bucket{rotulos_prometheus(rotulos, [('le', limite)])} {acumulado}")
+            linhas.append(f"{nome}_sum{rotulos_prometheus(rotulos)} {soma}")
+            linhas.append(f"{nome}_count{rotulos_prometheus(rotulos)} {total}")
+        for nome, valor in self.medidores().items():
+            linhas.append(f"# TYPE {nome} gauge")
+            linhas.append(f"{nome} {valor}")
+        return "\n".join(linhas) + "\n"
+
+    def resumo(self):
+        ativo_ha = timedelta(seconds=int(time.time() - self.inicio))
+        linhas = [f"📈 Métricas do processo {os.getpid()} (há {ativo_ha})"]
+        with self.trava:
+            histogramas = sorted(self.histogramas.items())
+            contadores = sorted(self.contadores.items())
+        nome_atual = None
+        for (nome, rotulos), h in histogramas:
+            if nome != nome_atual:
+                nome_atual = nome
+                linhas.append(f"\n⏱ {nome}")
+            descricao = ", ".join(f"{v}" for _, v in rotulos) or "total"
+            linhas.append(
+                f"• {descricao}: {h.total}x · p50 {h.percentil(0.5) * 1000:.1f} ms"
+                f" · p99 {h.percentil(0.99) * 1000:.1f} ms · máx {h.maximo * 1000:.1f} ms"
+            )
+        if contadores:
+            linhas.append("\n🔢 Contadores")
+            for (nome, rotulos), valor in contadores:
+                descricao = ", ".join(f"{v}" for _, v in rotulos)
+                linhas.append(f"• {nome}{f' ({descricao})' if descricao else ''}: {valor}")
+        linhas.append("\n📊 Agora")
+        for nome, valor in self.medidores().items():
+            linhas.append(f"• {nome.removeprefix('savecnt_')}: {valor}")
+        return "\n".join(linhas)
+
+metricas = Metricas()
+
+def instrumentar(nome, handler, rotulo=None):
+    # Mede cada execução do handler; rotulo(update), quando dado, separa os tipos de update
+    @functools.wraps(handler)
+    async def executar(update, context):
+        tipo = nome if rotulo is None else rotulo(update)
+        inicio = time.perf_counter()
+        try:
+            return await handler(update, context)
+        except Exception:
+            metricas.contar("savecnt_handler_erros_total", handler=tipo)
+            raise
+        finally:
+            metricas.observar("savecnt_handler_segundos", time.perf_counter() - inicio, handler=tipo)
+    return executar
+
+def tipo_callback(update):
+    # "pagina:3" e "pagina:4" são o mesmo tipo de botão: o rótulo é o prefixo
+    dados = update.callback_query.data if update.callback_query else None
+    return "callback:" + (dados or "").split(":", 1)[0]
+
+def iniciar_servidor_metricas(host, porta):
+    # http.server só é carregado quando as métricas são expostas
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class RespostaMetricas(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?", 1)[0] != "/metrics":
+                self.send_error(404)
+                return
+            corpo = metricas.texto_prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(corpo)))
+            self.end_headers()
+            self.wfile.write(corpo)
+
+        def log_message(self, formato, *args):
+            # Cada coleta do Prometheus escreveria uma linha no stderr
+            pass
+
+    # Thread própria: responde mesmo com o event loop ocupado e em qualquer modo (polling/webhook)
+    servidor = ThreadingHTTPServer((host, porta), RespostaMetricas)
+    servidor.daemon_threads = True
+    threading.Thread(target=servidor.serve_forever, name="metricas", daemon=True).start()
+    logger.info(f"Métricas em http://{host}:{porta}/metrics")
+    return servidor
+
+# ------------------- ENVIO PARA O TELEGRAM -------------------
+
+# Limites de envio do Telegram: ~30 mensagens/s no total, ~1/s por chat privado
+# (com pequenas rajadas) e 20/min por grupo
+LIMITE_ENVIOS_GLOBAL = 30
+LIMITE_ENVIOS_CHAT = 1.0
+RAJADA_ENVIOS_CHAT = 3
+LIMITE_ENVIOS_GRUPO = 20 / 60
+# Tentativas de cada chamada antes de desistir (429 e falhas de rede)
+TENTATIVAS_ENVIO = 5
+# Tamanho máximo de uma mensagem de texto do Telegram
+LIMITE_TEXTO_TELEGRAM = 4096
+# Parâmetros de sendMessage que não impedem juntar textos seguidos no mesmo chat
+PARAMETROS_JUNTAVEIS = {"chat_id", "text", "parse_mode", "disable_notification", "link_preview_options"}
+
+class BaldeFichas:
+    # Token bucket por reserva: cada chamada tira uma ficha na hora, mesmo que o saldo fique
+    # negativo, e espera o tempo até a ficha dela existir. Assim a ordem de chegada é a
+    # ordem de envio, sem travas nem tarefas extras.
+    def __init__(self, taxa, capacidade):
+        self.taxa = taxa
+        self.capacidade = capacidade
+        self.fichas = capacidade
+        self.atualizado = time.monotonic()
+
+    def reservar(self):
+        agora = time.monotonic()
+        self.fichas = min(self.capacidade, self.fichas + (agora - self.atualizado) * self.taxa)
+        self.atualizado = agora
+        self.fichas -= 1
+        return 0 if self.fichas >= 0 else -self.fichas / self.taxa
+
+    def pausar(self, segundos):
+        # Depois de um 429: nenhuma ficha nova até o fim do prazo pedido pelo Telegram
+        self.fichas = min(self.fichas, 0) - segundos * self.taxa
+
+    def cheio(self):
+        return self.fichas + (time.monotonic() - self.atualizado) * self.taxa >= self.capacidade
+
+class Juncao:
+    # sendMessage esperando a vez no chat: textos curtos que chegam enquanto isso vão junto
+    def __init__(self, data):
+        self.textos = [data["text"]]
+        self.outros = {k: v for k, v in data.items() if k != "text"}
+        self.tamanho = len(data["text"])
+        self.resultado = asyncio.get_running_loop().create_future()
+
+    def aceita(self, data):
+        outros = {k: v for k, v in data.items() if k != "text"}
+        return outros == self.outros and self.tamanho + 2 + len(data["text"]) <= LIMITE_TEXTO_TELEGRAM
+
+    def juntar(self, data):
+        self.textos.append(data["text"])
+        self.tamanho += 2 + len(data["text"])
+
+class LimitadorEnvios(BaseRateLimiter):
+    # Toda chamada do bot à Bot API passa por aqui (ApplicationBuilder.rate_limiter).
+    # Chamadas com chat_id esperam a vez no balde do chat e depois no global; textos
+    # simples que se acumulam na espera de um mesmo chat saem numa só mensagem; 429 e
+    # falhas de rede são repetidos com espera. rate_limit_args={"juntar": False} numa
+    # chamada impede a junção (ex.: mensagem que ainda vai ser editada).
+    def __init__(self, por_segundo=LIMITE_ENVIOS_GLOBAL, tentativas=TENTATIVAS_ENVIO):
+        self.global_ = BaldeFichas(por_segundo, por_segundo)
+        self.chats = {}
+        self.juncoes = {}
+        self.tentativas = tentativas
+        self.metricas = {
+            "na_fila": 0,
+            "na_fila_max": 0,
+            "enviadas": 0,
+            "juntadas": 0,
+            "repetidas": 0,
+            "erros_429": 0,
+            "espera_total_s": 0.0,
+            "espera_max_s": 0.0,
+        }
+
+    async def initialize(self):
+        self.ativo = True
+
+    async def shutdown(self):
+        # O PTB pode encerrar o limitador mais de uma vez (bot e aplicação)
+        if getattr(self, "ativo", False):
+            self.ativo = False
+            logger.info(f"Envios ao Telegram: {self.resumo_metricas()}")
+
+    def resumo_metricas(self):
+        resumo = dict(self.metricas)
+        chamadas = resumo["enviadas"] + resumo["juntadas"]
+        resumo["espera_media_s"] = round(resumo["espera_total_s"] / chamadas, 4) if chamadas else 0.0
+        return resumo
+
+    def _balde_chat(self, chat_id):
+        balde = self.chats.get(chat_id)
+        if balde is None:
+            if len(self.chats) > 10000:
+                # Esquece os chats parados, cujo balde já voltou a ficar cheio
+                self.chats = {c: b for c, b in self.chats.items() if not b.cheio()}
+            if isinstance(chat_id, int) and chat_id < 0:
+                balde = BaldeFichas(LIMITE_ENVIOS_GRUPO, RAJADA_ENVIOS_CHAT)
+            else:
+                balde = BaldeFichas(LIMITE_ENVIOS_CHAT, RAJADA_ENVIOS_CHAT)
+            self.chats[chat_id] = balde
+        return balde
+
+    async def _aguardar(self, espera):
+        if espera <= 0:
+            return 0
+        self.metricas["na_fila"] += 1
+        self.metricas["na_fila_max"] = max(self.metricas["na_fila_max"], self.metricas["na_fila"])
+        try:
+            await asyncio.sleep(espera)
+        finally:
+            self.metricas["na_fila"] -= 1
+        return espera
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id")
+        juntavel = (
+            endpoint == "sendMessage" and chat_id is not None
+            and isinstance(data.get("text"), str) and set(data) <= PARAMETROS_JUNTAVEIS
+            and (rate_limit_args or {}).get("juntar", True)
+        )
+        if juntavel:
+            juncao = self.juncoes.get(chat_id)
+            if juncao is not None and juncao.aceita(data):
+                # Já há um texto esperando a vez neste chat: vai junto com ele
+                juncao.juntar(data)
+                self.metricas["juntadas"] += 1
+                return await asyncio.shield(juncao.resultado)
+            juncao = self.juncoes[chat_id] = Juncao(data)
+
+        inicio = time.monotonic()
+        if chat_id is not None:
+            await self._aguardar(self._balde_chat(chat_id).reservar())
+        if juntavel:
+            if self.juncoes.get(chat_id) is juncao:
+                del self.juncoes[chat_id]
+            data["text"] = "\n\n".join(juncao.textos)
+        await self._aguardar(self.global_.reservar())
+        espera = time.monotonic() - inicio
+        self.metricas["espera_total_s"] += espera
+        self.metricas["espera_max_s"] = max(self.metricas["espera_max_s"], espera)
+
+        try:
+            resultado = await self._enviar(callback, args, kwargs, chat_id)
+        except Exception as e:
+            if juntavel:
+                juncao.resultado.set_exception(e)
+                # Ninguém mais além de quem chamou precisa ver a exceção
+                juncao.resultado.exception()
+            raise
+        if juntavel:
+            juncao.resultado.set_result(resultado)
+        return resultado
+
+    async def _enviar(self, callback, args, kwargs, chat_id):
+        for tentativa in range(1, self.tentativas + 1):
+            try:
+                resultado = await callback(*args, **kwargs)
+                self.metricas["enviadas"] += 1
+                return resultado
+            except RetryAfter as e:
+                if tentativa == self.tentativas:
+                    raise
+                atraso = e.retry_after
+                if isinstance(atraso, timedelta):
+                    atraso = atraso.total_seconds()
+                self.metricas["erros_429"] += 1
+                logger.warning(f"Telegram pediu {atraso}s de espera (chat {chat_id})")
+                # Segura as próximas chamadas do mesmo balde, não só esta
+                (self._balde_chat(chat_id) if chat_id is not None else self.global_).pausar(atraso)
+                await self._aguardar(atraso)
+            except BadRequest:
+                raise
+            except NetworkError as e:
+                if tentativa == self.tentativas:
+                    raise
+                atraso = 0.5 * 2 ** (tentativa - 1)
+                logger.warning(f"Falha de rede ao falar com o Telegram ({e}); nova tentativa em {atraso}s")
+                await self._aguardar(atraso)
+            self.metricas["repetidas"] += 1
 
 # ------------------- HANDLERS DO BOT -------------------
 
+class TravasPorUsuario:
+    # Uma trava por usuário ativo: updates de usuários diferentes rodam em paralelo e os do
+    # mesmo usuário, um de cada vez e na ordem de chegada (asyncio.Lock atende em FIFO).
+    # Fluxos de várias etapas (edição, remoção em lote) não se intercalam.
+    def __init__(self):
+        self.travas = {}
+
+    @asynccontextmanager
+    async def do_usuario(self, user_id):
+        entrada = self.travas.get(user_id)
+        if entrada is None:
+            entrada = self.travas[user_id] = [asyncio.Lock(), 0]
+        entrada[1] += 1
+        try:
+            async with entrada[0]:
+                yield
+        finally:
+            # Sem ninguém esperando, a trava sai da memória
+            entrada[1] -= 1
+            if entrada[1] == 0:
+                del self.travas[user_id]
+
+travas_usuarios = TravasPorUsuario()
+
+def por_usuario(handler):
+    # Aplicado só no registro dos handlers: handlers que chamam outros (ex.: callback_handler
+    # chamando listar) já estão dentro da trava e não podem tentar pegá-la de novo
+    @functools.wraps(handler)
+    async def executar(update, context):
+        usuario = update.effective_user
+        # Vale para as linhas de log deste update, inclusive as de funções chamadas por ele
+        correlacao = update_atual.set((update.update_id, usuario.id if usuario else None))
+        try:
+            if usuario is None:
+                return await handler(update, context)
+            async with travas_usuarios.do_usuario(usuario.id):
+                return await handler(update, context)
+        finally:
+            update_atual.reset(correlacao)
+    return executar
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    num_contatos = len(contatos_por_usuario.get(user_id, {}).get("contatos", []))
+    num_contatos = len(obter_usuario(user_id)["contatos"])
     await update.message.reply_text(
         f"👋 Olá! Envie os contatos no formato:\n\n"
         "Nome 1\nNúmero 1\nNome 2\nNúmero 2\n...\n\n"
@@ -185,12 +2433,14 @@ async def ajuda(update: Update, context: ContextTypes.DEFAULT_TYPE, pagina=0):
         "• /listar - Ver contatos adicionados\n"
         "• /remover - Remover contatos\n"
         "• /editar - Editar um contato\n"
+        "• /duplicados - Achar e juntar contatos repetidos\n"
         "• /apagar - Limpar todos os contatos\n\n"
         "Use os botões abaixo para navegar ➡️",
         "💡 *DICAS DE FORMATAÇÃO*\n\n"
         "• Use o formato: Nome - Categoria\n  Ex: João Silva - Trabalho\n\n"
         "• Categorias ajudam a organizar seus contatos\n\n"
         "• Números aceitos:\n  - +55 82 9961-0303\n  - 82 9961-0303\n  - 8299610303\n\n"
+        "• Para importar uma agenda inteira, envie um arquivo .vcf, .csv ou .json\n\n"
         "➡️ Próxima página",
         "📤 *DICAS DE EXPORTAÇÃO*\n\n"
         "• .VCF - Padrão universal para contatos\n"
@@ -226,13 +2476,11 @@ async def ajuda(update: Update, context: ContextTypes.DEFAULT_TYPE, pagina=0):
             reply_markup=markup
         )
         user_id = update.effective_user.id
-        if user_id not in contatos_por_usuario:
-            contatos_por_usuario[user_id] = {"contatos": []}
-        contatos_por_usuario[user_id]["msg_ajuda_id"] = msg.message_id
+        obter_sessao(user_id)["msg_ajuda_id"] = msg.message_id
 
 async def arquivo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    if user_id not in contatos_por_usuario or not contatos_por_usuario[user_id]["contatos"]:
+    if not obter_usuario(user_id)["contatos"]:
         await update.message.reply_text("❌ Nenhum contato adicionado ainda.")
         return
     
@@ -240,7 +2488,8 @@ async def arquivo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         [InlineKeyboardButton(".VCF - Para contatos", callback_data="exportar_vcf")],
         [InlineKeyboardButton(".CSV - Para planilhas", callback_data="exportar_csv")],
         [InlineKeyboardButton(".JSON - Para desenvolvedores", callback_data="exportar_json")],
-        [InlineKeyboardButton("TODOS os formatos", callback_data="exportar_todos")]
+        [InlineKeyboardButton("TODOS os formatos", callback_data="exportar_todos")],
+        [InlineKeyboardButton("TODOS em um .ZIP", callback_data="exportar_zip")]
     ]
     markup = InlineKeyboardMarkup(keyboard)
     await update.message.reply_text(
@@ -250,46 +2499,43 @@ async def arquivo(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def listar(update: Update, context: ContextTypes.DEFAULT_TYPE, pagina=0):
     user_id = update.effective_user.id
-    if user_id not in contatos_por_usuario or not contatos_por_usuario[user_id]["contatos"]:
+    usuario = obter_usuario(user_id)
+    if not usuario["contatos"]:
         if hasattr(update, 'callback_query') and update.callback_query:
             await update.callback_query.edit_message_text("❌ Nenhum contato adicionado ainda.")
         else:
             await update.message.reply_text("❌ Nenhum contato adicionado ainda.")
         return
     
-    if "ordenacao" not in contatos_por_usuario[user_id]:
-        contatos_por_usuario[user_id]["ordenacao"] = "padrao"
+    if "ordenacao" not in usuario:
+        usuario["ordenacao"] = "padrao"
     
-    ordenacao = contatos_por_usuario[user_id].get("ordenacao", "padrao")
+    ordenacao = usuario.get("ordenacao", "padrao")
     if ordenacao == "alfabetica":
-        contatos_ordenados = sorted(contatos_por_usuario[user_id]["contatos"], key=lambda x: x[0].lower())
         texto_botao = "Padrão"
         nova_ordenacao = "padrao"
     else:
-        contatos_ordenados = contatos_por_usuario[user_id]["contatos"]
         texto_botao = "Ordem ABCD"
         nova_ordenacao = "alfabetica"
     
+    # Ordem ABCD e estatísticas vêm do índice mantido a cada alteração: só a página é montada
+    indice = obter_indice(user_id)
     contatos_por_pagina = 25
-    total_paginas = (len(contatos_ordenados) + contatos_por_pagina - 1) // contatos_por_pagina
+    total_contatos = len(usuario["contatos"])
+    total_paginas = (total_contatos + contatos_por_pagina - 1) // contatos_por_pagina
     inicio = pagina * contatos_por_pagina
-    fim = min((pagina + 1) * contatos_por_pagina, len(contatos_ordenados))
-    contatos_pagina = contatos_ordenados[inicio:fim]
-    total_contatos = len(contatos_ordenados)
-    
-    categorias = {}
-    for nome, numero in contatos_ordenados:
-        if ' - ' in nome:
-            _, categoria = nome.split(' - ', 1)
-        else:
-            categoria = "Sem categoria"
-        categorias[categoria] = categorias.get(categoria, 0) + 1
+    fim = min((pagina + 1) * contatos_por_pagina, total_contatos)
+    if ordenacao == "alfabetica":
+        contatos_pagina = indice.pagina_ordenada(inicio, fim)
+    else:
+        contatos_pagina = usuario["contatos"][inicio:fim]
+    categorias = indice.categorias
     
     stats_texto = f"📊 Estatísticas:\nTotal: {total_contatos} contatos\n"
     for categoria, quantidade in categorias.items():
         stats_texto += f"- {categoria}: {quantidade}\n"
     
-    contatos_texto = "\n".join([f"- {c[0]} (+55 {c[1]})" for c in contatos_pagina])
+    contatos_texto = "\n".join([f"- {c.nome_linha} (+55 {c.numero})" for c in contatos_pagina])
     
     keyboard = [[InlineKeyboardButton(texto_botao, callback_data=f"alterar_ordenacao:{nova_ordenacao}:{pagina}")]]
     
@@ -315,23 +2561,87 @@ async def listar(update: Update, context: ContextTypes.DEFAULT_TYPE, pagina=0):
             texto_mensagem, 
             reply_markup=markup
         )
-        contatos_por_usuario[user_id]["msg_listar_id"] = msg.message_id
-        salvar_contatos()
+        obter_sessao(user_id)["msg_listar_id"] = msg.message_id
 
 async def apagar(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    contatos_por_usuario[user_id] = {"contatos": []}
-    salvar_contatos()
+    reiniciar_usuario(user_id)
     await update.message.reply_text("✅ Todos os contatos foram removidos!")
 
-def procurar_contatos_por_nome(contatos, nome_busca):
-    nome_busca = nome_busca.strip().lower()
-    encontrados = [(i, c) for i, c in enumerate(contatos) if nome_busca in c[0].lower()]
-    return encontrados
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Só para administradores (--admin); para os demais o comando nem existe
+    if update.effective_user.id not in context.bot_data.get("admins", ()):
+        return
+    if not metricas.ativo:
+        await update.message.reply_text("📈 Métricas desligadas. Inicie o bot com --metricas.")
+        return
+    texto = metricas.resumo()
+    if len(texto) > LIMITE_TEXTO_TELEGRAM:
+        texto = texto[:LIMITE_TEXTO_TELEGRAM - 1] + "…"
+    await update.message.reply_text(texto)
+
+# Resultados mostrados por página na escolha de contato e limite total da busca
+RESULTADOS_POR_PAGINA = 8
+LIMITE_RESULTADOS_BUSCA = 48
+
+def montar_resultados_busca(user_id, acao, pagina):
+    # acao é "editar" ou "remover"; os seriais encontrados ficam na sessão do usuário
+    indice = obter_indice(user_id)
+    seriais = obter_sessao(user_id).get(f"{'edicao' if acao == 'editar' else 'remocao'}_indices", [])
+    total_paginas = max(1, (len(seriais) + RESULTADOS_POR_PAGINA - 1) // RESULTADOS_POR_PAGINA)
+    pagina = min(max(pagina, 0), total_paginas - 1)
+    inicio = pagina * RESULTADOS_POR_PAGINA
+    keyboard = []
+    for serial in seriais[inicio:inicio + RESULTADOS_POR_PAGINA]:
+        contato = indice.contato(serial)
+        if contato is not None:
+            keyboard.append([InlineKeyboardButton(
+                f"{contato.nome_linha} (+55 {contato.numero})",
+                callback_data=f"selecionar_{acao}:{serial}"
+            )])
+    if total_paginas > 1:
+        nav_buttons = []
+        if pagina > 0:
+            nav_buttons.append(InlineKeyboardButton("⬅️ Anterior", callback_data=f"busca_pagina:{acao}:{pagina-1}"))
+        if pagina < total_paginas - 1:
+            nav_buttons.append(InlineKeyboardButton("Próxima ➡️", callback_data=f"busca_pagina:{acao}:{pagina+1}"))
+        keyboard.append(nav_buttons)
+    cancelar = "cancelar_edicao" if acao == "editar" else "cancelar_remocao"
+    keyboard.append([InlineKeyboardButton("❌ Cancelar", callback_data=cancelar)])
+    verbo = "editar" if acao == "editar" else "apagar"
+    texto = (
+        f"🔎 Foram encontrados {len(seriais)} contatos parecidos — clique em um para {verbo}"
+        f" (página {pagina+1}/{total_paginas}):"
+    )
+    return texto, InlineKeyboardMarkup(keyboard)
+
+def resolver_selecao(user_id, acao, serial):
+    # Converte o serial de um botão na posição atual; botões antigos ou de outra busca não valem
+    sessao = obter_sessao(user_id)
+    indice = obter_indice(user_id)
+    seriais = sessao.get(f"{'edicao' if acao == 'editar' else 'remocao'}_indices", [])
+    if sessao.get("busca_geracao") != indice.geracao or serial not in seriais:
+        return None
+    return serial
+
+def marcar_contato(indice, serial):
+    # A sessão guarda o serial, não a posição: outras alterações podem mover o contato
+    # até a confirmação. A geração invalida a marca se o índice for reconstruído.
+    return (indice.geracao, serial)
+
+def posicao_marcada(user_id, marca):
+    # Posição atual do contato marcado, ou None se ele não existe mais
+    if not isinstance(marca, tuple):
+        return None
+    geracao, serial = marca
+    indice = obter_indice(user_id)
+    if indice.geracao != geracao:
+        return None
+    return indice.posicao(serial)
 
 async def remover(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    if user_id not in contatos_por_usuario or not contatos_por_usuario[user_id]["contatos"]:
+    if not obter_usuario(user_id)["contatos"]:
         await update.message.reply_text("❌ Nenhum contato adicionado ainda.")
         return
 
@@ -347,17 +2657,18 @@ async def remover(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def editar(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    if user_id not in contatos_por_usuario or not contatos_por_usuario[user_id]["contatos"]:
+    if not obter_usuario(user_id)["contatos"]:
         await update.message.reply_text("❌ Nenhum contato adicionado ainda.")
         return
 
-    contatos_por_usuario[user_id]["modo_edicao"] = "selecionar"
+    obter_sessao(user_id)["modo_edicao"] = "selecionar"
     await update.message.reply_text("❓ Qual contato você quer editar? Digite o nome exato ou parte dele.")
 
 async def processar_editar_nome(update, context, nome_para_editar):
     user_id = update.effective_user.id
-    contatos_atuais = contatos_por_usuario[user_id]["contatos"]
-    encontrados = procurar_contatos_por_nome(contatos_atuais, nome_para_editar)
+    sessao = obter_sessao(user_id)
+    indice = obter_indice(user_id)
+    encontrados = indice.buscar(nome_para_editar, LIMITE_RESULTADOS_BUSCA)
 
     if not encontrados:
         keyboard = [
@@ -372,33 +2683,27 @@ async def processar_editar_nome(update, context, nome_para_editar):
         return
 
     if len(encontrados) == 1:
-        idx, contato = encontrados[0]
-        contatos_por_usuario[user_id]["contato_editando"] = idx
-        contatos_por_usuario[user_id]["modo_edicao"] = "dados"
+        contato = indice.contato(encontrados[0])
+        sessao["contato_editando"] = marcar_contato(indice, encontrados[0])
+        sessao["modo_edicao"] = "dados"
         await update.message.reply_text(
-            f"📝 Editando: {contato[0]} (+55 {contato[1]})\n\n"
+            f"📝 Editando: {contato.nome_linha} (+55 {contato.numero})\n\n"
             "Envie os novos dados no formato:\n"
             "Nome - Categoria\nNúmero\n\n"
             "Exemplo:\n"
             "João Silva - Trabalho\n8299610303"
         )
     else:
-        contatos_por_usuario[user_id]["edicao_indices"] = [idx for idx, _ in encontrados]
-        keyboard = [
-            [InlineKeyboardButton(f"{c[0]} (+55 {c[1]})", callback_data=f"selecionar_editar:{idx}")]
-            for idx, c in encontrados
-        ]
-        keyboard.append([InlineKeyboardButton("❌ Cancelar", callback_data="cancelar_edicao")])
-        markup = InlineKeyboardMarkup(keyboard)
-        await update.message.reply_text(
-            "🔎 Foram encontrados vários contatos com esse nome — clique em um para editar:",
-            reply_markup=markup
-        )
+        sessao["edicao_indices"] = encontrados
+        sessao["busca_geracao"] = indice.geracao
+        texto, markup = montar_resultados_busca(user_id, "editar", 0)
+        await update.message.reply_text(texto, reply_markup=markup)
 
 async def processar_remover_nome(update, context, nome_para_remover):
     user_id = update.effective_user.id
-    contatos_atuais = contatos_por_usuario[user_id]["contatos"]
-    encontrados = procurar_contatos_por_nome(contatos_atuais, nome_para_remover)
+    sessao = obter_sessao(user_id)
+    indice = obter_indice(user_id)
+    encontrados = indice.buscar(nome_para_remover, LIMITE_RESULTADOS_BUSCA)
 
     if not encontrados:
         keyboard = [
@@ -413,29 +2718,198 @@ async def processar_remover_nome(update, context, nome_para_remover):
         return
 
     if len(encontrados) == 1:
-        idx, contato = encontrados[0]
-        contatos_por_usuario[user_id]["confirm_remover"] = idx
+        contato = indice.contato(encontrados[0])
+        sessao["confirm_remover"] = marcar_contato(indice, encontrados[0])
         keyboard = [
             [InlineKeyboardButton("Sim", callback_data="confirmar_remover")],
             [InlineKeyboardButton("Não", callback_data="cancelar_remover")]
         ]
         markup = InlineKeyboardMarkup(keyboard)
         await update.message.reply_text(
-            f"Quer mesmo excluir {contato[0]} (+55 {contato[1]})?",
+            f"Quer mesmo excluir {contato.nome_linha} (+55 {contato.numero})?",
             reply_markup=markup
         )
     else:
-        contatos_por_usuario[user_id]["remocao_indices"] = [idx for idx, _ in encontrados]
-        keyboard = [
-            [InlineKeyboardButton(f"{c[0]} (+55 {c[1]})", callback_data=f"selecionar_remover:{idx}")]
-            for idx, c in encontrados
-        ]
-        keyboard.append([InlineKeyboardButton("❌ Cancelar", callback_data="cancelar_remocao")])
-        markup = InlineKeyboardMarkup(keyboard)
-        await update.message.reply_text(
-            "🔎 Foram encontrados vários contatos com esse nome — clique em um para apagar:",
-            reply_markup=markup
+        sessao["remocao_indices"] = encontrados
+        sessao["busca_geracao"] = indice.geracao
+        texto, markup = montar_resultados_busca(user_id, "remover", 0)
+        await update.message.reply_text(texto, reply_markup=markup)
+
+# Grupos de duplicados mostrados por mensagem e contatos listados de cada grupo
+GRUPOS_DUPLICADOS_POR_PAGINA = 5
+MEMBROS_DUPLICADOS_EXIBIDOS = 6
+
+def chave_numero(numero):
+    # Celular gravado sem o nono dígito (DDD + 8 dígitos começando em 6-9) é o mesmo número com ele
+    if len(numero) == 10 and numero[2] in "6789":
+        return numero[:2] + "9" + numero[2:]
+    return numero
+
+def agrupar_duplicados(contatos, seriais, por_nome=False):
+    # Uma passada com dicionários: cada contato cai no grupo do seu número (e, com por_nome,
+    # também no do nome sem acentos). Grupos que compartilham um contato viram um só
+    # (union-find). Devolve os grupos com 2+ contatos, como listas de seriais em ordem da lista.
+    pai = list(range(len(contatos)))
+    # Só quem colidiu com alguém pode estar num grupo de 2+: o resto nem é revisitado
+    tocados = set()
+
+    def raiz(i):
+        while pai[i] != i:
+            pai[i] = pai[pai[i]]
+            i = pai[i]
+        return i
+
+    def unir(i, j):
+        tocados.add(i)
+        tocados.add(j)
+        a, b = raiz(i), raiz(j)
+        if a != b:
+            pai[max(a, b)] = min(a, b)
+
+    por_numero = {}
+    por_nome_dobrado = {}
+    for i, contato in enumerate(contatos):
+        j = por_numero.setdefault(chave_numero(contato.numero), i)
+        if j != i:
+            unir(i, j)
+        if por_nome:
+            j = por_nome_dobrado.setdefault(" ".join(dobrar_texto(contato.nome).split()), i)
+            if j != i:
+                unir(i, j)
+    grupos = {}
+    for i in sorted(tocados):
+        grupos.setdefault(raiz(i), []).append(seriais[i])
+    return [grupo for _, grupo in sorted(grupos.items())]
+
+def escolher_mantido(contatos):
+    # Quem fica ao juntar: número completo (11 dígitos), com categoria, nome mais longo; no
+    # empate, o que entrou primeiro na lista
+    return max(
+        range(len(contatos)),
+        key=lambda i: (len(contatos[i].numero), contatos[i].categoria is not None, len(contatos[i].nome), -i)
+    )
+
+def juntar_grupo(contatos):
+    # Contatos do grupo com o mesmo número viram um só: fica o de escolher_mantido, com a
+    # categoria de um dos outros se ele não tiver. Números diferentes (grupos por nome) não
+    # cabem num contato só e ficam como estão. Devolve {posição no grupo: contato que fica}
+    # e as posições no grupo a remover.
+    por_numero = {}
+    for i, contato in enumerate(contatos):
+        por_numero.setdefault(chave_numero(contato.numero), []).append(i)
+    mantidos = {}
+    removidos = []
+    for membros in por_numero.values():
+        if len(membros) < 2:
+            continue
+        escolhido = membros[escolher_mantido([contatos[i] for i in membros])]
+        contato = contatos[escolhido]
+        if contato.categoria is None:
+            categoria = next((contatos[i].categoria for i in membros if contatos[i].categoria is not None), None)
+            if categoria is not None:
+                contato = Contato(contato.nome, categoria, contato.numero)
+        mantidos[escolhido] = contato
+        removidos.extend(i for i in membros if i != escolhido)
+    return mantidos, sorted(removidos)
+
+def montar_pagina_duplicados(user_id, pagina):
+    sessao = obter_sessao(user_id)["duplicados"]
+    grupos = sessao["grupos"]
+    total_paginas = max(1, (len(grupos) + GRUPOS_DUPLICADOS_POR_PAGINA - 1) // GRUPOS_DUPLICADOS_POR_PAGINA)
+    pagina = min(max(pagina, 0), total_paginas - 1)
+    inicio = pagina * GRUPOS_DUPLICADOS_POR_PAGINA
+    indice = obter_indice(user_id)
+    contatos = obter_usuario(user_id)["contatos"]
+    pagina_grupos = range(inicio, min(inicio + GRUPOS_DUPLICADOS_POR_PAGINA, len(grupos)))
+    # Uma passada pelos seriais resolve as posições de todos os grupos da página
+    posicoes = indice.posicoes([serial for g in pagina_grupos for serial in grupos[g]])
+
+    linhas = [
+        f"🔁 {len(grupos)} grupo(s) de duplicados — página {pagina+1}/{total_paginas}",
+        "Juntar deixa um contato por número: o ⭐, com a categoria dos repetidos se ele não tiver. "
+        "Os 📞 têm outro número e ficam. Nada muda até você tocar em Aplicar.",
+    ]
+    keyboard = []
+    for g in pagina_grupos:
+        membros = [contatos[posicoes[serial]] for serial in grupos[g] if serial in posicoes]
+        juntar = g in sessao["juntar"]
+        linhas.append(f"\n{g+1}. {len(membros)} contatos — {'🔗 juntar' if juntar else '✋ manter'}")
+        mantidos, removidos = juntar_grupo(membros)
+        for i, contato in enumerate(membros[:MEMBROS_DUPLICADOS_EXIBIDOS]):
+            if i in mantidos:
+                marca, contato = "⭐", mantidos[i]
+            else:
+                marca = "•" if i in removidos else "📞"
+            linhas.append(f"{marca} {contato.nome_linha} (+55 {contato.numero})")
+        if len(membros) > MEMBROS_DUPLICADOS_EXIBIDOS:
+            linhas.append(f"… e mais {len(membros) - MEMBROS_DUPLICADOS_EXIBIDOS}")
+        rotulo = f"↩️ Manter {g+1}" if juntar else f"🔗 Juntar {g+1}"
+        keyboard.append([InlineKeyboardButton(rotulo, callback_data=f"dup_alternar:{g}:{pagina}")])
+
+    nav_buttons = []
+    if pagina > 0:
+        nav_buttons.append(InlineKeyboardButton("⬅️ Anterior", callback_data=f"dup_pagina:{pagina-1}"))
+    if pagina < total_paginas - 1:
+        nav_buttons.append(InlineKeyboardButton("Próxima ➡️", callback_data=f"dup_pagina:{pagina+1}"))
+    if nav_buttons:
+        keyboard.append(nav_buttons)
+    keyboard.append([InlineKeyboardButton("🔗 Juntar todos desta página", callback_data=f"dup_juntar_pagina:{pagina}")])
+    keyboard.append([
+        InlineKeyboardButton(f"✅ Aplicar ({len(sessao['juntar'])})", callback_data="dup_aplicar"),
+        InlineKeyboardButton("❌ Cancelar", callback_data="dup_cancelar"),
+    ])
+    texto = "\n".join(linhas)
+    if len(texto) > LIMITE_TEXTO_TELEGRAM:
+        texto = texto[:LIMITE_TEXTO_TELEGRAM - 1] + "…"
+    return texto, InlineKeyboardMarkup(keyboard)
+
+def aplicar_duplicados(user_id):
+    # Cada grupo é conferido de novo na lista atual: quem foi removido ou editado para outro
+    # número depois do /duplicados não é mais juntado. As categorias completadas vão antes
+    # (edições não mudam posições); as remoções, todas numa única alteração "remover".
+    sessao = obter_sessao(user_id).pop("duplicados")
+    grupos = [sessao["grupos"][g] for g in sorted(sessao["juntar"])]
+    posicoes = obter_indice(user_id).posicoes([serial for grupo in grupos for serial in grupo])
+    contatos = obter_usuario(user_id)["contatos"]
+    editar = []
+    remover = []
+    juntados = 0
+    for grupo in grupos:
+        membros = [posicoes[serial] for serial in grupo if serial in posicoes]
+        mantidos, removidos = juntar_grupo([contatos[i] for i in membros])
+        if not removidos:
+            continue
+        editar.extend(
+            (membros[k], contato) for k, contato in mantidos.items() if contato is not contatos[membros[k]]
         )
+        remover.extend(membros[k] for k in removidos)
+        juntados += 1
+    for idx, contato in editar:
+        editar_contato(user_id, idx, contato)
+    if remover:
+        remover_contatos(user_id, remover)
+    return juntados, len(remover), len(editar)
+
+async def duplicados(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    usuario = obter_usuario(user_id)
+    if not usuario["contatos"]:
+        await update.message.reply_text("❌ Nenhum contato adicionado ainda.")
+        return
+    por_nome = bool(context.args) and context.args[0].lower() in ("nome", "nomes")
+    indice = obter_indice(user_id)
+    loop = asyncio.get_running_loop()
+    # Cópias feitas no loop; o agrupamento (uma passada pela lista toda) roda fora dele
+    grupos = await loop.run_in_executor(
+        None, agrupar_duplicados, list(usuario["contatos"]), list(indice.seriais), por_nome
+    )
+    if not grupos:
+        dica = "" if por_nome else "\nUse /duplicados nomes para procurar também nomes iguais com números diferentes."
+        await update.message.reply_text(f"✅ Nenhum duplicado encontrado.{dica}")
+        return
+    obter_sessao(user_id)["duplicados"] = {"grupos": grupos, "juntar": set(), "geracao": indice.geracao}
+    texto, markup = montar_pagina_duplicados(user_id, 0)
+    await update.message.reply_text(texto, reply_markup=markup)
 
 async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -457,87 +2931,303 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         partes = data.split(":")
         nova_ordenacao = partes[1]
         pagina = int(partes[2])
-        contatos_por_usuario[user_id]["ordenacao"] = nova_ordenacao
+        obter_usuario(user_id)["ordenacao"] = nova_ordenacao
+        salvar_estado(user_id)
         await listar(update, context, pagina)
         return
 
-    elif data == "exportar_vcf":
-        contatos = contatos_por_usuario[user_id]["contatos"]
-        vcf_file = salvar_vcf(contatos)
-        await query.message.reply_document(
-            document=InputFile(vcf_file, filename="contatos.vcf"),
-            caption="📇 Aqui estão seus contatos no formato VCF!"
-        )
+    elif data in ("exportar_vcf", "exportar_csv", "exportar_json", "exportar_zip"):
+        await enviar_exportacao(query.message, user_id, data.split("_", 1)[1])
         return
 
-    elif data == "exportar_csv":
-        contatos = contatos_por_usuario[user_id]["contatos"]
-        csv_file = salvar_csv(contatos)
-        await query.message.reply_document(
-            document=InputFile(csv_file, filename="contatos.csv"),
-            caption="📊 Aqui estão seus contatos no formato CSV!"
-        )
+    elif data == "exportar_todos":
+        # Os três formatos saem de uma única leitura da lista e são enviados juntos
+        await enviar_todos_formatos(query.message, user_id)
+        await query.message.reply_text("📦 Todos os formatos exportados!")
         return
 
-    elif data == "exportar_json":
-        contatos = contatos_por_usuario[user_id]["contatos"]
-        json_file = salvar_json(contatos)
-        await query.message.reply_document(
-            document=InputFile(json_file, filename="contatos.json"),
-            caption="📝 Aqui estão seus contatos no formato JSON!"
+    elif data.startswith("busca_pagina:"):
+        _, acao, pagina = data.split(":")
+        texto, markup = montar_resultados_busca(user_id, acao, int(pagina))
+        await query.edit_message_text(texto, reply_markup=markup)
+        return
+
+    elif data.startswith("selecionar_editar:"):
+        serial = resolver_selecao(user_id, "editar", int(data.split(":")[1]))
+        if serial is None:
+            await query.edit_message_text("⚠️ Essa busca expirou. Use /editar para buscar de novo.")
+            return
+        indice = obter_indice(user_id)
+        contato = indice.contato(serial)
+        sessao = obter_sessao(user_id)
+        sessao["contato_editando"] = marcar_contato(indice, serial)
+        sessao["modo_edicao"] = "dados"
+        await query.edit_message_text(
+            f"📝 Editando: {contato.nome_linha} (+55 {contato.numero})\n\n"
+            "Envie os novos dados no formato:\n"
+            "Nome - Categoria\nNúmero\n\n"
+            "Exemplo:\n"
+            "João Silva - Trabalho\n8299610303"
         )
         return
 
-    elif data == "exportar_todos":
-        contatos = contatos_por_usuario[user_id]["contatos"]
-        
-        # Enviar VCF
-        vcf_file = salvar_vcf(contatos)
-        await query.message.reply_document(
-            document=InputFile(vcf_file, filename="contatos.vcf"),
-            caption="📇 Contatos em formato VCF"
+    elif data.startswith("selecionar_remover:"):
+        serial = resolver_selecao(user_id, "remover", int(data.split(":")[1]))
+        if serial is None:
+            await query.edit_message_text("⚠️ Essa busca expirou. Use /remover para buscar de novo.")
+            return
+        indice = obter_indice(user_id)
+        contato = indice.contato(serial)
+        obter_sessao(user_id)["confirm_remover"] = marcar_contato(indice, serial)
+        keyboard = [
+            [InlineKeyboardButton("Sim", callback_data="confirmar_remover")],
+            [InlineKeyboardButton("Não", callback_data="cancelar_remover")]
+        ]
+        await query.edit_message_text(
+            f"Quer mesmo excluir {contato.nome_linha} (+55 {contato.numero})?",
+            reply_markup=InlineKeyboardMarkup(keyboard)
         )
-        
-        # Enviar CSV
-        csv_file = salvar_csv(contatos)
-        await query.message.reply_document(
-            document=InputFile(csv_file, filename="contatos.csv"),
-            caption="📊 Contatos em formato CSV"
+        return
+
+    elif data == "confirmar_remover":
+        usuario = obter_usuario(user_id)
+        sessao = obter_sessao(user_id)
+        idx = posicao_marcada(user_id, sessao.pop("confirm_remover", None))
+        sessao.pop("remocao_indices", None)
+        sessao.pop("modo_remocao", None)
+        if idx is None:
+            await query.edit_message_text("⚠️ Contato não encontrado. Use /remover para tentar de novo.")
+            return
+        contato = usuario["contatos"][idx]
+        remover_contatos(user_id, [idx])
+        keyboard = [
+            [InlineKeyboardButton("Remover outro", callback_data="remover_outra")],
+            [InlineKeyboardButton("Adicionar contatos", callback_data="adicionar_contatos")]
+        ]
+        await query.edit_message_text(
+            f"✅ Contato removido: {contato.nome_linha} (+55 {contato.numero})",
+            reply_markup=InlineKeyboardMarkup(keyboard)
         )
-        
-        # Enviar JSON
-        json_file = salvar_json(contatos)
-        await query.message.reply_document(
-            document=InputFile(json_file, filename="contatos.json"),
-            caption="📝 Contatos em formato JSON"
+        return
+
+    elif data in ("cancelar_remover", "cancelar_remocao"):
+        sessao = obter_sessao(user_id)
+        for chave in ("confirm_remover", "remocao_indices", "modo_remocao", "awaiting_remover_name"):
+            sessao.pop(chave, None)
+        await query.edit_message_text("❌ Remoção cancelada.")
+        return
+
+    elif data == "cancelar_edicao":
+        sessao = obter_sessao(user_id)
+        for chave in ("modo_edicao", "contato_editando", "edicao_indices"):
+            sessao.pop(chave, None)
+        await query.edit_message_text("❌ Edição cancelada.")
+        return
+
+    elif data == "editar_outro":
+        obter_sessao(user_id)["modo_edicao"] = "selecionar"
+        await query.edit_message_text("❓ Qual contato você quer editar? Digite o nome exato ou parte dele.")
+        return
+
+    elif data in ("remover_um", "remover_outra"):
+        sessao = obter_sessao(user_id)
+        sessao["modo_remocao"] = "individual"
+        sessao["awaiting_remover_name"] = True
+        await query.edit_message_text("❓ Qual contato você quer remover? Digite o nome exato ou parte dele.")
+        return
+
+    elif data == "adicionar_contatos":
+        sessao = obter_sessao(user_id)
+        for chave in ("modo_edicao", "contato_editando", "modo_remocao", "awaiting_remover_name"):
+            sessao.pop(chave, None)
+        await query.edit_message_text("👍 Envie os contatos no formato:\n\nNome - Categoria\nNúmero")
+        return
+
+    elif data.startswith("dup_"):
+        sessao_usuario = obter_sessao(user_id)
+        sessao = sessao_usuario.get("duplicados")
+        if sessao is None or sessao["geracao"] != obter_indice(user_id).geracao:
+            sessao_usuario.pop("duplicados", None)
+            await query.edit_message_text("⚠️ Essa lista de duplicados expirou. Use /duplicados de novo.")
+            return
+        acao, _, resto = data.partition(":")
+        if acao == "dup_cancelar":
+            sessao_usuario.pop("duplicados", None)
+            await query.edit_message_text("❌ Nada foi alterado.")
+            return
+        if acao == "dup_aplicar":
+            juntados, removidos, completados = aplicar_duplicados(user_id)
+            texto = f"✅ {juntados} grupo(s) juntados, {removidos} contato(s) duplicados removidos."
+            if completados:
+                texto += f"\n🏷️ {completados} contato(s) ficaram com a categoria de um repetido."
+            await query.edit_message_text(texto)
+            return
+        if acao == "dup_alternar":
+            grupo, pagina = (int(x) for x in resto.split(":"))
+            if grupo in sessao["juntar"]:
+                sessao["juntar"].discard(grupo)
+            else:
+                sessao["juntar"].add(grupo)
+        elif acao == "dup_juntar_pagina":
+            pagina = int(resto)
+            inicio = pagina * GRUPOS_DUPLICADOS_POR_PAGINA
+            sessao["juntar"].update(range(inicio, min(inicio + GRUPOS_DUPLICADOS_POR_PAGINA, len(sessao["grupos"]))))
+        else:
+            pagina = int(resto)
+        texto, markup = montar_pagina_duplicados(user_id, pagina)
+        await query.edit_message_text(texto, reply_markup=markup)
+        return
+
+    elif data == "remover_lote":
+        sessao = obter_sessao(user_id)
+        for chave in ("confirm_remover", "remocao_indices", "awaiting_remover_name"):
+            sessao.pop(chave, None)
+        sessao["modo_remocao"] = "lote"
+        sessao["contatos_lote"] = []
+        await query.edit_message_text(
+            "📋 Envie os contatos que quer apagar, no mesmo formato usado para adicionar:\n\n"
+            "Nome - Categoria\nNúmero\n\n"
+            "Pode mandar vários de uma vez e em mais de uma mensagem."
         )
-        
-        await query.message.reply_text("📦 Todos os formatos exportados!")
         return
 
-    # ... (outros callbacks permanecem iguais) ...
+    elif data == "continuar_lote":
+        await query.edit_message_text("➕ Envie mais contatos para apagar (Nome - Categoria / Número).")
+        return
+
+    elif data == "cancelar_lote":
+        sessao = obter_sessao(user_id)
+        sessao.pop("modo_remocao", None)
+        sessao.pop("contatos_lote", None)
+        await query.edit_message_text("❌ Remoção em lote cancelada.")
+        return
+
+    elif data == "confirmar_lote":
+        sessao = obter_sessao(user_id)
+        pares = sessao.pop("contatos_lote", [])
+        sessao.pop("modo_remocao", None)
+        if not pares:
+            await query.edit_message_text("⚠️ Nenhum contato selecionado. Use /remover para começar de novo.")
+            return
+        removidos, nao_encontrados = remover_lote(user_id, pares)
+        msg = f"✅ {len(removidos)} contato(s) removidos."
+        if nao_encontrados:
+            msg += f"\n\n⚠️ {len(nao_encontrados)} não encontrado(s) na sua lista:\n"
+            msg += "\n".join(f"• {nome} - {numero}" for nome, numero in nao_encontrados[:LIMITE_LOTE_EXIBIDOS])
+            if len(nao_encontrados) > LIMITE_LOTE_EXIBIDOS:
+                msg += f"\n… e mais {len(nao_encontrados) - LIMITE_LOTE_EXIBIDOS}."
+        keyboard = [
+            [InlineKeyboardButton("Remover mais", callback_data="remover_lote")],
+            [InlineKeyboardButton("Adicionar contatos", callback_data="adicionar_contatos")]
+        ]
+        await query.edit_message_text(msg, reply_markup=InlineKeyboardMarkup(keyboard))
+        return
 
     logger.warning(f"Callback não tratado: {data}")
     await query.edit_message_text("❌ Ação não reconhecida.")
 
+async def importar_documento(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    documento = update.message.document
+    formato = formato_importacao(documento)
+    if formato is None:
+        await update.message.reply_text("⚠️ Envie um arquivo .vcf, .csv ou .json para importar contatos.")
+        return
+    if documento.file_size and documento.file_size > LIMITE_ARQUIVO_IMPORTACAO:
+        await update.message.reply_text("⚠️ Arquivo grande demais. O Telegram só entrega ao bot arquivos de até 20 MB.")
+        return
+
+    # Vai ser editada com o progresso: não pode sair junto com outro texto
+    status = await update.message.reply_text(
+        f"📥 Importando {formato.upper()}...",
+        rate_limit_args=None if context.bot.rate_limiter is None else {"juntar": False}
+    )
+    loop = asyncio.get_running_loop()
+    lidos = 0
+    adicionados = 0
+    duplicados = 0
+    invalidos = []
+    sem_nome = []
+    ultima_edicao = time.monotonic()
+    # O arquivo vai para um temporário em disco e é lido aos poucos, lote a lote
+    with tempfile.TemporaryFile() as bruto:
+        try:
+            arquivo = await documento.get_file()
+            await arquivo.download_to_memory(out=bruto)
+            bruto.seek(0)
+            registros = LEITORES_IMPORTACAO[formato](
+                TextIOWrapper(bruto, encoding="utf-8-sig", errors="replace", newline="")
+            )
+            while True:
+                # A leitura do arquivo roda fora do event loop; deduplicar e gravar, dentro
+                lote = await loop.run_in_executor(None, proximo_lote, registros)
+                if not lote:
+                    break
+                indice = obter_indice(user_id)
+                vistos = set()
+                novos = []
+                numeros = normalizar_numeros([numero for _, _, numero in lote])
+                for i, ((nome, categoria, numero), numero_limpo) in enumerate(zip(lote, numeros)):
+                    nome = nome.strip()
+                    if not nome:
+                        # Linha em branco (comum no fim de planilhas) não é contato sem nome
+                        if numero.strip():
+                            sem_nome.append((lidos + i + 1, numero.strip()))
+                        continue
+                    if not validar_numero_brasileiro(numero_limpo):
+                        invalidos.append((lidos + i + 1, numero.strip()))
+                        continue
+                    contato = Contato(nome, categoria_importada(categoria), numero_limpo)
+                    chave = IndiceContatos.chave(contato.nome_linha, numero_limpo)
+                    if chave in vistos or indice.contem(contato.nome_linha, numero_limpo):
+                        duplicados += 1
+                    else:
+                        vistos.add(chave)
+                        novos.append(contato)
+                lidos += len(lote)
+                if novos:
+                    adicionar_contatos(user_id, novos)
+                    adicionados += len(novos)
+                if time.monotonic() - ultima_edicao >= INTERVALO_PROGRESSO:
+                    ultima_edicao = time.monotonic()
+                    await status.edit_text(
+                        f"📥 Importando {formato.upper()}... {lidos} lido(s), {adicionados} adicionado(s)."
+                    )
+        except Exception as e:
+            logger.error(f"Erro ao importar {formato} do usuário {user_id}: {e}")
+            await status.edit_text(
+                f"❌ Não foi possível ler o arquivo: {e}\n"
+                f"{adicionados} contato(s) foram importados antes do erro."
+            )
+            return
+
+    msg = f"✅ Importação concluída: {adicionados} de {lidos} contato(s) adicionados."
+    if duplicados:
+        msg += f"\n⚠️ {duplicados} contato(s) já existiam e não foram adicionados."
+    if sem_nome:
+        msg += "\n\n" + relatorio_sem_nome(sem_nome)
+    if invalidos:
+        msg += "\n\n" + relatorio_invalidos(invalidos, rotulo="contato")
+    msg += "\nUse /arquivo para gerar o .vcf."
+    await status.edit_text(msg)
+
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     text = update.message.text.strip()
 
-    if user_id not in contatos_por_usuario:
-        contatos_por_usuario[user_id] = {"contatos": []}
+    usuario = obter_usuario(user_id)
+    sessao = obter_sessao(user_id)
     
     # FLUXO DE CONFIRMAÇÃO DE APAGAR LISTA APÓS EXPORTAÇÃO
-    if contatos_por_usuario.get(user_id, {}).get("aguardando_confirmacao_apagar", False):
+    if sessao.get("aguardando_confirmacao_apagar", False):
         resposta = text.lower()
         if resposta in ["sim", "s"]:
-            contatos_por_usuario[user_id]["contatos"] = []
-            contatos_por_usuario[user_id]["aguardando_confirmacao_apagar"] = False
+            sessao["aguardando_confirmacao_apagar"] = False
+            limpar_contatos(user_id)
             await update.message.reply_text("✅ Lista apagada! Envie os novos contatos.")
-            salvar_contatos()
             return
         elif resposta in ["não", "nao", "n"]:
-            contatos_por_usuario[user_id]["aguardando_confirmacao_apagar"] = False
+            sessao["aguardando_confirmacao_apagar"] = False
             await update.message.reply_text("👍 Lista mantida! Envie os contatos para adicionar.")
             return
         else:
@@ -549,17 +3239,21 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return
 
-    modo_remocao = contatos_por_usuario[user_id].get("modo_remocao")
-    modo_edicao = contatos_por_usuario[user_id].get("modo_edicao")
-    awaiting_remover_name = contatos_por_usuario[user_id].get("awaiting_remover_name", False)
+    modo_remocao = sessao.get("modo_remocao")
+    modo_edicao = sessao.get("modo_edicao")
+    awaiting_remover_name = sessao.get("awaiting_remover_name", False)
 
     if modo_edicao == "selecionar":
         await processar_editar_nome(update, context, text)
         return
 
     elif modo_edicao == "dados":
-        idx = contatos_por_usuario[user_id].get("contato_editando")
-        if idx is not None and 0 <= idx < len(contatos_por_usuario[user_id]["contatos"]):
+        idx = posicao_marcada(user_id, sessao.get("contato_editando"))
+        if idx is None:
+            sessao.pop("modo_edicao", None)
+            sessao.pop("contato_editando", None)
+            await update.message.reply_text("⚠️ Contato não encontrado. Use /editar para tentar de novo.")
+        else:
             linhas = text.splitlines()
             if len(linhas) < 2:
                 await update.message.reply_text("⚠️ Formato inválido. Envie no formato:\nNome - Categoria\nNúmero")
@@ -570,8 +3264,8 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if not validar_numero_brasileiro(numero_limpo):
                 await update.message.reply_text("❌ Número inválido. Deve ter 10 ou 11 dígitos (DDD + número).")
                 return
-            contato_antigo = contatos_por_usuario[user_id]["contatos"][idx]
-            contatos_por_usuario[user_id]["contatos"][idx] = (novo_nome, numero_limpo)
+            contato_antigo = usuario["contatos"][idx]
+            editar_contato(user_id, idx, Contato.de_linha(novo_nome, numero_limpo))
             keyboard = [
                 [InlineKeyboardButton("Editar outro", callback_data="editar_outro")],
                 [InlineKeyboardButton("Voltar ao menu", callback_data="adicionar_contatos")]
@@ -579,17 +3273,16 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             markup = InlineKeyboardMarkup(keyboard)
             await update.message.reply_text(
                 f"✅ Contato editado com sucesso!\n\n"
-                f"Antes: {contato_antigo[0]} (+55 {contato_antigo[1]})\n"
+                f"Antes: {contato_antigo.nome_linha} (+55 {contato_antigo.numero})\n"
                 f"Depois: {novo_nome} (+55 {numero_limpo})",
                 reply_markup=markup
             )
-            contatos_por_usuario[user_id].pop("modo_edicao", None)
-            contatos_por_usuario[user_id].pop("contato_editando", None)
-            salvar_contatos()
+            sessao.pop("modo_edicao", None)
+            sessao.pop("contato_editando", None)
         return
 
     elif awaiting_remover_name and modo_remocao == "individual":
-        contatos_por_usuario[user_id].pop("awaiting_remover_name", None)
+        sessao.pop("awaiting_remover_name", None)
         await processar_remover_nome(update, context, text)
         return
 
@@ -599,16 +3292,16 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("⚠️ Formato inválido. Cada nome deve ser seguido de um número.")
             return
         contatos_para_remover = []
-        for i in range(0, len(linhas), 2):
-            nome = linhas[i].strip()
-            numero = linhas[i+1].strip()
-            numero_limpo = limpar_numero(numero)
+        for nome, numero_limpo in zip(linhas[0::2], normalizar_numeros(linhas[1::2])):
+            nome = nome.strip()
             if nome and numero_limpo:
                 contatos_para_remover.append((nome, numero_limpo))
-        if "contatos_lote" not in contatos_por_usuario[user_id]:
-            contatos_por_usuario[user_id]["contatos_lote"] = []
-        contatos_por_usuario[user_id]["contatos_lote"].extend(contatos_para_remover)
-        contatos_texto = "\n".join([f"❌ {c[0]} - {c[1]}" for c in contatos_por_usuario[user_id]["contatos_lote"]])
+        lote = sessao.setdefault("contatos_lote", [])
+        lote.extend(contatos_para_remover)
+        contatos_texto = "\n".join([f"❌ {c[0]} - {c[1]}" for c in lote[-LIMITE_LOTE_EXIBIDOS:]])
+        if len(lote) > LIMITE_LOTE_EXIBIDOS:
+            # Lotes grandes passariam do tamanho máximo de uma mensagem: só os últimos aparecem
+            contatos_texto = f"… {len(lote) - LIMITE_LOTE_EXIBIDOS} anteriores e os últimos:\n{contatos_texto}"
         keyboard = [
             [InlineKeyboardButton("✅ Confirmar exclusão", callback_data="confirmar_lote")],
             [InlineKeyboardButton("➕ Adicionar mais", callback_data="continuar_lote")],
@@ -616,7 +3309,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         ]
         markup = InlineKeyboardMarkup(keyboard)
         await update.message.reply_text(
-            f"📋 Contatos selecionados para remoção:\n\n{contatos_texto}\n\n"
+            f"📋 {len(lote)} contato(s) selecionados para remoção:\n\n{contatos_texto}\n\n"
             "Deseja confirmar a exclusão ou adicionar mais contatos?",
             reply_markup=markup
         )
@@ -633,32 +3326,37 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     novos_contatos = []
     contatos_duplicados = []
-    for i in range(0, len(linhas), 2):
-        nome = linhas[i].strip()
-        numero = linhas[i + 1].strip()
-        numero_limpo = limpar_numero(numero)
+    invalidos = []
+    # Chaves já aceitas nesta mesma mensagem, para barrar repetições dentro do lote
+    vistos = set()
+    numeros = linhas[1::2]
+    for i, (nome, numero_limpo) in enumerate(zip(linhas[0::2], normalizar_numeros(numeros))):
+        nome = nome.strip()
         if not validar_numero_brasileiro(numero_limpo):
-            await update.message.reply_text(f"❌ Número inválido: {numero}. Deve ter 10 ou 11 dígitos (DDD + número).")
+            # Linha do número na mensagem, contando a partir de 1
+            invalidos.append((2 * i + 2, numeros[i].strip()))
             continue
         if nome and numero_limpo:
-            if contato_existe(user_id, nome, numero_limpo):
+            chave = IndiceContatos.chave(nome, numero_limpo)
+            if chave in vistos or contato_existe(user_id, nome, numero_limpo):
                 contatos_duplicados.append((nome, numero_limpo))
             else:
-                novos_contatos.append((nome, numero_limpo))
+                vistos.add(chave)
+                novos_contatos.append(Contato.de_linha(nome, numero_limpo))
 
     if novos_contatos:
-        contatos_por_usuario[user_id]["contatos"].extend(novos_contatos)
-        salvar_contatos()
+        adicionar_contatos(user_id, novos_contatos)
         msg = f"✅ {len(novos_contatos)} contato(s) adicionados."
         if contatos_duplicados:
             msg += f"\n⚠️ {len(contatos_duplicados)} contato(s) já existiam e não foram adicionados."
         msg += "\nUse /arquivo para gerar o .vcf."
-        await update.message.reply_text(msg)
     else:
         msg = "❌ Nenhum contato válido foi adicionado."
         if contatos_duplicados:
             msg += f"\n⚠️ {len(contatos_duplicados)} contato(s) já existiam e não foram adicionados."
-        await update.message.reply_text(msg)
+    if invalidos:
+        msg += "\n\n" + relatorio_invalidos(invalidos)
+    await update.message.reply_text(msg)
 
 # ---------------- FIM DOS HANDLERS ---------------------
 
@@ -677,15 +3375,23 @@ def mostrar_menu_principal():
     print()
     print("1. Logout")
     print("2. Encerrar programa")
+    print("3. Reiniciar o bot")
     print()
     print("Digite o número da opção desejada:")
 
+class Recarregar(Exception):
+    # Levantada pelo SIGHUP para tirar o menu do input() e reiniciar o bot
+    pass
+
+def pedir_recarga(sig, frame):
+    raise Recarregar()
+
 def menu_principal_loop(bot_process):
+    # Devolve "logout" ou "reiniciar" para o supervisor; encerrar sai do programa aqui mesmo
     # Configurar handler para Ctrl+C
     def signal_handler(sig, frame):
         print("\n\nEncerrando o programa...")
-        bot_process.terminate()
-        bot_process.join()
+        parar_processo_bot(bot_process)
         sys.exit(0)
     
     signal.signal(signal.SIGINT, signal_handler)
@@ -697,48 +3403,510 @@ def menu_principal_loop(bot_process):
             
             if opcao == "1":
                 if remover_token():
-                    print("Token removido com sucesso! Reiniciando...")
+                    print("Token removido com sucesso!")
                     time.sleep(2)
-                    bot_process.terminate()
-                    bot_process.join()
-                    python = sys.executable
-                    os.execl(python, python, *sys.argv)
+                    return "logout"
                 else:
                     print("Erro ao remover token. Tente novamente.")
                     time.sleep(2)
             elif opcao == "2":
                 print("\nBot encerrado com sucesso, te espero em breve <3")
                 time.sleep(2)
-                bot_process.terminate()
-                bot_process.join()
+                parar_processo_bot(bot_process)
                 sys.exit(0)
+            elif opcao == "3":
+                print("Reiniciando o bot...")
+                return "reiniciar"
             else:
                 print("Opção inválida. Tente novamente.")
                 time.sleep(2)
+        except Recarregar:
+            logger.info("SIGHUP recebido: reiniciando o bot")
+            return "reiniciar"
         except KeyboardInterrupt:
             signal_handler(None, None)
         except Exception as e:
             print(f"Erro: {e}")
             time.sleep(2)
 
-def iniciar_bot(token):
-    global contatos_por_usuario
-    app = ApplicationBuilder().token(token).build()
-
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CommandHandler("ajuda", ajuda))
-    app.add_handler(CommandHandler("arquivo", arquivo))
-    app.add_handler(CommandHandler("listar", listar))
-    app.add_handler(CommandHandler("remover", remover))
-    app.add_handler(CommandHandler("editar", editar))
-    app.add_handler(CommandHandler("apagar", apagar))
-    app.add_handler(CallbackQueryHandler(callback_handler))
-    app.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), handle_message))
+def pedir_token():
+    mostrar_banner()
+    print("Adicione o token do seu bot do Telegram:")
+    while True:
+        token = input().strip()
+        if not token:
+            print("Token não pode estar vazio. Tente novamente:")
+            continue
+        if not token.count(":") > 0:
+            print("Token inválido. Formato esperado: 123456789:ABCdefGhIJKlmNoPQRsTUVwxyZ")
+            print("Digite novamente:")
+            continue
+        salvar_token(token)
+        print("✅ Token salvo com sucesso! :D")
+        time.sleep(2)
+        return token
+
+def executar_bot(token, opcoes, fila):
+    ligar_log(fila)
+    # O menu não atende usuários e fecha o armazenamento antes de criar o bot; como a
+    # leitura é preguiçosa por usuário, reabrir aqui é barato e a visão nunca envelhece
+    configurar_armazenamento()
+    # Os tratadores de sinal do menu não valem para o bot
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    iniciar_bot(token, opcoes)
+
+def parar_processo_bot(bot_process):
+    # SIGTERM: o bot termina o que está fazendo e grava os contatos antes de sair
+    bot_process.terminate()
+    bot_process.join()
+
+def supervisionar(opcoes):
+    # O processo do menu fica de pé com os módulos já importados e só troca o processo do
+    # bot: logout, troca de token e reinício não pagam de novo a partida do Python
+    # kill -HUP no processo do menu relê o token_salvo.txt e reinicia o bot
+    recarga = hasattr(signal, "SIGHUP")
+    token = carregar_token() or pedir_token()
+    # Nada do menu fica aberto: no Windows o mapa do snapshot impediria o bot de compactá-lo,
+    # e as conexões do SQLite não atravessam o fork
+    armazenamento.fechar()
+    while True:
+        bot_process = Process(target=executar_bot, args=(token, opcoes, fila_log))
+        bot_process.start()
+        try:
+            if recarga:
+                signal.signal(signal.SIGHUP, pedir_recarga)
+            acao = menu_principal_loop(bot_process)
+        except Recarregar:
+            # SIGHUP fora do input() (ex.: durante uma mensagem na tela)
+            acao = "reiniciar"
+        finally:
+            # Pedindo token ou parando o bot, um SIGHUP não tem o que interromper
+            if recarga:
+                signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        parar_processo_bot(bot_process)
+        if acao == "logout":
+            token = pedir_token()
+        else:
+            token = carregar_token() or pedir_token()
+
+# ------------------- MODO WEBHOOK -------------------
+
+# Tamanho máximo aceito para o corpo de uma requisição do webhook
+LIMITE_CORPO_WEBHOOK = 1024 * 1024
+
+class CorpoGrandeDemais(ValueError):
+    pass
+
+async def ler_requisicao_http(reader):
+    # ValueError para requisição malformada (400); CorpoGrandeDemais acima do limite (413)
+    linha = await reader.readline()
+    if not linha:
+        return None
+    partes = linha.decode('latin-1').split(' ', 2)
+    if len(partes) != 3:
+        raise ValueError(f"Linha de requisição inválida: {linha[:100]!r}")
+    metodo, caminho, _ = partes
+    cabecalhos = {}
+    while True:
+        linha = await reader.readline()
+        if linha in (b'\r\n', b'\n', b''):
+            break
+        nome, _, valor = linha.decode('latin-1').partition(':')
+        cabecalhos[nome.strip().lower()] = valor.strip()
+    tamanho = int(cabecalhos.get('content-length', 0))
+    if tamanho < 0:
+        raise ValueError(f"Content-Length inválido: {tamanho}")
+    if tamanho > LIMITE_CORPO_WEBHOOK:
+        raise CorpoGrandeDemais(f"Corpo grande demais: {tamanho} bytes")
+    corpo = await reader.readexactly(tamanho) if tamanho else b''
+    return metodo, caminho, cabecalhos, corpo
+
+def resposta_http(status, corpo=b'', tipo='text/plain; charset=utf-8', extras=()):
+    motivos = {200: "OK", 401: "Unauthorized", 404: "Not Found", 400: "Bad Request", 413: "Payload Too Large", 503: "Service Unavailable"}
+    linhas = [f"HTTP/1.1 {status} {motivos.get(status, '')}", f"Content-Type: {tipo}", f"Content-Length: {len(corpo)}"]
+    linhas.extend(extras)
+    return ("\r\n".join(linhas) + "\r\n\r\n").encode('latin-1') + corpo
+
+class ServidorWebhook:
+    # Servidor HTTP mínimo (asyncio puro) que recebe os updates do Telegram.
+    # Os updates entram numa fila limitada; quando ela enche, o servidor responde 503
+    # e o Telegram reenvia depois, em vez de o bot acumular memória sem limite.
+    # processar recebe o JSON de cada update: no modo normal entrega à Application,
+    # no modo com shards repassa ao processo do shard.
+    def __init__(self, processar, host, porta, caminho, segredo=None, concorrencia=1, tamanho_fila=1000):
+        self.processar = processar
+        self.host = host
+        self.porta = porta
+        self.caminho = caminho
+        self.segredo = segredo
+        self.concorrencia = concorrencia
+        self.tamanho_fila = tamanho_fila
+        self.fila = None
+        self.servidor = None
+        self.trabalhadores = []
+
+    async def iniciar(self):
+        self.fila = asyncio.Queue(maxsize=self.tamanho_fila)
+        self.trabalhadores = [asyncio.create_task(self._consumir()) for _ in range(self.concorrencia)]
+        self.servidor = await asyncio.start_server(self._atender, self.host, self.porta)
+
+    async def parar(self):
+        if self.servidor is not None:
+            self.servidor.close()
+            await self.servidor.wait_closed()
+        # Processa o que já foi aceito antes de encerrar
+        await self.fila.join()
+        for tarefa in self.trabalhadores:
+            tarefa.cancel()
+        await asyncio.gather(*self.trabalhadores, return_exceptions=True)
+
+    async def _atender(self, reader, writer):
+        try:
+            while True:
+                try:
+                    requisicao = await ler_requisicao_http(reader)
+                except CorpoGrandeDemais:
+                    writer.write(resposta_http(413))
+                    break
+                except ValueError:
+                    writer.write(resposta_http(400))
+                    break
+                if requisicao is None:
+                    break
+                metodo, caminho, cabecalhos, corpo = requisicao
+                writer.write(self._responder(metodo, caminho.split('?', 1)[0], cabecalhos, corpo))
+                await writer.drain()
+                if cabecalhos.get('connection', '').lower() == 'close':
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception as e:
+            logger.error(f"Erro no servidor webhook: {e}")
+        finally:
+            writer.close()
+
+    def _responder(self, metodo, caminho, cabecalhos, corpo):
+        if metodo == "GET" and caminho == "/saude":
+            return resposta_http(200, f"ok fila={self.fila.qsize()}".encode())
+        if metodo != "POST" or caminho != self.caminho:
+            return resposta_http(404)
+        if self.segredo and cabecalhos.get('x-telegram-bot-api-secret-token') != self.segredo:
+            return resposta_http(401)
+        try:
+            dados = json.loads(corpo)
+        except ValueError:
+            return resposta_http(400)
+        try:
+            self.fila.put_nowait(dados)
+        except asyncio.QueueFull:
+            return resposta_http(503, extras=("Retry-After: 1",))
+        return resposta_http(200)
+
+    async def _consumir(self):
+        while True:
+            dados = await self.fila.get()
+            try:
+                await self.processar(dados)
+            except Exception as e:
+                logger.error(f"Erro ao processar update do webhook: {e}")
+            finally:
+                self.fila.task_done()
+
+def evento_de_parada():
+    # SIGINT (Ctrl+C) ou SIGTERM (menu encerrando o processo) pedem um encerramento limpo
+    parar = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sinal in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sinal, parar.set)
+    return parar
+
+async def servir_webhook(bot, processar, opcoes, concorrencia):
+    caminho = urlparse(opcoes.webhook).path or "/webhook"
+    servidor = ServidorWebhook(
+        processar, opcoes.host, opcoes.porta, caminho,
+        segredo=opcoes.segredo, concorrencia=concorrencia, tamanho_fila=opcoes.fila
+    )
+    parar = evento_de_parada()
+    await servidor.iniciar()
+    try:
+        await bot.set_webhook(
+            url=opcoes.webhook,
+            secret_token=opcoes.segredo,
+            max_connections=max(1, min(100, opcoes.concorrencia * 4))
+        )
+        logger.info(f"Webhook ativo em {opcoes.host}:{opcoes.porta}{caminho}")
+        await parar.wait()
+    finally:
+        await servidor.parar()
 
+async def executar_webhook(app, opcoes):
+    async def processar(dados):
+        await app.process_update(Update.de_json(dados, app.bot))
+
+    await app.initialize()
+    await app.start()
+    try:
+        await servir_webhook(app.bot, processar, opcoes, opcoes.concorrencia)
+    finally:
+        await app.stop()
+        await app.shutdown()
+
+# ------------------- MODO COM SHARDS -------------------
+
+def shard_do_usuario(user_id, total):
+    return user_id % total
+
+def user_id_do_update(dados):
+    # Lido direto do JSON, sem montar o Update: todo tipo de update traz um único objeto
+    # no primeiro nível, com o remetente em "from" (ou "user") ou ao menos um "chat"
+    for valor in dados.values():
+        if isinstance(valor, dict):
+            remetente = valor.get("from") or valor.get("user") or valor.get("chat")
+            if remetente:
+                return remetente.get("id", 0)
+    return 0
+
+def ler_layout_shards():
+    try:
+        with open(ARQUIVO_SHARDS, 'r') as f:
+            return json.load(f).get("shards", 0)
+    except FileNotFoundError:
+        return 0
+    except Exception as e:
+        logger.error(f"Erro ao ler {ARQUIVO_SHARDS}: {e}")
+        return 0
+
+def redistribuir_shards(total):
+    # Reparte os dados entre os arquivos de cada shard quando a quantidade muda
+    # (inclusive ao voltar para o arquivo único, total 0). Os arquivos novos são gravados
+    # antes de o layout mudar: uma queda no meio só faz a redistribuição rodar de novo.
+    atual = ler_layout_shards()
+    if atual == total:
+        return False
+    origens = [criar_armazenamento(shard=i) for i in range(atual)] if atual else [armazenamento]
+    usuarios = {}
+    for origem in origens:
+        usuarios.update(origem.exportar_usuarios())
+    if total:
+        for i in range(total):
+            criar_armazenamento(shard=i).importar_usuarios({
+                user_id: usuario for user_id, usuario in usuarios.items()
+                if shard_do_usuario(user_id, total) == i
+            })
+    else:
+        armazenamento.importar_usuarios(usuarios)
+    temporario = ARQUIVO_SHARDS + '.tmp'
+    with open(temporario, 'w') as f:
+        json.dump({"shards": total}, f)
+    os.replace(temporario, ARQUIVO_SHARDS)
+    logger.info(f"Dados de {len(usuarios)} usuários redistribuídos de {atual} para {total} shards")
+    return True
+
+def configurar_armazenamento(shard=None):
+    # Troca o backend global e recarrega os usuários (cada shard abre os próprios arquivos)
+    global armazenamento, contatos_por_usuario, contatos_em_memoria
+    armazenamento = criar_armazenamento(shard=shard)
+    contatos_por_usuario = OrderedDict(carregar_contatos())
+    contatos_em_memoria = sum(len(u["contatos"]) for u in contatos_por_usuario.values())
+    sessoes_usuarios.arquivo = arquivo_do_shard(ARQUIVO_SESSOES, shard) if ARQUIVO_SESSOES else ""
+    sessoes_usuarios.carregar()
+    indices_por_usuario.clear()
+    versoes_por_usuario.clear()
+
+async def consumir_shard(app, fila, concorrencia):
+    loop = asyncio.get_running_loop()
+    # SIGTERM direto no shard encerra do mesmo jeito que o aviso do processo da frente
+    loop.add_signal_handler(signal.SIGTERM, fila.put_nowait, None)
+    vagas = asyncio.Semaphore(concorrencia)
+    tarefas = set()
+
+    async def processar(dados):
+        try:
+            await app.process_update(Update.de_json(dados, app.bot))
+        except Exception as e:
+            logger.error(f"Erro ao processar update no shard: {e}")
+        finally:
+            vagas.release()
+
+    await app.initialize()
+    await app.start()
+    try:
+        while True:
+            dados = await loop.run_in_executor(None, fila.get)
+            if dados is None:
+                break
+            # Os updates saem da fila em ordem; a trava de cada usuário mantém essa ordem
+            await vagas.acquire()
+            tarefa = asyncio.create_task(processar(dados))
+            tarefas.add(tarefa)
+            tarefa.add_done_callback(tarefas.discard)
+        await asyncio.gather(*tarefas)
+    finally:
+        await app.stop()
+        await app.shutdown()
+
+def executar_shard(token, opcoes, indice, fila, fila_do_log):
+    ligar_log(fila_do_log)
+    # Ctrl+C chega a todo o grupo de processos; quem coordena o encerramento é a frente
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    configurar_armazenamento(indice)
+    app = montar_aplicacao(token, opcoes, com_updater=False)
+    if opcoes.metricas_porta is not None:
+        # Cada shard mede só os próprios usuários e responde na porta seguinte
+        iniciar_servidor_metricas(opcoes.host, opcoes.metricas_porta + indice)
+    armazenamento.iniciar()
+    logger.info(f"Shard {indice} iniciado (pid {os.getpid()})")
+    try:
+        asyncio.run(consumir_shard(app, fila, opcoes.concorrencia))
+    except Exception as e:
+        logger.error(f"Erro no shard {indice}: {e}")
+    finally:
+        salvar_contatos()
+        armazenamento.parar()
+        sessoes_usuarios.salvar()
+        logger.info(f"Shard {indice} encerrado")
+
+async def despachar_update(filas, dados):
+    fila = filas[shard_do_usuario(user_id_do_update(dados), len(filas))]
+    try:
+        fila.put_nowait(dados)
+    except queue.Full:
+        # Shard atrasado: segura a frente (e, no webhook, a fila dela) até abrir espaço
+        await asyncio.get_running_loop().run_in_executor(None, fila.put, dados)
+
+async def receber_por_polling(bot, despachar):
+    await bot.delete_webhook()
+    offset = None
+    try:
+        while True:
+            try:
+                updates = await bot.get_updates(offset=offset, timeout=10, allowed_updates=Update.ALL_TYPES)
+            except Exception as e:
+                logger.error(f"Erro ao buscar updates: {e}")
+                await asyncio.sleep(1)
+                continue
+            for update in updates:
+                await despachar(update.to_dict())
+                offset = update.update_id + 1
+    except asyncio.CancelledError:
+        # O offset só é confirmado na chamada seguinte: sem esta, o Telegram reentregaria
+        # na próxima partida os updates já repassados aos shards
+        if offset is not None:
+            try:
+                await bot.get_updates(offset=offset, timeout=0)
+            except Exception as e:
+                logger.error(f"Erro ao confirmar updates: {e}")
+        raise
+
+async def receber_updates(token, opcoes, filas):
+    if opcoes.api_url:
+        bot = Bot(token, base_url=f"{opcoes.api_url}/bot", base_file_url=f"{opcoes.api_url}/file/bot")
+    else:
+        bot = Bot(token)
+    despachar = functools.partial(despachar_update, filas)
+    async with bot:
+        if opcoes.webhook:
+            # Um único consumidor: repassar é barato e preserva a ordem de chegada
+            await servir_webhook(bot, despachar, opcoes, 1)
+        else:
+            parar = evento_de_parada()
+            recebendo = asyncio.create_task(receber_por_polling(bot, despachar))
+            await parar.wait()
+            recebendo.cancel()
+            await asyncio.gather(recebendo, return_exceptions=True)
+
+def iniciar_shards(token, opcoes):
+    # Processo da frente: recebe os updates e reparte por user_id entre os processos dos
+    # shards, cada um com seus usuários, seus arquivos e seu próprio núcleo
+    redistribuir_shards(opcoes.shards)
+    filas = [Queue(maxsize=opcoes.fila) for _ in range(opcoes.shards)]
+    shards = [
+        Process(target=executar_shard, args=(token, opcoes, i, fila, fila_log), name=f"savecnt-shard{i}")
+        for i, fila in enumerate(filas)
+    ]
+    for shard in shards:
+        shard.start()
+    logger.info(f"Bot iniciado com {opcoes.shards} shards")
+    print(f"🤖 Bot rodando em {opcoes.shards} processos... Pressione Ctrl+C para voltar ao menu.")
+    try:
+        asyncio.run(receber_updates(token, opcoes, filas))
+    except KeyboardInterrupt:
+        logger.info("Bot interrompido pelo usuário")
+    except Exception as e:
+        logger.error(f"Erro ao receber updates: {e}")
+        print(f"❌ Erro: {e}")
+    finally:
+        # Cada shard termina o que já recebeu, grava e sai
+        for fila in filas:
+            fila.put(None)
+        for shard in shards:
+            shard.join(PRAZO_ENCERRAMENTO_SHARD)
+            if shard.is_alive():
+                logger.warning(f"{shard.name} não encerrou a tempo; forçando")
+                shard.terminate()
+                shard.join()
+
+def montar_aplicacao(token, opcoes, com_updater=True):
+    construtor = ApplicationBuilder().token(token)
+    if opcoes.api_url:
+        # Permite apontar para um servidor falso do Telegram em testes de carga
+        construtor = construtor.base_url(f"{opcoes.api_url}/bot").base_file_url(f"{opcoes.api_url}/file/bot")
+    if not com_updater:
+        # Nos shards quem busca os updates é o processo da frente
+        construtor = construtor.updater(None)
+    metricas.ativo = opcoes.metricas or opcoes.metricas_porta is not None
+    if not opcoes.sem_limite_envios:
+        # O limite global do Telegram vale para o bot todo: cada shard fica com a sua parte
+        limitador = LimitadorEnvios(por_segundo=LIMITE_ENVIOS_GLOBAL / max(1, opcoes.shards))
+        construtor = construtor.rate_limiter(limitador)
+        metricas.limitador = limitador
+    # Updates concorrentes são seguros porque todo handler passa pela trava do usuário
+    app = construtor.concurrent_updates(opcoes.concorrencia).build()
+    app.bot_data["admins"] = set(opcoes.admin)
+
+    def handler(funcao, rotulo=None):
+        # Com as métricas desligadas o handler é registrado como está, sem custo nenhum
+        if metricas.ativo:
+            funcao = instrumentar(funcao.__name__, funcao, rotulo)
+        return por_usuario(funcao)
+
+    app.add_handler(CommandHandler("start", handler(start)))
+    app.add_handler(CommandHandler("ajuda", handler(ajuda)))
+    app.add_handler(CommandHandler("arquivo", handler(arquivo)))
+    app.add_handler(CommandHandler("listar", handler(listar)))
+    app.add_handler(CommandHandler("remover", handler(remover)))
+    app.add_handler(CommandHandler("editar", handler(editar)))
+    app.add_handler(CommandHandler("apagar", handler(apagar)))
+    app.add_handler(CommandHandler("duplicados", handler(duplicados)))
+    app.add_handler(CommandHandler("stats", por_usuario(stats)))
+    app.add_handler(CallbackQueryHandler(handler(callback_handler, tipo_callback)))
+    app.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), handler(handle_message)))
+    app.add_handler(MessageHandler(filters.Document.ALL, handler(importar_documento)))
+    return app
+
+def iniciar_bot(token, opcoes=None):
+    global contatos_por_usuario
+    opcoes = opcoes or ler_argumentos([])
+    if opcoes.shards > 1:
+        iniciar_shards(token, opcoes)
+        return
+    if redistribuir_shards(0):
+        # Dados vinham de uma execução com shards: junta tudo de volta no arquivo único
+        configurar_armazenamento()
+    app = montar_aplicacao(token, opcoes)
+    if opcoes.metricas_porta is not None:
+        iniciar_servidor_metricas(opcoes.host, opcoes.metricas_porta)
+
+    armazenamento.iniciar()
     logger.info("Bot iniciado com sucesso!")
     print("🤖 Bot rodando... Pressione Ctrl+C para voltar ao menu.")
     try:
-        app.run_polling()
+        if opcoes.webhook:
+            asyncio.run(executar_webhook(app, opcoes))
+        else:
+            app.run_polling()
     except KeyboardInterrupt:
         logger.info("Bot interrompido pelo usuário")
         print("👋 Retornando ao menu principal...")
@@ -747,31 +3915,39 @@ def iniciar_bot(token):
         print(f"❌ Erro: {e}")
     finally:
         salvar_contatos()
+        armazenamento.parar()
+        sessoes_usuarios.salvar()
+
+def ler_argumentos(argv=None):
+    parser = argparse.ArgumentParser(description="SAVECNT – Bot de Contatos para Telegram")
+    parser.add_argument("--webhook", metavar="URL",
+                        help="recebe updates por webhook nesta URL pública em vez de long polling")
+    parser.add_argument("--host", default="0.0.0.0", help="endereço local do servidor webhook")
+    parser.add_argument("--porta", type=int, default=8443, help="porta local do servidor webhook")
+    parser.add_argument("--segredo", help="secret token conferido em cada requisição do webhook")
+    parser.add_argument("--concorrencia", type=int, default=8,
+                        help="quantidade de updates processados ao mesmo tempo; usuários diferentes "
+                             "rodam em paralelo e os updates de um mesmo usuário, sempre em ordem")
+    parser.add_argument("--fila", type=int, default=1000,
+                        help="tamanho máximo da fila de updates do webhook antes de recusar (503)")
+    parser.add_argument("--api-url", help="URL base da Bot API (ex.: servidor falso do telegram_falso.py)")
+    parser.add_argument("--sem-limite-envios", action="store_true",
+                        help="não limita a taxa de envio ao Telegram (para testes de carga com servidor falso)")
+    parser.add_argument("--shards", type=int, default=0,
+                        help="quantidade de processos que atendem os usuários, repartidos por user_id "
+                             "(0 ou 1: um único processo)")
+    parser.add_argument("--metricas", action="store_true",
+                        help="mede handlers, exportações e gravações; os números saem no /stats")
+    parser.add_argument("--metricas-porta", type=int, metavar="PORTA",
+                        help="expõe as métricas no formato do Prometheus em http://HOST:PORTA/metrics "
+                             "(com shards, um por porta a partir desta); implica --metricas")
+    parser.add_argument("--admin", type=int, action="append", default=[], metavar="USER_ID",
+                        help="user_id do Telegram que pode usar /stats (pode repetir)")
+    return parser.parse_args(argv)
 
 def main():
-    token_salvo = carregar_token()
-    if token_salvo:
-        bot_process = Process(target=iniciar_bot, args=(token_salvo,))
-        bot_process.start()
-        menu_principal_loop(bot_process)
-    else:
-        mostrar_banner()
-        print("Adicione o token do seu bot do Telegram:")
-        while True:
-            token = input().strip()
-            if not token:
-                print("Token não pode estar vazio. Tente novamente:")
-                continue
-            if not token.count(":") > 0:
-                print("Token inválido. Formato esperado: 123456789:ABCdefGhIJKlmNoPQRsTUVwxyZ")
-                print("Digite novamente:")
-                continue
-            salvar_token(token)
-            print("✅ Token salvo com sucesso! :D")
-            time.sleep(2)
-            break
-        python = sys.executable
-        os.execl(python, python, *sys.argv)
+    opcoes = ler_argumentos()
+    supervisionar(opcoes)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,225 @@
+import argparse
+import asyncio
+import itertools
+import json
+import re
+import statistics
+import time
+from urllib.parse import parse_qs, urlparse
+
+# Servidor falso da Bot API do Telegram, para medir o SAVECNT localmente sem rede.
+#
+# Uso:
+#   python telegram_falso.py --porta 8081
+#   python savecnt.py --webhook http://127.0.0.1:8443/webhook --api-url http://127.0.0.1:8081
+#   python telegram_falso.py --porta 8081 --disparar http://127.0.0.1:8443/webhook --updates 5000
+#
+# Com --disparar, o próprio script envia updates sintéticos ao webhook do bot e mede
+# quanto tempo cada um leva até o bot responder (sendMessage/sendDocument para o mesmo chat).
+
+ids_mensagem = itertools.count(1)
+# Para cada chat, os instantes em que updates foram disparados e ainda não tiveram resposta
+pendentes_por_chat = {}
+latencias = []
+respostas = 0
+
+
+async def ler_requisicao(reader):
+    linha = await reader.readline()
+    if not linha:
+        return None
+    metodo, caminho, _ = linha.decode('latin-1').split(' ', 2)
+    cabecalhos = {}
+    while True:
+        linha = await reader.readline()
+        if linha in (b'\r\n', b'\n', b''):
+            break
+        nome, _, valor = linha.decode('latin-1').partition(':')
+        cabecalhos[nome.strip().lower()] = valor.strip()
+    tamanho = int(cabecalhos.get('content-length', 0))
+    corpo = await reader.readexactly(tamanho) if tamanho else b''
+    return metodo, caminho, cabecalhos, corpo
+
+
+def ler_parametros(cabecalhos, corpo):
+    tipo = cabecalhos.get('content-type', '')
+    if 'json' in tipo:
+        return json.loads(corpo or b'{}')
+    if 'multipart' in tipo:
+        # Só os campos simples interessam aqui (chat_id, text...); arquivos são ignorados
+        campos = re.findall(rb'name="([^"]+)"\r\n\r\n(.*?)\r\n--', corpo, re.S)
+        return {nome.decode(): valor.decode('utf-8', 'replace') for nome, valor in campos}
+    return {k: v[0] for k, v in parse_qs(corpo.decode('utf-8')).items()}
+
+
+def mensagem(chat_id, **extras):
+    return {
+        "message_id": next(ids_mensagem),
+        "date": int(time.time()),
+        "chat": {"id": int(chat_id), "type": "private"},
+        **extras,
+    }
+
+
+def registrar_resposta(chat_id):
+    global respostas
+    respostas += 1
+    pendentes = pendentes_por_chat.get(int(chat_id))
+    if pendentes:
+        latencias.append(time.perf_counter() - pendentes.pop(0))
+
+
+def resultado(metodo, parametros):
+    chat_id = parametros.get("chat_id", 0)
+    if metodo == "getMe":
+        return {"id": 1, "is_bot": True, "first_name": "SAVECNT", "username": "savecnt_falso_bot"}
+    if metodo == "sendMessage":
+        registrar_resposta(chat_id)
+        return mensagem(chat_id, text=parametros.get("text", ""))
+    if metodo == "sendDocument":
+        registrar_resposta(chat_id)
+        n = next(ids_mensagem)
+        return mensagem(chat_id, document={"file_id": f"doc{n}", "file_unique_id": f"u{n}"})
+    if metodo == "sendMediaGroup":
+        registrar_resposta(chat_id)
+        return [
+            mensagem(chat_id, document={"file_id": f"doc{n}", "file_unique_id": f"u{n}"})
+            for n in (next(ids_mensagem) for _ in range(3))
+        ]
+    if metodo == "editMessageText":
+        registrar_resposta(chat_id)
+        return mensagem(chat_id, text=parametros.get("text", ""))
+    return True
+
+
+async def atender(reader, writer):
+    try:
+        while True:
+            requisicao = await ler_requisicao(reader)
+            if requisicao is None:
+                break
+            metodo_http, caminho, cabecalhos, corpo = requisicao
+            metodo = urlparse(caminho).path.rsplit('/', 1)[-1]
+            parametros = ler_parametros(cabecalhos, corpo)
+            if metodo == "getUpdates":
+                # Long polling sem updates: segura um pouco, como o Telegram faz
+                await asyncio.sleep(min(float(parametros.get("timeout", 0) or 0), 1.0))
+                dados = {"ok": True, "result": []}
+            else:
+                dados = {"ok": True, "result": resultado(metodo, parametros)}
+            corpo_resposta = json.dumps(dados).encode('utf-8')
+            writer.write(
+                b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                + f"Content-Length: {len(corpo_resposta)}\r\n\r\n".encode('latin-1')
+                + corpo_resposta
+            )
+            await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+        pass
+    finally:
+        writer.close()
+
+
+def update_sintetico(update_id, user_id, i):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"Usuario {user_id}"},
+            "text": f"Contato {i} - Teste\n8299{i % 10000000:07d}",
+        },
+    }
+
+
+async def enviar_update(url, dados):
+    alvo = urlparse(url)
+    reader, writer = await asyncio.open_connection(alvo.hostname, alvo.port or 80)
+    corpo = json.dumps(dados).encode('utf-8')
+    writer.write(
+        f"POST {alvo.path or '/'} HTTP/1.1\r\nHost: {alvo.hostname}\r\n"
+        f"Content-Type: application/json\r\nContent-Length: {len(corpo)}\r\nConnection: close\r\n\r\n".encode('latin-1')
+        + corpo
+    )
+    await writer.drain()
+    status = await reader.readline()
+    writer.close()
+    return status.split()[1] if status else b"000"
+
+
+async def aguardar_bot(url, limite=60):
+    # O bot só sobe depois que este servidor responde ao getMe; espera o webhook dele ficar pronto
+    alvo = urlparse(url)
+    prazo = time.monotonic() + limite
+    while time.monotonic() < prazo:
+        try:
+            reader, writer = await asyncio.open_connection(alvo.hostname, alvo.port or 80)
+            writer.write(b"GET /saude HTTP/1.1\r\nConnection: close\r\n\r\n")
+            await writer.drain()
+            status = await reader.readline()
+            writer.close()
+            if b" 200 " in status:
+                return True
+        except OSError:
+            pass
+        await asyncio.sleep(0.2)
+    return False
+
+
+async def disparar(url, total, usuarios, paralelos):
+    if not await aguardar_bot(url):
+        print(f"Webhook {url} não respondeu.")
+        return
+    recusados = 0
+    fila = asyncio.Queue()
+    for i in range(total):
+        fila.put_nowait(i)
+
+    async def enviar():
+        nonlocal recusados
+        while not fila.empty():
+            i = fila.get_nowait()
+            user_id = 1000 + i % usuarios
+            pendentes_por_chat.setdefault(user_id, []).append(time.perf_counter())
+            status = await enviar_update(url, update_sintetico(i + 1, user_id, i))
+            if status != b"200":
+                recusados += 1
+                pendentes_por_chat[user_id].pop()
+
+    inicio = time.perf_counter()
+    await asyncio.gather(*(enviar() for _ in range(paralelos)))
+    while respostas < total - recusados and time.perf_counter() - inicio < 300:
+        await asyncio.sleep(0.05)
+    duracao = time.perf_counter() - inicio
+    ordenadas = sorted(latencias)
+    print(json.dumps({
+        "updates": total,
+        "recusados_503": recusados,
+        "respostas": respostas,
+        "duracao_s": round(duracao, 3),
+        "updates_por_s": round((total - recusados) / duracao, 1),
+        "latencia_p50_ms": round(statistics.median(ordenadas) * 1000, 2) if ordenadas else None,
+        "latencia_p99_ms": round(ordenadas[int(len(ordenadas) * 0.99) - 1] * 1000, 2) if ordenadas else None,
+    }, indent=2))
+
+
+async def principal(opcoes):
+    servidor = await asyncio.start_server(atender, opcoes.host, opcoes.porta)
+    print(f"Telegram falso ouvindo em http://{opcoes.host}:{opcoes.porta}")
+    async with servidor:
+        if opcoes.disparar:
+            await disparar(opcoes.disparar, opcoes.updates, opcoes.usuarios, opcoes.paralelos)
+        else:
+            await servidor.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Servidor falso da Bot API para testes de carga do SAVECNT")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--porta", type=int, default=8081)
+    parser.add_argument("--disparar", metavar="URL_WEBHOOK", help="envia updates sintéticos para o webhook do bot")
+    parser.add_argument("--updates", type=int, default=1000, help="quantidade de updates a disparar")
+    parser.add_argument("--usuarios", type=int, default=100, help="quantidade de usuários diferentes")
+    parser.add_argument("--paralelos", type=int, default=32, help="requisições simultâneas ao webhook")
+    asyncio.run(principal(parser.parse_args()))
@@ -0,0 +1,28 @@
+import os
+import sys
+import tempfile
+from collections import OrderedDict
+
+import pytest
+
+# O savecnt abre o armazenamento e o log no diretório atual já na importação:
+# os testes rodam num diretório temporário, longe dos arquivos de verdade
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+os.environ.setdefault("SAVECNT_ARQUIVO_SESSOES", "")
+os.chdir(tempfile.mkdtemp(prefix="savecnt-testes-"))
+
+
+@pytest.fixture
+def usuarios_isolados(tmp_path, monkeypatch):
+    # Usuários, índices e sessões só do teste, num armazenamento próprio
+    import savecnt
+    armazenamento = savecnt.ArmazenamentoPickle(str(tmp_path / "contatos.pkl"), str(tmp_path / "contatos.log"))
+    armazenamento.carregar()
+    monkeypatch.setattr(savecnt, "armazenamento", armazenamento)
+    monkeypatch.setattr(savecnt, "contatos_por_usuario", OrderedDict())
+    monkeypatch.setattr(savecnt, "contatos_em_memoria", 0)
+    monkeypatch.setattr(savecnt, "indices_por_usuario", {})
+    monkeypatch.setattr(savecnt, "versoes_por_usuario", {})
+    monkeypatch.setattr(savecnt, "sessoes_usuarios", savecnt.SessoesUsuarios(arquivo=""))
+    return armazenamento
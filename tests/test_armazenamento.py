@@ -0,0 +1,374 @@
+import os
+import pickle
+import random
+import struct
+import sys
+import threading
+from collections import OrderedDict
+
+import pytest
+
+import savecnt
+
+
+def abrir_pickle(diretorio, nome="contatos_salvos"):
+    armazenamento = savecnt.ArmazenamentoPickle(str(diretorio / f"{nome}.pkl"), str(diretorio / f"{nome}.log"))
+    armazenamento.carregar()
+    return armazenamento
+
+
+def contatos(*linhas):
+    return [savecnt.Contato.de_linha(linha, f"8299111{i:04d}") for i, linha in enumerate(linhas)]
+
+
+def resumo(usuario):
+    return [(c.nome, c.categoria, c.numero) for c in usuario["contatos"]]
+
+
+def exportados(armazenamento):
+    # Usuários que ficaram com a lista vazia podem ou não existir, conforme o backend
+    return {
+        user_id: resumo(usuario)
+        for user_id, usuario in armazenamento.exportar_usuarios().items() if usuario["contatos"]
+    }
+
+
+def gravar_journal(caminho, registros):
+    with open(caminho, 'ab') as f:
+        for registro in registros:
+            f.write(pickle.dumps(registro, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+def inverter_byte(caminho, posicao):
+    with open(caminho, 'r+b') as f:
+        f.seek(posicao)
+        byte = f.read(1)
+        f.seek(posicao)
+        f.write(bytes([byte[0] ^ 0xFF]))
+
+
+# ------------------- JOURNAL -------------------
+
+def test_journal_reaplicado_na_partida(tmp_path):
+    armazenamento = abrir_pickle(tmp_path)
+    armazenamento.registrar(1, "adicionar", contatos("Ana - Casa", "Bia"), {})
+    armazenamento.registrar(1, "editar", (0, savecnt.Contato("Ana Maria", "Casa", "82991110000")), {})
+    armazenamento.registrar(2, "adicionar", contatos("Caio - Trabalho"), {})
+    armazenamento.registrar(1, "remover", [1], {})
+    armazenamento.registrar(2, "estado", {"ordenacao": "alfabetica"}, {})
+
+    reaberto = abrir_pickle(tmp_path)
+    assert resumo(reaberto.carregar_usuario(1)) == [("Ana Maria", "Casa", "82991110000")]
+    assert resumo(reaberto.carregar_usuario(2)) == [("Caio", "Trabalho", "82991110000")]
+    assert reaberto.carregar_usuario(2)["ordenacao"] == "alfabetica"
+    assert reaberto.carregar_usuario(3) is None
+
+
+def test_journal_depois_da_compactacao(tmp_path):
+    armazenamento = abrir_pickle(tmp_path)
+    armazenamento.registrar(1, "adicionar", contatos("Ana", "Bia"), {})
+    armazenamento.salvar({})
+    assert os.path.getsize(armazenamento.journal) == 0
+    armazenamento.registrar(1, "adicionar", contatos("Caio"), {})
+    armazenamento.registrar(1, "remover", [0], {})
+
+    reaberto = abrir_pickle(tmp_path)
+    assert [nome for nome, _, _ in resumo(reaberto.carregar_usuario(1))] == ["Bia", "Caio"]
+    assert reaberto.seq == armazenamento.seq
+
+
+def test_journal_com_final_incompleto(tmp_path):
+    armazenamento = abrir_pickle(tmp_path)
+    armazenamento.registrar(1, "adicionar", contatos("Ana"), {})
+    tamanho = os.path.getsize(armazenamento.journal)
+    # Queda no meio da escrita do registro seguinte
+    with open(armazenamento.journal, 'ab') as f:
+        f.write(pickle.dumps((2, 1, "adicionar", contatos("Bia")))[:-5])
+
+    reaberto = abrir_pickle(tmp_path)
+    assert [nome for nome, _, _ in resumo(reaberto.carregar_usuario(1))] == ["Ana"]
+    assert os.path.getsize(armazenamento.journal) == tamanho
+
+
+def rodando_como_script(monkeypatch):
+    # "python savecnt.py": a classe Contato mora no módulo __main__
+    monkeypatch.setattr(savecnt.Contato, "__module__", "__main__")
+    monkeypatch.setattr(sys.modules["__main__"], "Contato", savecnt.Contato, raising=False)
+
+
+def test_journal_sem_referencia_a_classe(tmp_path, monkeypatch):
+    rodando_como_script(monkeypatch)
+    armazenamento = abrir_pickle(tmp_path)
+    armazenamento.registrar(1, "adicionar", contatos("Ana - Casa"), {})
+    armazenamento.registrar(1, "editar", (0, savecnt.Contato("Ana Maria", "Casa", "82991110000")), {})
+    monkeypatch.undo()
+
+    with open(armazenamento.journal, 'rb') as f:
+        gravado = f.read()
+    assert b"Contato" not in gravado and b"__main__" not in gravado
+    reaberto = abrir_pickle(tmp_path)
+    assert resumo(reaberto.carregar_usuario(1)) == [("Ana Maria", "Casa", "82991110000")]
+
+
+def test_journal_antigo_gravado_pelo_script(tmp_path, monkeypatch):
+    # Journals de versões anteriores guardam __main__.Contato e continuam legíveis importando
+    rodando_como_script(monkeypatch)
+    gravar_journal(tmp_path / "contatos_salvos.log", [
+        (1, 1, "adicionar", contatos("Ana - Casa", "Bia")),
+        (2, 1, "editar", (1, savecnt.Contato("Bia", "Trabalho", "82991110001"))),
+    ])
+    monkeypatch.undo()
+    tamanho = os.path.getsize(tmp_path / "contatos_salvos.log")
+
+    reaberto = abrir_pickle(tmp_path)
+    assert resumo(reaberto.carregar_usuario(1)) == [
+        ("Ana", "Casa", "82991110000"), ("Bia", "Trabalho", "82991110001"),
+    ]
+    assert os.path.getsize(reaberto.journal) == tamanho
+
+
+def test_registro_corrompido_no_meio_impede_a_partida(tmp_path):
+    armazenamento = abrir_pickle(tmp_path)
+    armazenamento.registrar(1, "adicionar", contatos("Ana"), {})
+    meio = os.path.getsize(armazenamento.journal)
+    armazenamento.registrar(1, "adicionar", contatos("Bia"), {})
+    armazenamento.registrar(1, "adicionar", contatos("Caio"), {})
+    tamanho = os.path.getsize(armazenamento.journal)
+    inverter_byte(armazenamento.journal, meio)
+
+    with pytest.raises(savecnt.JournalCorrompido):
+        abrir_pickle(tmp_path)
+    assert os.path.getsize(armazenamento.journal) == tamanho
+
+
+def test_registro_ilegivel_nao_zera_o_journal(tmp_path, monkeypatch):
+    # Classe que o processo que lê não encontra: antes o journal era truncado na posição 0
+    Desconhecida = type("Desconhecida", (), {"__module__": "__main__"})
+    monkeypatch.setattr(sys.modules["__main__"], "Desconhecida", Desconhecida, raising=False)
+    gravar_journal(tmp_path / "contatos_salvos.log", [(1, 1, "estado", {"ordenacao": Desconhecida()})])
+    monkeypatch.undo()
+    tamanho = os.path.getsize(tmp_path / "contatos_salvos.log")
+
+    with pytest.raises(savecnt.JournalCorrompido):
+        abrir_pickle(tmp_path)
+    assert os.path.getsize(tmp_path / "contatos_salvos.log") == tamanho
+
+
+def test_compactacao_que_falha_devolve_os_deltas(tmp_path, monkeypatch):
+    armazenamento = abrir_pickle(tmp_path)
+    armazenamento.registrar(1, "adicionar", contatos("Ana"), {})
+    escrevendo, liberar = threading.Event(), threading.Event()
+
+    def escrever_snapshot(caminho, blocos, seq):
+        escrevendo.set()
+        liberar.wait(5)
+        raise OSError("disco cheio")
+    monkeypatch.setattr(armazenamento, "_escrever_snapshot", escrever_snapshot)
+
+    armazenamento.iniciar()
+    armazenamento.salvar({})
+    assert escrevendo.wait(5)
+    # Alterações feitas enquanto o gravador compacta, em outra thread
+    armazenamento.registrar(1, "adicionar", contatos("Bia"), {})
+    armazenamento.registrar(2, "adicionar", contatos("Caio"), {})
+    liberar.set()
+    armazenamento.parar()
+
+    assert armazenamento.compactando is None
+    assert [nome for nome, _, _ in resumo(armazenamento.carregar_usuario(1))] == ["Ana", "Bia"]
+    assert [nome for nome, _, _ in resumo(armazenamento.carregar_usuario(2))] == ["Caio"]
+    reaberto = abrir_pickle(tmp_path)
+    assert [nome for nome, _, _ in resumo(reaberto.carregar_usuario(1))] == ["Ana", "Bia"]
+
+
+# ------------------- SNAPSHOT CORROMPIDO -------------------
+
+@pytest.fixture
+def snapshot(tmp_path):
+    armazenamento = abrir_pickle(tmp_path)
+    armazenamento.importar_usuarios({1: {"contatos": contatos("Ana", "Bia")}, 2: {"contatos": contatos("Caio")}})
+    armazenamento.registrar(2, "adicionar", contatos("Duda"), {})
+    armazenamento.fechar()
+    return armazenamento
+
+
+def tamanhos(armazenamento):
+    return os.path.getsize(armazenamento.arquivo), os.path.getsize(armazenamento.journal)
+
+
+def test_snapshot_truncado_impede_a_partida(tmp_path, snapshot):
+    with open(snapshot.arquivo, 'r+b') as f:
+        f.truncate(os.path.getsize(snapshot.arquivo) - 5)
+    antes = tamanhos(snapshot)
+    with pytest.raises(savecnt.SnapshotCorrompido):
+        abrir_pickle(tmp_path)
+    # Nada é movido nem reescrito: o backup restaurado ainda recebe o journal
+    assert tamanhos(snapshot) == antes
+    assert sorted(os.listdir(tmp_path)) == ["contatos_salvos.log", "contatos_salvos.pkl"]
+
+
+def test_tabela_corrompida_impede_a_partida(tmp_path, snapshot):
+    fim_tabela = os.path.getsize(snapshot.arquivo) - len(savecnt.MAGICO_SNAPSHOT) - 4 - savecnt.RODAPE_SNAPSHOT.size
+    inverter_byte(snapshot.arquivo, fim_tabela - 1)
+    with pytest.raises(savecnt.SnapshotCorrompido):
+        abrir_pickle(tmp_path)
+
+
+def test_bloco_corrompido_afeta_so_o_usuario(tmp_path, snapshot):
+    armazenamento = abrir_pickle(tmp_path)
+    posicao, _, _ = armazenamento.indice[1]
+    armazenamento.fechar()
+    inverter_byte(snapshot.arquivo, posicao + 2)
+
+    armazenamento = abrir_pickle(tmp_path)
+    with pytest.raises(savecnt.SnapshotCorrompido):
+        armazenamento.carregar_usuario(1)
+    assert [nome for nome, _, _ in resumo(armazenamento.carregar_usuario(2))] == ["Caio", "Duda"]
+
+    # A compactação termina: o bloco ruim segue como está e as alterações dele vão para outro arquivo
+    armazenamento.registrar(1, "adicionar", contatos("Eva"), {})
+    armazenamento.registrar(2, "adicionar", contatos("Fabi"), {})
+    armazenamento.salvar({})
+    assert armazenamento.compactando is None
+    assert os.path.getsize(armazenamento.journal) == 0
+    quarentena = [nome for nome in os.listdir(tmp_path) if ".usuario1.corrompido-" in nome]
+    assert len(quarentena) == 1
+    with open(tmp_path / quarentena[0], 'rb') as f:
+        assert pickle.load(f)[1:3] == (1, "adicionar")
+    assert not [nome for nome in os.listdir(tmp_path) if nome.endswith(".tmp")]
+
+    reaberto = abrir_pickle(tmp_path)
+    with pytest.raises(savecnt.SnapshotCorrompido):
+        reaberto.carregar_usuario(1)
+    assert [nome for nome, _, _ in resumo(reaberto.carregar_usuario(2))] == ["Caio", "Duda", "Fabi"]
+
+
+# ------------------- FORMATOS ANTIGOS -------------------
+
+def gravar_formato_3(caminho, usuarios, seq):
+    indice = {}
+    with open(caminho, 'wb') as f:
+        f.write(savecnt.MAGICO_SNAPSHOT_3)
+        for user_id, usuario in usuarios.items():
+            dados = pickle.dumps(usuario, protocol=pickle.HIGHEST_PROTOCOL)
+            indice[user_id] = (f.tell(), len(dados))
+            f.write(dados)
+        posicao = f.tell()
+        f.write(pickle.dumps({"seq": seq, "indice": indice}, protocol=pickle.HIGHEST_PROTOCOL))
+        f.write(struct.pack("<Q", posicao))
+
+
+def gravar_formato_2(caminho, usuarios, seq):
+    with open(caminho, 'wb') as f:
+        pickle.dump({"formato": 2, "seq": seq, "usuarios": usuarios}, f)
+
+
+def gravar_dicionario(caminho, usuarios, seq):
+    # Primeiro formato: o dicionário de usuários direto, com contatos em tuplas (linha, número)
+    with open(caminho, 'wb') as f:
+        pickle.dump({
+            user_id: {**usuario, "contatos": [(c.nome_linha, c.numero) for c in usuario["contatos"]]}
+            for user_id, usuario in usuarios.items()
+        }, f)
+
+
+@pytest.mark.parametrize("gravar, seq", [(gravar_formato_3, 7), (gravar_formato_2, 7), (gravar_dicionario, 0)])
+def test_formato_antigo_convertido(tmp_path, gravar, seq):
+    usuarios = {
+        1: {"contatos": contatos("Ana - Casa", "Bia"), "modo_edicao": True},
+        -5: {"contatos": contatos("Caio"), "ordenacao": "alfabetica"},
+    }
+    arquivo = tmp_path / "contatos_salvos.pkl"
+    gravar(arquivo, usuarios, seq)
+    # Um registro já contido no snapshot (ignorado, quando há seq) e um posterior
+    registros = [(seq + 1, 1, "adicionar", contatos("Duda"))]
+    if seq:
+        registros.insert(0, (seq, 1, "adicionar", contatos("Repetido")))
+    gravar_journal(tmp_path / "contatos_salvos.log", registros)
+
+    armazenamento = abrir_pickle(tmp_path)
+    with open(arquivo, 'rb') as f:
+        assert f.read(len(savecnt.MAGICO_SNAPSHOT)) == savecnt.MAGICO_SNAPSHOT
+    assert [nome for nome, _, _ in resumo(armazenamento.carregar_usuario(1))] == ["Ana", "Bia", "Duda"]
+    assert resumo(armazenamento.carregar_usuario(1))[0] == ("Ana", "Casa", "82991110000")
+    assert armazenamento.carregar_usuario(-5)["ordenacao"] == "alfabetica"
+
+    # Convertido uma vez: a próxima partida já lê o formato novo
+    reaberto = abrir_pickle(tmp_path)
+    assert exportados(reaberto) == exportados(armazenamento)
+
+
+# ------------------- PICKLE <-> SQLITE -------------------
+
+@pytest.fixture
+def memoria(monkeypatch):
+    # Poucos usuários em memória: as alterações abaixo forçam descartes o tempo todo
+    monkeypatch.setattr(savecnt, "LIMITE_USUARIOS_MEMORIA", 3)
+
+    def usar(armazenamento):
+        monkeypatch.setattr(savecnt, "armazenamento", armazenamento)
+        monkeypatch.setattr(savecnt, "contatos_por_usuario", OrderedDict())
+        monkeypatch.setattr(savecnt, "contatos_em_memoria", 0)
+        monkeypatch.setattr(savecnt, "indices_por_usuario", {})
+        monkeypatch.setattr(savecnt, "versoes_por_usuario", {})
+
+    return usar
+
+
+def alterar_usuarios(esperado, aleatorio, passos):
+    # Aplica alterações pelo caminho dos handlers e repete cada uma no modelo esperado
+    for passo in range(passos):
+        user_id = aleatorio.randrange(1, 9)
+        lista = esperado.setdefault(user_id, [])
+        sorteio = aleatorio.random()
+        if lista and sorteio < 0.25:
+            idx = aleatorio.randrange(len(lista))
+            novo = savecnt.Contato("Editado", "Trabalho", f"8299{passo:07d}")
+            savecnt.editar_contato(user_id, idx, novo)
+            lista[idx] = ("Editado", "Trabalho", novo.numero)
+        elif lista and sorteio < 0.45:
+            indices = set(aleatorio.sample(range(len(lista)), aleatorio.randint(1, len(lista))))
+            savecnt.remover_contatos(user_id, indices)
+            lista[:] = [c for i, c in enumerate(lista) if i not in indices]
+        else:
+            novos = [savecnt.Contato(f"Contato {passo}-{i}", None, f"8298{passo:05d}{i:02d}") for i in range(aleatorio.randint(1, 4))]
+            savecnt.adicionar_contatos(user_id, novos)
+            lista.extend((c.nome, c.categoria, c.numero) for c in novos)
+        assert len(savecnt.contatos_por_usuario) <= 3
+    return {user_id: lista for user_id, lista in esperado.items() if lista}
+
+
+def test_ida_e_volta_entre_pickle_e_sqlite(tmp_path, memoria):
+    aleatorio = random.Random(1)
+    esperado = {}
+
+    origem = abrir_pickle(tmp_path)
+    memoria(origem)
+    esperado = alterar_usuarios(esperado, aleatorio, 150)
+    origem.salvar({})
+    # Parte fica só no journal, sem compactar
+    esperado = alterar_usuarios(esperado, aleatorio, 50)
+    assert exportados(abrir_pickle(tmp_path)) == esperado
+
+    # pickle -> SQLite pela migração automática
+    caminho_banco = str(tmp_path / "contatos.db")
+    banco = savecnt.ArmazenamentoSQLite(caminho_banco, origem.arquivo, origem.journal)
+    assert exportados(banco) == esperado
+
+    # Com o gravador em outra thread, usuários saem da memória com escritas ainda na fila
+    memoria(banco)
+    banco.iniciar()
+    esperado = alterar_usuarios(esperado, aleatorio, 200)
+    for user_id in esperado:
+        assert resumo(savecnt.obter_usuario(user_id)) == esperado[user_id]
+    banco.parar()
+    banco.fechar()
+
+    banco = savecnt.ArmazenamentoSQLite(caminho_banco, origem.arquivo, origem.journal)
+    assert exportados(banco) == esperado
+
+    # SQLite -> pickle
+    destino = abrir_pickle(tmp_path, "volta")
+    destino.importar_usuarios(banco.exportar_usuarios())
+    banco.fechar()
+    assert exportados(abrir_pickle(tmp_path, "volta")) == esperado
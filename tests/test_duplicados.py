@@ -0,0 +1,86 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import savecnt
+
+
+class Conversa:
+    # Comando /duplicados e cliques nos botões, pelos handlers, com as respostas guardadas
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.respostas = []
+
+    async def responder(self, texto, **kwargs):
+        self.respostas.append(texto)
+
+    def duplicados(self, *args):
+        update = SimpleNamespace(
+            effective_user=SimpleNamespace(id=self.user_id),
+            message=SimpleNamespace(text="/duplicados", reply_text=self.responder),
+        )
+        asyncio.run(savecnt.duplicados(update, SimpleNamespace(args=list(args))))
+        return self.respostas[-1]
+
+    def clicar(self, data):
+        async def answer():
+            pass
+
+        query = SimpleNamespace(
+            data=data, from_user=SimpleNamespace(id=self.user_id), answer=answer, edit_message_text=self.responder,
+        )
+        asyncio.run(savecnt.callback_handler(SimpleNamespace(callback_query=query), None))
+        return self.respostas[-1]
+
+
+def lista(user_id):
+    return [(c.nome, c.categoria, c.numero) for c in savecnt.obter_usuario(user_id)["contatos"]]
+
+
+@pytest.fixture
+def conversa(usuarios_isolados):
+    savecnt.adicionar_contatos(1, [
+        savecnt.Contato("Ana", None, "82991110000"),
+        savecnt.Contato("Ana", "Casa", "8291110000"),
+        savecnt.Contato("Ana", None, "82988887777"),
+        savecnt.Contato("Bia", None, "82977776666"),
+        savecnt.Contato("Caio", "Trabalho", "82966665555"),
+        savecnt.Contato("Caio Souza", None, "82966665555"),
+    ])
+    return Conversa(1)
+
+
+def test_juntar_completa_a_categoria_e_mantem_outros_numeros(conversa):
+    texto = conversa.duplicados("nomes")
+    assert "2 grupo(s) de duplicados" in texto
+    # O mantido já aparece com a categoria herdada; o número diferente fica
+    assert "⭐ Ana - Casa (+55 82991110000)" in texto
+    assert "• Ana - Casa (+55 8291110000)" in texto
+    assert "📞 Ana (+55 82988887777)" in texto
+
+    conversa.clicar("dup_juntar_pagina:0")
+    resposta = conversa.clicar("dup_aplicar")
+    assert resposta.startswith("✅ 2 grupo(s) juntados, 2 contato(s) duplicados removidos.")
+    assert "1 contato(s) ficaram com a categoria" in resposta
+    assert lista(1) == [
+        ("Ana", "Casa", "82991110000"),
+        ("Ana", None, "82988887777"),
+        ("Bia", None, "82977776666"),
+        ("Caio", "Trabalho", "82966665555"),
+    ]
+    reaberto = savecnt.ArmazenamentoPickle(savecnt.armazenamento.arquivo, savecnt.armazenamento.journal)
+    reaberto.carregar()
+    assert [(c.nome, c.categoria, c.numero) for c in reaberto.carregar_usuario(1)["contatos"]] == lista(1)
+
+
+def test_grupo_conferido_de_novo_ao_aplicar(conversa):
+    conversa.duplicados()
+    conversa.clicar("dup_juntar_pagina:0")
+    # Depois do /duplicados, uma cópia da Ana muda de número e a do Caio some
+    savecnt.editar_contato(1, 1, savecnt.Contato("Ana", "Casa", "82955554444"))
+    savecnt.remover_contatos(1, [5])
+
+    resposta = conversa.clicar("dup_aplicar")
+    assert resposta == "✅ 0 grupo(s) juntados, 0 contato(s) duplicados removidos."
+    assert len(lista(1)) == 5
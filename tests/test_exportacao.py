@@ -0,0 +1,53 @@
+import asyncio
+import zipfile
+
+import pytest
+
+import savecnt
+
+
+@pytest.fixture
+def gerados(usuarios_isolados, monkeypatch):
+    # Formatos que passaram de fato pelos escritores, em ordem
+    monkeypatch.setattr(savecnt, "cache_exportacoes", savecnt.CacheExportacoes())
+    gerados = []
+    gerar_arquivo = savecnt.gerar_arquivo
+
+    def contar(formato, registros):
+        gerados.append(formato)
+        return gerar_arquivo(formato, registros)
+    monkeypatch.setattr(savecnt, "gerar_arquivo", contar)
+    savecnt.adicionar_contatos(1, [
+        savecnt.Contato("Ana", "Casa", "82991110000"), savecnt.Contato("Bia", None, "8233334444"),
+    ])
+    return gerados
+
+
+def obter(*formatos):
+    arquivos = asyncio.run(savecnt.obter_arquivos(1, list(formatos)))
+    return {formato: arquivo.getvalue() for formato, arquivo in arquivos.items()}
+
+
+def test_zip_reaproveita_os_formatos_do_cache(gerados):
+    vcf = obter("vcf")["vcf"]
+    assert gerados == ["vcf"]
+
+    pacote = obter("zip")["zip"]
+    assert sorted(gerados) == ["csv", "json", "vcf"]
+    with zipfile.ZipFile(savecnt.arquivo_em_memoria("zip", pacote)) as lido:
+        assert lido.namelist() == ["contatos.vcf", "contatos.csv", "contatos.json"]
+        assert lido.read("contatos.vcf") == vcf
+        assert lido.read("contatos.csv") == obter("csv")["csv"]
+
+    # Tudo no cache: nada é gerado de novo
+    assert obter("zip", "json")["zip"] == pacote
+    assert len(gerados) == 3
+
+
+def test_alteracao_invalida_o_cache(gerados):
+    obter("zip")
+    savecnt.remover_contatos(1, [1])
+    pacote = obter("zip")["zip"]
+    assert sorted(gerados) == ["csv", "csv", "json", "json", "vcf", "vcf"]
+    with zipfile.ZipFile(savecnt.arquivo_em_memoria("zip", pacote)) as lido:
+        assert b"Bia" not in lido.read("contatos.csv")
@@ -0,0 +1,69 @@
+import asyncio
+from types import SimpleNamespace
+
+import savecnt
+
+
+class Mensagem:
+    def __init__(self, documento=None):
+        self.document = documento
+        self.textos = []
+
+    async def reply_text(self, texto, **kwargs):
+        self.textos.append(texto)
+        return self
+
+    async def edit_text(self, texto, **kwargs):
+        self.textos.append(texto)
+        return self
+
+
+class Documento:
+    def __init__(self, nome, dados):
+        self.file_name = nome
+        self.mime_type = None
+        self.file_size = len(dados)
+        self.dados = dados
+
+    async def get_file(self):
+        return self
+
+    async def download_to_memory(self, out):
+        out.write(self.dados)
+
+
+def importar(user_id, nome, conteudo):
+    mensagem = Mensagem(Documento(nome, conteudo.encode("utf-8")))
+    update = SimpleNamespace(effective_user=SimpleNamespace(id=user_id), message=mensagem)
+    contexto = SimpleNamespace(bot=SimpleNamespace(rate_limiter=None))
+    asyncio.run(savecnt.importar_documento(update, contexto))
+    return mensagem.textos[-1]
+
+
+def test_linha_sem_nome_nao_e_numero_invalido(usuarios_isolados):
+    resposta = importar(1, "contatos.csv", "\n".join([
+        "Nome,Número,Categoria",
+        "Ana,+55 82 99111-0000,Casa",
+        ",82 99999-8888,Casa",
+        "Bia,123,",
+        "",
+        "Caio,(82) 3333-4444,",
+        "Ana,82991110000,Casa",
+    ]))
+    assert resposta.startswith("✅ Importação concluída: 2 de 6 contato(s) adicionados.")
+    assert "⚠️ 1 contato(s) já existiam" in resposta
+    assert "❌ 1 contato(s) sem nome, não importado(s):\n• contato 2: 82 99999-8888" in resposta
+    assert "❌ 1 número(s) inválido(s)" in resposta
+    assert "• contato 3: 123" in resposta
+    # A linha em branco não aparece em nenhum dos avisos
+    assert "contato 4" not in resposta
+    assert [(c.nome, c.categoria, c.numero) for c in savecnt.obter_usuario(1)["contatos"]] == [
+        ("Ana", "Casa", "82991110000"), ("Caio", None, "8233334444"),
+    ]
+
+
+def test_json_sem_nome(usuarios_isolados):
+    resposta = importar(2, "contatos.json", '[{"nome": "", "numero": "82991110000"}, {"nome": " ", "numero": "12"}]')
+    assert "❌ 2 contato(s) sem nome" in resposta
+    assert "número(s) inválido(s)" not in resposta
+    assert savecnt.obter_usuario(2)["contatos"] == []
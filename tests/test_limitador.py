@@ -0,0 +1,107 @@
+import asyncio
+import time
+from datetime import timedelta
+
+from telegram.error import RetryAfter
+
+import savecnt
+
+
+class ApiFalsa:
+    # Registra cada chamada que chega de fato à Bot API; erros[n] é levantado na chamada n
+    def __init__(self, erros=None):
+        self.enviados = []
+        self.erros = dict(erros or {})
+
+    async def __call__(self, data):
+        self.enviados.append((time.monotonic(), dict(data)))
+        erro = self.erros.pop(len(self.enviados), None)
+        if erro is not None:
+            raise erro
+        return len(self.enviados)
+
+
+def enviar(limitador, api, chat_id, texto, **extras):
+    data = {"chat_id": chat_id, "text": texto, **extras.pop("data", {})}
+    return limitador.process_request(api, (data,), {}, "sendMessage", data, extras.get("rate_limit_args"))
+
+
+def balde_rapido(limitador, chat_id, taxa=20):
+    # Balde sem fichas e com taxa alta: a próxima chamada espera 1/taxa s, sem deixar o teste lento
+    balde = limitador.chats[chat_id] = savecnt.BaldeFichas(taxa, 1)
+    balde.fichas = 0
+
+
+def test_textos_na_espera_do_chat_saem_juntos():
+    async def rodar():
+        limitador, api = savecnt.LimitadorEnvios(), ApiFalsa()
+        balde_rapido(limitador, 1)
+        resultados = await asyncio.gather(
+            enviar(limitador, api, 1, "primeiro"),
+            enviar(limitador, api, 1, "segundo"),
+            enviar(limitador, api, 1, "terceiro"),
+        )
+        return limitador, api, resultados
+
+    limitador, api, resultados = asyncio.run(rodar())
+    assert [data["text"] for _, data in api.enviados] == ["primeiro\n\nsegundo\n\nterceiro"]
+    # Todos recebem a mensagem que saiu
+    assert resultados == [1, 1, 1]
+    assert limitador.metricas["enviadas"] == 1
+    assert limitador.metricas["juntadas"] == 2
+
+
+def test_so_junta_textos_compativeis():
+    async def rodar():
+        limitador, api = savecnt.LimitadorEnvios(), ApiFalsa()
+        for chat_id in (1, 2, 3):
+            balde_rapido(limitador, chat_id)
+        await asyncio.gather(
+            enviar(limitador, api, 1, "a"),
+            enviar(limitador, api, 1, "b", data={"parse_mode": "Markdown"}),
+            enviar(limitador, api, 1, "c", rate_limit_args={"juntar": False}),
+            enviar(limitador, api, 2, "d"),
+            # Juntas passariam do tamanho máximo de uma mensagem
+            enviar(limitador, api, 3, "e"),
+            enviar(limitador, api, 3, "x" * (savecnt.LIMITE_TEXTO_TELEGRAM - 2)),
+        )
+        return api
+
+    api = asyncio.run(rodar())
+    assert sorted(data["text"][:3] for _, data in api.enviados) == ["a", "b", "c", "d", "e", "xxx"]
+
+
+def test_429_pausa_o_chat_e_repete():
+    async def rodar():
+        limitador = savecnt.LimitadorEnvios()
+        api = ApiFalsa(erros={1: RetryAfter(timedelta(milliseconds=200))})
+        limitador.chats[1] = savecnt.BaldeFichas(10, 3)
+        primeira = asyncio.create_task(enviar(limitador, api, 1, "a", rate_limit_args={"juntar": False}))
+        while not api.enviados:
+            await asyncio.sleep(0.001)
+        # Chega depois do 429: o balde do chat está pausado e ela espera o prazo também
+        segunda = enviar(limitador, api, 1, "b", rate_limit_args={"juntar": False})
+        await asyncio.gather(primeira, segunda)
+        return limitador, api
+
+    limitador, api = asyncio.run(rodar())
+    (pedido_429, _), *depois = api.enviados
+    assert sorted(data["text"] for _, data in depois) == ["a", "b"]
+    assert all(momento - pedido_429 >= 0.19 for momento, _ in depois)
+    assert limitador.metricas["erros_429"] == 1
+    assert limitador.metricas["repetidas"] == 1
+    assert limitador.metricas["enviadas"] == 2
+
+
+def test_429_repetido_ate_o_limite_de_tentativas():
+    async def rodar():
+        limitador = savecnt.LimitadorEnvios(tentativas=2)
+        api = ApiFalsa(erros={n: RetryAfter(timedelta(milliseconds=10)) for n in (1, 2)})
+        balde_rapido(limitador, 1, taxa=1000)
+        try:
+            await enviar(limitador, api, 1, "a")
+        except RetryAfter:
+            return api
+        raise AssertionError("o segundo 429 devia chegar a quem chamou")
+
+    assert len(asyncio.run(rodar()).enviados) == 2
@@ -0,0 +1,81 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import savecnt
+
+
+def test_normalizar_numeros_igual_a_limpar_um_por_um():
+    numeros = [
+        "(82) 99111-0000", "+55 82 99111 0000", "5582991110000", "82 3333-4444",
+        "", "abc", "055 82 99111-0000", "8299111000０", " 82.99111.0000 ",
+    ]
+    assert savecnt.normalizar_numeros(numeros) == [savecnt.limpar_numero(n) for n in numeros]
+    assert savecnt.normalizar_numeros(numeros)[:4] == ["82991110000", "82991110000", "82991110000", "8233334444"]
+    assert savecnt.normalizar_numeros([]) == []
+
+
+def test_so_aceita_ddd_mais_numero():
+    assert savecnt.validar_numero_brasileiro("8233334444")
+    assert savecnt.validar_numero_brasileiro("82991110000")
+    assert not savecnt.validar_numero_brasileiro("991110000")
+    assert not savecnt.validar_numero_brasileiro("829911100000")
+    assert not savecnt.validar_numero_brasileiro("")
+
+
+def test_relatorio_lista_no_maximo_o_limite():
+    invalidos = [(2 * i + 2, f"12{i}") for i in range(savecnt.LIMITE_INVALIDOS_EXIBIDOS + 5)]
+    linhas = savecnt.relatorio_invalidos(invalidos).splitlines()
+    assert linhas[0].startswith(f"❌ {len(invalidos)} número(s) inválido(s)")
+    assert linhas[1] == "• linha 2: 120"
+    assert len(linhas) == 1 + savecnt.LIMITE_INVALIDOS_EXIBIDOS + 1
+    assert linhas[-1] == "… e mais 5 inválido(s)."
+
+
+@pytest.fixture
+def bot(usuarios_isolados):
+    def enviar(user_id, texto):
+        respostas = []
+
+        async def reply_text(resposta, **kwargs):
+            respostas.append(resposta)
+
+        update = SimpleNamespace(
+            effective_user=SimpleNamespace(id=user_id),
+            message=SimpleNamespace(text=texto, reply_text=reply_text),
+        )
+        asyncio.run(savecnt.handle_message(update, None))
+        return respostas
+
+    return enviar
+
+
+def test_mensagem_com_invalidos_recebe_uma_resposta_so(bot):
+    respostas = bot(1, "\n".join([
+        "Ana - Casa", "(82) 99111-0000",
+        "Bia", "123",
+        "Caio", "+55 82 3333-4444",
+        "Ana - Casa", "82991110000",
+        "Duda", "9999999999999",
+    ]))
+    assert len(respostas) == 1
+    resposta = respostas[0]
+    assert "✅ 2 contato(s) adicionados." in resposta
+    assert "⚠️ 1 contato(s) já existiam" in resposta
+    # Linhas dos números inválidos na mensagem, contando a partir de 1
+    assert "❌ 2 número(s) inválido(s)" in resposta
+    assert "• linha 4: 123" in resposta and "• linha 10: 9999999999999" in resposta
+    assert [(c.nome, c.categoria, c.numero) for c in savecnt.obter_usuario(1)["contatos"]] == [
+        ("Ana", "Casa", "82991110000"), ("Caio", None, "8233334444"),
+    ]
+
+
+def test_mensagem_so_com_invalidos_nao_adiciona(bot):
+    respostas = bot(2, "Ana\n12\nBia\n34")
+    assert respostas == [
+        "❌ Nenhum contato válido foi adicionado.\n\n"
+        "❌ 2 número(s) inválido(s). Devem ter 10 ou 11 dígitos (DDD + número):\n"
+        "• linha 2: 12\n• linha 4: 34"
+    ]
+    assert savecnt.obter_usuario(2)["contatos"] == []
@@ -0,0 +1,85 @@
+import pytest
+
+import savecnt
+
+
+class Relogio:
+    # Substitui o módulo time do savecnt: monotonic e time andam juntos, só quando o teste manda
+    def __init__(self):
+        self.agora = 1000.0
+
+    def monotonic(self):
+        return self.agora
+
+    def time(self):
+        return 1_700_000_000 + self.agora
+
+    def avancar(self, segundos):
+        self.agora += segundos
+
+
+@pytest.fixture
+def relogio(monkeypatch):
+    relogio = Relogio()
+    monkeypatch.setattr(savecnt, "time", relogio)
+    return relogio
+
+
+def test_sessao_expira_depois_do_ttl_sem_uso(relogio):
+    sessoes = savecnt.SessoesUsuarios(ttl=60, limite=100, arquivo="")
+    sessoes.obter(1)["modo_edicao"] = "selecionar"
+    # Cada acesso renova o prazo
+    relogio.avancar(50)
+    assert sessoes.obter(1) == {"modo_edicao": "selecionar"}
+    relogio.avancar(50)
+    assert sessoes.obter(1) == {"modo_edicao": "selecionar"}
+    sessoes.obter(2)
+    relogio.avancar(61)
+    assert sessoes.obter(1) == {}
+    # A expirada sai da memória mesmo sem ser acessada de novo
+    assert list(sessoes.sessoes) == [1]
+
+
+def test_limite_descarta_a_mais_antiga_sem_update_em_andamento(relogio):
+    sessoes = savecnt.SessoesUsuarios(ttl=60, limite=2, arquivo="")
+    for user_id in (1, 2):
+        sessoes.obter(user_id)["lote"] = user_id
+        relogio.avancar(1)
+    sessoes.obter(3)
+    assert list(sessoes.sessoes) == [2, 3]
+
+    # O usuário 2 tem update em andamento: quem sai é o 3, mesmo sendo mais recente
+    savecnt.travas_usuarios.travas[2] = [None, 1]
+    try:
+        sessoes.obter(4)
+    finally:
+        del savecnt.travas_usuarios.travas[2]
+    assert list(sessoes.sessoes) == [2, 4]
+
+
+def test_sessoes_sobrevivem_ao_reinicio_com_o_tempo_restante(tmp_path, relogio):
+    arquivo = str(tmp_path / "sessoes.pkl")
+    sessoes = savecnt.SessoesUsuarios(ttl=60, limite=100, arquivo=arquivo)
+    sessoes.obter(1)["modo_remocao"] = "lote"
+    relogio.avancar(40)
+    sessoes.obter(2)["contatos_lote"] = [("Ana", "82991110000")]
+    sessoes.obter(3)
+    sessoes.salvar()
+
+    # Bot parado por 30s: a sessão 1 tinha 20s restantes e expira, a 2 fica com 30s
+    relogio.avancar(30)
+    reaberto = savecnt.SessoesUsuarios(ttl=60, limite=100, arquivo=arquivo)
+    reaberto.carregar()
+    # Sessões vazias não são gravadas
+    assert list(reaberto.sessoes) == [2]
+    assert reaberto.sessoes[2][1] == {"contatos_lote": [("Ana", "82991110000")]}
+    relogio.avancar(29)
+    assert reaberto.obter(2) == {"contatos_lote": [("Ana", "82991110000")]}
+
+
+def test_arquivo_de_sessoes_ilegivel_comeca_vazio(tmp_path, relogio):
+    arquivo = tmp_path / "sessoes.pkl"
+    arquivo.write_bytes(b"nao e pickle")
+    sessoes = savecnt.SessoesUsuarios(ttl=60, limite=100, arquivo=str(arquivo))
+    sessoes.carregar()
+    assert sessoes.obter(1) == {}
@@ -0,0 +1,60 @@
+import asyncio
+from types import SimpleNamespace
+
+import savecnt
+
+
+def update_de(user_id, update_id):
+    return SimpleNamespace(update_id=update_id, effective_user=SimpleNamespace(id=user_id))
+
+
+def test_updates_do_mesmo_usuario_em_ordem_e_usuarios_em_paralelo():
+    eventos = []
+
+    @savecnt.por_usuario
+    async def handler(update, context):
+        eventos.append(("inicio", update.update_id))
+        # O primeiro update demora mais: sem a trava o segundo terminaria antes dele
+        await asyncio.sleep(0.05 if update.update_id == 1 else 0.01)
+        eventos.append(("fim", update.update_id))
+
+    async def rodar():
+        await asyncio.gather(
+            handler(update_de(10, 1), None),
+            handler(update_de(10, 2), None),
+            handler(update_de(20, 3), None),
+            handler(update_de(10, 4), None),
+        )
+
+    asyncio.run(rodar())
+    do_usuario_10 = [evento for evento in eventos if evento[1] in (1, 2, 4)]
+    assert do_usuario_10 == [("inicio", 1), ("fim", 1), ("inicio", 2), ("fim", 2), ("inicio", 4), ("fim", 4)]
+    # O outro usuário não espera o primeiro terminar
+    assert eventos.index(("inicio", 3)) < eventos.index(("fim", 1))
+    assert savecnt.travas_usuarios.travas == {}
+
+
+def test_trava_sai_da_memoria_mesmo_com_erro():
+    @savecnt.por_usuario
+    async def handler(update, context):
+        raise RuntimeError("falha no handler")
+
+    async def rodar():
+        resultados = await asyncio.gather(
+            handler(update_de(30, 1), None), handler(update_de(30, 2), None), return_exceptions=True,
+        )
+        assert [type(r) for r in resultados] == [RuntimeError, RuntimeError]
+
+    asyncio.run(rodar())
+    assert savecnt.travas_usuarios.travas == {}
+
+
+def test_update_sem_usuario_nao_usa_trava():
+    vistos = []
+
+    @savecnt.por_usuario
+    async def handler(update, context):
+        vistos.append(dict(savecnt.travas_usuarios.travas))
+
+    asyncio.run(handler(SimpleNamespace(update_id=1, effective_user=None), None))
+    assert vistos == [{}]
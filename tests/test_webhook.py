@@ -0,0 +1,99 @@
+import asyncio
+import json
+
+import savecnt
+
+
+async def enviar(porta, bruto):
+    reader, writer = await asyncio.open_connection("127.0.0.1", porta)
+    writer.write(bruto)
+    await writer.drain()
+    linha = await reader.readline()
+    resposta = linha + await reader.read()
+    writer.close()
+    return int(linha.split()[1]), resposta
+
+
+def post(corpo, caminho="/webhook", extras=""):
+    return (
+        f"POST {caminho} HTTP/1.1\r\nHost: x\r\nContent-Length: {len(corpo)}\r\n{extras}Connection: close\r\n\r\n"
+    ).encode() + corpo
+
+
+def servir(teste, processar=None, **kwargs):
+    # Servidor de verdade numa porta livre; o teste recebe a porta
+    recebidos = []
+
+    async def guardar(dados):
+        recebidos.append(dados)
+
+    async def rodar():
+        servidor = savecnt.ServidorWebhook(processar or guardar, "127.0.0.1", 0, "/webhook", **kwargs)
+        await servidor.iniciar()
+        try:
+            await teste(servidor.servidor.sockets[0].getsockname()[1])
+        finally:
+            await servidor.parar()
+
+    asyncio.run(rodar())
+    return recebidos
+
+
+def test_update_aceito():
+    async def teste(porta):
+        status, _ = await enviar(porta, post(json.dumps({"update_id": 7}).encode()))
+        assert status == 200
+
+    assert servir(teste) == [{"update_id": 7}]
+
+
+def test_requisicoes_malformadas_recebem_400():
+    async def teste(porta):
+        assert (await enviar(porta, b"LIXO\r\n\r\n"))[0] == 400
+        assert (await enviar(porta, b"POST /webhook HTTP/1.1\r\nContent-Length: abc\r\n\r\n"))[0] == 400
+        assert (await enviar(porta, b"POST /webhook HTTP/1.1\r\nContent-Length: -5\r\n\r\n"))[0] == 400
+        assert (await enviar(porta, post(b"{nao e json")))[0] == 400
+
+    assert servir(teste) == []
+
+
+def test_corpo_acima_do_limite_recebe_413():
+    async def teste(porta):
+        tamanho = savecnt.LIMITE_CORPO_WEBHOOK + 1
+        status, _ = await enviar(porta, f"POST /webhook HTTP/1.1\r\nContent-Length: {tamanho}\r\n\r\n".encode())
+        assert status == 413
+
+    assert servir(teste) == []
+
+
+def test_caminho_e_segredo():
+    async def teste(porta):
+        corpo = json.dumps({"update_id": 1}).encode()
+        assert (await enviar(porta, post(corpo, caminho="/outro")))[0] == 404
+        assert (await enviar(porta, post(corpo)))[0] == 401
+        assert (await enviar(porta, post(corpo, extras="X-Telegram-Bot-Api-Secret-Token: s3\r\n")))[0] == 200
+
+    assert servir(teste, segredo="s3") == [{"update_id": 1}]
+
+
+def test_fila_cheia_recebe_503():
+    liberar = asyncio.Event()
+    processados = []
+
+    async def processar(dados):
+        await liberar.wait()
+        processados.append(dados["update_id"])
+
+    async def teste(porta):
+        # O primeiro fica preso no único trabalhador, o segundo ocupa a única vaga da fila
+        assert (await enviar(porta, post(b'{"update_id": 1}')))[0] == 200
+        await asyncio.sleep(0.05)
+        assert (await enviar(porta, post(b'{"update_id": 2}')))[0] == 200
+        status, resposta = await enviar(porta, post(b'{"update_id": 3}'))
+        assert status == 503
+        assert b"Retry-After: 1" in resposta
+        liberar.set()
+
+    servir(teste, processar=processar, concorrencia=1, tamanho_fila=1)
+    # O que foi aceito é processado antes de o servidor parar
+    assert processados == [1, 2]